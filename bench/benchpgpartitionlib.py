@@ -0,0 +1,326 @@
+# Copyright (c) 2010 Matt Harrison
+'''
+Benchmarks of the sql generators and, optionally, of rows per second
+through the generated insert trigger.  Results are written as JSON so
+two versions can be compared:
+
+  python bench/benchpgpartitionlib.py -o new.json
+  python bench/benchpgpartitionlib.py --compare old.json new.json
+
+Each generator case runs in its own process, so its peak RSS (from
+getrusage) is its own.  The routing benchmark needs psycopg2 and either
+--dsn (tables are made in a pgpartition_bench schema that is dropped
+afterwards) or --throwaway, which runs initdb and a private postmaster
+in a temporary directory (needs initdb/pg_ctl on the PATH and a non
+root user).
+'''
+from collections import namedtuple
+import contextlib
+import json
+import optparse
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import pgpartitionlib
+from pgpartitionlib import meta
+
+SIZES = [10 ** 2, 10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6]
+
+CHUNKERS = ['int', 'month', 'arbitrary']
+
+# (method, routing) - routing only for function_code
+METHODS = [('create_ddl', None), ('function_code', 'linear'),
+           ('function_code', 'tree'), ('function_code', 'arithmetic'),
+           ('create_idx_ddl', None)]
+
+# months from 0001-01 before datetime runs out of years
+MAX_MONTHS = 9998 * 12
+
+ROUTE_PARTITIONS = [10, 100, 1000]
+
+POSITIONS = ['first', 'middle', 'last']
+
+SCHEMA = 'pgpartition_bench'
+
+Generated = namedtuple('Generated', ['chunker', 'partitions', 'method',
+                                     'routing', 'seconds', 'bytes',
+                                     'peak_rss_kb'])
+
+Routed = namedtuple('Routed', ['partitions', 'routing', 'position', 'rows',
+                               'seconds', 'rows_per_second'])
+
+
+def partitioner(chunker, n, table_name='bench', **kw):
+    """
+    Partitioner with n partitions
+    >>> len(partitioner('month', 14).chunk_table())
+    14
+    >>> partitioner('arbitrary', 3).chunker.nums
+    [0, 3, 6, 9]
+    """
+    if chunker == 'int':
+        return pgpartitionlib.IntPartitioner(table_name, 'key', 0, n, **kw)
+    elif chunker == 'arbitrary':
+        return pgpartitionlib.ArbitraryIntPartitioner(
+            table_name, 'key', range(0, 3 * n + 1, 3), **kw)
+    elif chunker == 'month':
+        return pgpartitionlib.MonthPartitioner(
+            table_name, 'date', '0001-01',
+            '{0:04d}-{1:02d}'.format(1 + n // 12, 1 + n % 12), **kw)
+    raise ValueError('Unknown chunker {0!r}'.format(chunker))
+
+
+def skip_reason(chunker, n, method, routing):
+    if chunker == 'month' and n > MAX_MONTHS:
+        return 'more months than datetime has years for'
+    if chunker == 'arbitrary' and routing == 'arithmetic':
+        return 'no constant stride'
+    return None
+
+
+def iter_stmts(p, method, routing):
+    if method == 'create_ddl':
+        return p.iter_create_ddl()
+    elif method == 'function_code':
+        return p.iter_function_code(routing=routing)
+    elif method == 'create_idx_ddl':
+        return p.iter_create_idx_ddl()
+    raise ValueError('Unknown method {0!r}'.format(method))
+
+
+def run_case(chunker, n, method, routing):
+    """
+    Generate (and throw away) the sql of one case in this process,
+    returns a Generated
+    """
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.time()
+    size = 0
+    for stmt in iter_stmts(partitioner(chunker, n), method, routing):
+        size += len(stmt) + 1
+    seconds = time.time() - started
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return Generated(chunker, n, method, routing, seconds, size,
+                     peak - before)
+
+
+def bench_generators(sizes, chunkers, report=None):
+    """
+    Run each case in a fresh python, returns a list of Generated
+    """
+    results = []
+    for chunker in chunkers:
+        for n in sizes:
+            for method, routing in METHODS:
+                if skip_reason(chunker, n, method, routing):
+                    continue
+                out = subprocess.check_output(
+                    [sys.executable, os.path.abspath(__file__), '--case',
+                     chunker, str(n), method, routing or ''])
+                result = Generated(**json.loads(out))
+                results.append(result)
+                if report:
+                    report(result)
+    return results
+
+
+@contextlib.contextmanager
+def throwaway_postgres():
+    """
+    yield the dsn of a new cluster that is stopped and deleted afterwards
+    """
+    tmp = tempfile.mkdtemp(prefix='pgpartition_bench')
+    data = os.path.join(tmp, 'data')
+    devnull = open(os.devnull, 'w')
+    try:
+        subprocess.check_call(['initdb', '-D', data, '-A', 'trust', '-U',
+                               'postgres'], stdout=devnull)
+        subprocess.check_call(
+            ['pg_ctl', '-D', data, '-l', os.path.join(tmp, 'log'), '-w',
+             '-o', "-c listen_addresses='' -k {0} -c fsync=off".format(tmp),
+             'start'], stdout=devnull)
+        try:
+            yield 'host={0} user=postgres dbname=postgres'.format(tmp)
+        finally:
+            subprocess.call(['pg_ctl', '-D', data, '-m', 'immediate', '-w',
+                             'stop'], stdout=devnull)
+    finally:
+        devnull.close()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def position_value(p, position):
+    table = p.chunk_table()
+    i = {'first': 0, 'middle': len(table) // 2, 'last': len(table) - 1}[
+        position]
+    return table.starts[i]
+
+
+def bench_routing(dsn, partition_counts, rows=20000, report=None):
+    """
+    Insert rows through the trigger for each routing, with every row
+    going to the first, middle or last partition (linear routing tests
+    the chunks in order), returns a list of Routed
+    """
+    from pgpartitionlib import db
+    conn = db.connect(dsn, autocommit=True)
+    cur = conn.cursor()
+    results = []
+    try:
+        cur.execute('DROP SCHEMA IF EXISTS {0} CASCADE;'.format(SCHEMA))
+        cur.execute('CREATE SCHEMA {0};'.format(SCHEMA))
+        cur.execute('SET search_path = {0};'.format(SCHEMA))
+        for n in partition_counts:
+            p = partitioner('int', n, 'bench_route')
+            cur.execute(p.master_ddl('key INTEGER NOT NULL, junk INTEGER'))
+            cur.execute('\n'.join(p.iter_create_ddl()))
+            cur.execute(p.function_code())
+            cur.execute(p.trigger_code())
+            insert = ('INSERT INTO bench_route SELECT %s, g FROM '
+                      'generate_series(1, %s) g;')
+            for routing in pgpartitionlib.ROUTING_MODES:
+                cur.execute(p.function_code(routing=routing))
+                # the first insert compiles the function
+                cur.execute(insert, (position_value(p, 'first'), 100))
+                cur.execute('TRUNCATE bench_route;')
+                for position in POSITIONS:
+                    started = time.time()
+                    cur.execute(insert, (position_value(p, position), rows))
+                    seconds = time.time() - started
+                    result = Routed(n, routing, position, rows, seconds,
+                                    rows / seconds)
+                    results.append(result)
+                    if report:
+                        report(result)
+                    cur.execute('TRUNCATE bench_route;')
+            cur.execute('DROP TABLE bench_route CASCADE;')
+    finally:
+        cur.execute('DROP SCHEMA IF EXISTS {0} CASCADE;'.format(SCHEMA))
+        conn.close()
+    return results
+
+
+def case_key(result):
+    """
+    What a result is compared on between runs
+    """
+    return tuple(result[:-3]) if isinstance(result, Routed) else tuple(
+        result[:4])
+
+
+def compare(old, new, threshold=1.2):
+    """
+    yield (key, old seconds, new seconds, ratio, slower) for the cases in
+    both result files (as written by main)
+    >>> case = dict(chunker='int', partitions=100, method='create_ddl',
+    ...             routing=None, bytes=9, peak_rss_kb=0)
+    >>> old = {'generated': [dict(case, seconds=0.1)]}
+    >>> new = {'generated': [dict(case, seconds=0.15)]}
+    >>> for row in compare(old, new):
+    ...     print row
+    (('int', 100, 'create_ddl', None), 0.1, 0.15, 1.5, True)
+    """
+    for kind, cls in (('generated', Generated), ('routing', Routed)):
+        before = dict((case_key(cls(**row)), cls(**row))
+                      for row in old.get(kind, []))
+        for row in new.get(kind, []):
+            result = cls(**row)
+            key = case_key(result)
+            if key not in before or not before[key].seconds:
+                continue
+            ratio = result.seconds / before[key].seconds
+            yield (key, before[key].seconds, result.seconds, round(ratio, 2),
+                   ratio > threshold)
+
+
+def format_result(result):
+    """
+    >>> print format_result(Generated('int', 1000, 'function_code', 'tree', 0.25, 70000, 1024))
+    int 1000 function_code tree: 0.250s, 70000 bytes, 1024 KB peak RSS
+    """
+    if isinstance(result, Routed):
+        return '{0} partitions {1} {2}: {3:.0f} rows/s'.format(
+            result.partitions, result.routing, result.position,
+            result.rows_per_second)
+    return '{0} {1} {2}{3}: {4:.3f}s, {5} bytes, {6} KB peak RSS'.format(
+        result.chunker, result.partitions, result.method,
+        ' ' + result.routing if result.routing else '', result.seconds,
+        result.bytes, result.peak_rss_kb)
+
+
+def _sizes(text):
+    return [int(float(num)) for num in text.split(',')]
+
+
+def main(prog_args):
+    parser = optparse.OptionParser(
+        usage='%prog [options]\n       %prog --compare OLD.json NEW.json',
+        description='Benchmark the sql generators and trigger routing')
+    parser.add_option('-o', '--output', help='write the results as JSON to this file')
+    parser.add_option('--sizes', default=','.join(str(n) for n in SIZES), help='partition counts to generate, defaults to 1e2 to 1e6')
+    parser.add_option('--chunkers', default=','.join(CHUNKERS), help='defaults to ' + ','.join(CHUNKERS))
+    parser.add_option('--no-generators', action='store_true', help='only run the routing benchmark')
+    parser.add_option('--dsn', help='benchmark routing rows through the trigger in this database')
+    parser.add_option('--throwaway', action='store_true', help='benchmark routing in a temporary cluster made with initdb')
+    parser.add_option('--route-partitions', default=','.join(str(n) for n in ROUTE_PARTITIONS), help='partition counts for the routing benchmark, defaults to 10,100,1000')
+    parser.add_option('--rows', type='int', default=20000, help='rows inserted per routing case, defaults to 20000')
+    parser.add_option('--compare', action='store_true', help='compare two result files, flagging cases over 1.2x slower')
+    parser.add_option('--case', action='store_true', help=optparse.SUPPRESS_HELP)
+
+    opt, args = parser.parse_args(prog_args[1:])
+    if opt.case:
+        chunker, n, method, routing = (args + [''])[:4]
+        json.dump(run_case(chunker, int(n), method, routing or None)._asdict(),
+                  sys.stdout)
+        return
+    if opt.compare:
+        if len(args) != 2:
+            parser.print_help()
+            return 1
+        old, new = [json.load(open(path)) for path in args]
+        slower = 0
+        for key, before, after, ratio, flag in compare(old, new):
+            slower += flag
+            print '{0}: {1:.3f}s -> {2:.3f}s ({3}x){4}'.format(
+                ' '.join(str(part) for part in key if part is not None),
+                before, after, ratio, ' SLOWER' if flag else '')
+        return 1 if slower else 0
+
+    def report(result):
+        sys.stderr.write(format_result(result) + '\n')
+    results = {'version': meta.__version__,
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'started': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    if not opt.no_generators:
+        results['generated'] = [result._asdict() for result in
+                                bench_generators(_sizes(opt.sizes),
+                                                 opt.chunkers.split(','),
+                                                 report)]
+    counts = _sizes(opt.route_partitions)
+    routed = None
+    if opt.throwaway:
+        with throwaway_postgres() as dsn:
+            routed = bench_routing(dsn, counts, opt.rows, report)
+    elif opt.dsn:
+        routed = bench_routing(opt.dsn, counts, opt.rows, report)
+    if routed is not None:
+        results['routing'] = [result._asdict() for result in routed]
+    if opt.output:
+        fout = open(opt.output, 'w')
+        try:
+            json.dump(results, fout, indent=1, sort_keys=True)
+        finally:
+            fout.close()
+    else:
+        json.dump(results, sys.stdout, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -69,6 +69,35 @@ CREATE TRIGGER insert_test_month_trigger
     BEFORE INSERT ON test_month
     FOR EACH ROW EXECUTE PROCEDURE test_month_insert_function();
 
+Binary search routing (a nested IF per halving of the chunks)
+
+>>> print p.function_code(routing='tree')
+CREATE OR REPLACE FUNCTION test_month_insert_function()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF NEW.date < '2012-02-01' THEN
+        IF ( NEW.date >= '2012-01-01' AND NEW.date < '2012-02-01' ) THEN
+            INSERT INTO test_month_2012-01 VALUES (NEW.*);
+            RETURN NULL;
+        END IF;
+    ELSE
+        IF NEW.date < '2012-03-01' THEN
+            IF ( NEW.date >= '2012-02-01' AND NEW.date < '2012-03-01' ) THEN
+                INSERT INTO test_month_2012-02 VALUES (NEW.*);
+                RETURN NULL;
+            END IF;
+        ELSE
+            IF ( NEW.date >= '2012-03-01' AND NEW.date < '2012-04-01' ) THEN
+                INSERT INTO test_month_2012-03 VALUES (NEW.*);
+                RETURN NULL;
+            END IF;
+        END IF;
+    END IF;
+    RAISE EXCEPTION 'date out of range.  Fix the test_month_insert_function() function!';
+END;
+$$
+LANGUAGE plpgsql;
+
 Test Int-based partitioning
 >>> p = IntPartitioner('test_part', 'adweekid', 0, 2)
 
@@ -110,6 +139,146 @@ END;
 $$
 LANGUAGE plpgsql;
 
+Computing the partition from the value (the cost per row doesn't grow
+with the number of partitions)
+
+>>> print IntPartitioner('test_part', 'adweekid', 0, 100, 10).function_code(routing='arithmetic')
+CREATE OR REPLACE FUNCTION test_part_insert_function()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF ( NEW.adweekid >= 0 AND NEW.adweekid < 100 ) THEN
+        EXECUTE 'INSERT INTO test_part' || '_' || (NEW.adweekid - (NEW.adweekid - 0) % 10)::text || ' SELECT ($1).*' USING NEW;
+    ELSE
+        RAISE EXCEPTION 'adweekid out of range.  Fix the test_part_insert_function() function!';
+    END IF;
+    RETURN NULL;
+END;
+$$
+LANGUAGE plpgsql;
+
+Finer grained time partitions (hour, day, week and year with any stride)
+
+>>> print DayPartitioner('test_day', 'ts', '2012-02-28', '2012-03-02', stride=2).create_ddl()
+CREATE TABLE test_day_2012-02-28 (
+    CHECK ( ts >= '2012-02-28' AND ts < '2012-03-01' )
+) INHERITS (test_day);
+CREATE TABLE test_day_2012-03-01 (
+    CHECK ( ts >= '2012-03-01' AND ts < '2012-03-03' )
+) INHERITS (test_day);
+
+Hash partitioning (spreads increasing keys over every child)
+
+>>> h = HashPartitioner('test_hash', 'id', 3)
+>>> print h.create_ddl()
+CREATE TABLE test_hash_0 (
+    CHECK ( (hashtext(id::text) & 2147483647) % 3 = 0 )
+) INHERITS (test_hash);
+CREATE TABLE test_hash_1 (
+    CHECK ( (hashtext(id::text) & 2147483647) % 3 = 1 )
+) INHERITS (test_hash);
+CREATE TABLE test_hash_2 (
+    CHECK ( (hashtext(id::text) & 2147483647) % 3 = 2 )
+) INHERITS (test_hash);
+>>> print h.function_code()
+CREATE OR REPLACE FUNCTION test_hash_insert_function()
+RETURNS TRIGGER AS $$
+BEGIN
+    CASE (hashtext(NEW.id::text) & 2147483647) % 3
+    WHEN 0 THEN
+        INSERT INTO test_hash_0 VALUES (NEW.*);
+    WHEN 1 THEN
+        INSERT INTO test_hash_1 VALUES (NEW.*);
+    WHEN 2 THEN
+        INSERT INTO test_hash_2 VALUES (NEW.*);
+    ELSE
+        RAISE EXCEPTION 'id out of range.  Fix the test_hash_insert_function() function!';
+    END CASE;
+    RETURN NULL;
+END;
+$$
+LANGUAGE plpgsql;
+>>> [h.partition_for(i) for i in (1, 2, 3)]
+['test_hash_0', 'test_hash_1', 'test_hash_1']
+>>> h = HashPartitioner('test_hash', 'id', 2, declarative=True)
+>>> print h.master_ddl('id INTEGER NOT NULL')
+CREATE TABLE test_hash (
+    id INTEGER NOT NULL
+) PARTITION BY HASH (id);
+>>> print h.create_ddl()
+CREATE TABLE test_hash_0 PARTITION OF test_hash
+    FOR VALUES WITH (MODULUS 2, REMAINDER 0);
+CREATE TABLE test_hash_1 PARTITION OF test_hash
+    FOR VALUES WITH (MODULUS 2, REMAINDER 1);
+
+Sub-partitioning (each month split again by tenant id)
+
+>>> s = SubPartitioner(MonthPartitioner('orders', 'created', '2024-01', '2024-02'),
+...                    IntPartitioner('orders', 'tenant_id', 0, 200, 100))
+>>> print s.create_ddl()
+CREATE TABLE orders_2024-01 (
+    CHECK ( created >= '2024-01-01' AND created < '2024-02-01' )
+) INHERITS (orders);
+CREATE TABLE orders_2024-01_0 (
+    CHECK ( tenant_id >= 0 AND tenant_id < 100 )
+) INHERITS (orders_2024-01);
+CREATE TABLE orders_2024-01_100 (
+    CHECK ( tenant_id >= 100 AND tenant_id < 200 )
+) INHERITS (orders_2024-01);
+>>> print s.function_code()
+CREATE OR REPLACE FUNCTION orders_insert_function()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF ( NEW.created >= '2024-01-01' AND NEW.created < '2024-02-01' ) THEN
+        IF ( NEW.tenant_id >= 0 AND NEW.tenant_id < 100 ) THEN
+            INSERT INTO orders_2024-01_0 VALUES (NEW.*);
+            RETURN NULL;
+        ELSIF ( NEW.tenant_id >= 100 AND NEW.tenant_id < 200 ) THEN
+            INSERT INTO orders_2024-01_100 VALUES (NEW.*);
+            RETURN NULL;
+        END IF;
+    END IF;
+    RAISE EXCEPTION 'created, tenant_id out of range.  Fix the orders_insert_function() function!';
+END;
+$$
+LANGUAGE plpgsql;
+>>> print s.drop_ddl()
+DROP TABLE orders_2024-01_0;
+DROP TABLE orders_2024-01_100;
+DROP TABLE orders_2024-01;
+>>> s.partition_for('2024-01-15', 150)
+'orders_2024-01_100'
+
+Rows outside every partition
+----------------------------
+>>> o = IntPartitioner('test_ovf', 'key', 0, 20, 10, on_miss='overflow')
+>>> print o.overflow_ddl()
+CREATE TABLE test_ovf_overflow (
+    CHECK ( NOT ( key >= 0 AND key < 20 ) )
+) INHERITS (test_ovf);
+>>> print o.function_code() # doctest: +ELLIPSIS
+CREATE OR REPLACE FUNCTION test_ovf_insert_function()
+...
+    ELSE
+        INSERT INTO test_ovf_overflow VALUES (NEW.*);
+    END IF;
+...
+>>> print o.function_code(on_miss='create') # doctest: +ELLIPSIS
+CREATE OR REPLACE FUNCTION test_ovf_insert_function()
+...
+        DECLARE
+            child text := 'test_ovf' || '_' || (0 + floor((NEW.key - 0)::numeric / 10)::bigint * 10)::text;
+...
+                PERFORM pg_advisory_xact_lock(hashtext('test_ovf'));
+...
+>>> c = IntPartitioner('test_ovf', 'key', 0, 20, 10, on_miss='create',
+...     index_columns_list=[IndexSpec('key', where="tags <> '{}'")])
+>>> for routing in ROUTING_MODES:
+...     print [line.strip() for line in c.function_code(routing).splitlines()
+...            if 'INDEX' in line][0]
+EXECUTE format('CREATE INDEX %I ON %I (key) WHERE tags <> ''{}'';', child || '_0_index', child);
+EXECUTE format('CREATE INDEX %I ON %I (key) WHERE tags <> ''{}'';', child || '_0_index', child);
+EXECUTE format('CREATE INDEX %I ON %I (key) WHERE tags <> ''{}'';', child || '_0_index', child);
+
 INSERT TRIGGER
 ---------------
 >>> print p.trigger_code()
@@ -118,6 +287,61 @@ CREATE TRIGGER insert_test_part_trigger
     FOR EACH ROW EXECUTE PROCEDURE test_part_insert_function();
 
 
+Routing rows client side (to insert straight into the partitions)
+-----------------------------------------------------------------
+
+>>> p.partition_for(1)
+'test_part_1'
+>>> print p.partition_for(5)
+None
+>>> [int(i) for i in p.route_many([1, 0, 5, 1])]
+[1, 0, -1, 1]
+>>> groups = p.route_many([1, 0, 5, 1], group=True)
+>>> sorted((name, [int(pos) for pos in positions])
+...        for name, positions in groups.items())
+[(None, [2]), ('test_part_0', [1]), ('test_part_1', [0, 3])]
+>>> m = MonthPartitioner('test_month', 'date', '2012-01', '2012-04')
+>>> m.partition_for(dt.date(2012, 2, 29))
+'test_month_2012-02'
+>>> [int(i) for i in m.route_many([dt.date(2012, 3, 1), dt.datetime(2011, 12, 31, 23),
+...                                dt.datetime(2012, 1, 31, 23, 59)])]
+[2, -1, 0]
+
+Partition pruning (without relying on constraint_exclusion)
+-----------------------------------------------------------
+
+>>> m.prune(dt.date(2012, 2, 10), dt.date(2012, 3, 1))
+['test_month_2012-02']
+>>> m.prune(dt.date(2012, 2, 10), dt.date(2012, 3, 1), inclusive=True)
+['test_month_2012-02', 'test_month_2012-03']
+>>> m.prune(hi='2012-02-01')
+['test_month_2012-01']
+>>> print m.pruned_sql("""SELECT * FROM {table_name} WHERE date >= '2012-02-10'""", lo='2012-02-10')
+SELECT * FROM test_month_2012-02 WHERE date >= '2012-02-10'
+UNION ALL
+SELECT * FROM test_month_2012-03 WHERE date >= '2012-02-10';
+
+Declarative partitioning (Postgres 10+)
+---------------------------------------
+
+>>> p = IntPartitioner('test_part', 'adweekid', 0, 2, declarative=True)
+>>> print p.master_ddl('adweekid INTEGER NOT NULL')
+CREATE TABLE test_part (
+    adweekid INTEGER NOT NULL
+) PARTITION BY RANGE (adweekid);
+>>> print p.create_ddl()
+CREATE TABLE test_part_0 PARTITION OF test_part
+    FOR VALUES FROM (0) TO (1);
+CREATE TABLE test_part_1 PARTITION OF test_part
+    FOR VALUES FROM (1) TO (2);
+>>> print p.create_idx_ddl()
+CREATE INDEX test_part_0_index ON test_part (adweekid);
+>>> print p.function_code()
+Traceback (most recent call last):
+  ...
+ValueError: Declarative partitioning routes rows itself, there is no insert function
+>>> p = IntPartitioner('test_part', 'adweekid', 0, 2)
+
 DROP TRIGGER (Cannot CREATE OR REPLACE IT)
 --------------------------------------------
 
@@ -131,6 +355,24 @@ INDEX CREATION
 CREATE INDEX test_part_0_0_index ON test_part_0 (adweekid);
 CREATE INDEX test_part_1_0_index ON test_part_1 (adweekid);
 
+>>> print p.create_idx_ddl(concurrently=True)
+CREATE INDEX CONCURRENTLY test_part_0_0_index ON test_part_0 (adweekid);
+CREATE INDEX CONCURRENTLY test_part_1_0_index ON test_part_1 (adweekid);
+
+Other methods, INCLUDE columns, partial indexes and storage options are
+given with an IndexSpec (or a dict of its arguments)
+
+>>> p2 = IntPartitioner('test_part', 'adweekid', 0, 1, index_columns_list=[
+...     IndexSpec('adweekid', 'brin'),
+...     {'columns': ['site', 'adweekid'], 'include': 'clicks',
+...      'where': 'clicks > 0', 'tablespace': 'fast'}])
+>>> print p2.create_idx_ddl()
+CREATE INDEX test_part_0_0_index ON test_part_0 USING brin (adweekid);
+CREATE INDEX test_part_0_1_index ON test_part_0 (site,adweekid) INCLUDE (clicks) TABLESPACE fast WHERE clicks > 0;
+>>> print p2.drop_idx_ddl()
+DROP INDEX test_part_0_0_index;
+DROP INDEX test_part_0_1_index;
+
 INDEX DROPPING
 ---------------
 >>> print p.drop_idx_ddl()
@@ -146,12 +388,25 @@ VACUUM ANALYZE test_part_0;
 VACUUM ANALYZE test_part_1;
 
 '''
+import array
+import bisect
 from collections import namedtuple
+import copy
 import datetime as dt
+import itertools
 import optparse
+import random
+import re
+import string
+import struct
 import sys
 import time
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 import meta
 
 
@@ -171,13 +426,15 @@ def month_range(start, end, stride=1):
 
 
 def add_month(date, months=1):
-    month = date.month + months
-    if month > 12:
-        year = date.year + (months/12)+1
-        month = month % 12
-    else:
-        year = date.year
-    return dt.date(year, month, 1)
+    """
+    First of the month months after (or before if negative) date's
+    >>> add_month(dt.date(2012, 11, 5), 14)
+    datetime.date(2014, 1, 1)
+    >>> add_month(dt.date(2012, 1, 5), -1)
+    datetime.date(2011, 12, 1)
+    """
+    year, month = divmod(date.year * 12 + date.month - 1 + months, 12)
+    return dt.date(year, month + 1, 1)
 
 
 def month_chunk_str(start, end, stride=1, fmt="%Y-%m", out_fmt="%Y-%m-%d"):
@@ -205,22 +462,323 @@ def month_chunk(start, end, stride=1):
 # sql_* is for a what appears in the CHECK statement
 Chunk = namedtuple('Chunk', ['start', 'end', 'suffix', 'sql_start', 'sql_end'])
 
-class MonthChunker(object):
-    def __init__(self, start, end, fmt='%Y-%m'):
+# a date or timestamp as Postgres (or isoformat) writes it, any UTC
+# offset is matched but not captured
+TIMESTAMP_RE = re.compile(
+    r'(\d{4})-(\d{2})-(\d{2})(?:[ T](\d{2})(?::(\d{2})(?::(\d{2})'
+    r'(?:\.(\d+))?)?)?)?\s*(?:Z|[+-]\d{2}(?::?\d{2}){0,2})?$')
+
+
+class TimeChunker(object):
+    """
+    Base for chunkers over a date or timestamp column.  start and end
+    are strings in fmt (or date/datetime objects), end isn't included.
+    The chunk boundaries come from date arithmetic, subclasses supply
+    floor (start of the unit holding a datetime), step (move a
+    datetime n units, callable on the class) and the suffix format.
+    """
+    # for vectorized routing with numpy
+    numpy_dtype = 'datetime64[s]'
+    fmt = '%Y-%m-%d'
+    # bounds are dates unless the unit is smaller than a day
+    has_time = False
+
+    def __init__(self, start, end, stride=1, fmt=None):
+        if stride < 1:
+            raise ValueError('stride must be at least 1')
         self.start = start
         self.end = end
-        self.fmt = fmt
+        self.stride = stride
+        if fmt:
+            self.fmt = fmt
+
+    def _parse(self, value):
+        """
+        A date alone is its midnight for units smaller than a day
+        >>> HourChunker('2012-01-01', '2012-01-02').first()
+        datetime.datetime(2012, 1, 1, 0, 0)
+        >>> HourChunker('2012-01-01 6am', '2012-01-02').first()
+        Traceback (most recent call last):
+          ...
+        ValueError: '2012-01-01 6am' is not %Y-%m-%d %H:%M or %Y-%m-%d
+        """
+        if isinstance(value, dt.datetime):
+            return value
+        if isinstance(value, dt.date):
+            return dt.datetime(value.year, value.month, value.day)
+        if not self.has_time:
+            return dt.datetime.strptime(value, self.fmt)
+        for fmt in (self.fmt, '%Y-%m-%d'):
+            try:
+                return dt.datetime.strptime(value, fmt)
+            except ValueError:
+                pass
+        raise ValueError('{0!r} is not {1} or %Y-%m-%d'.format(value,
+                                                               self.fmt))
+
+    def first(self):
+        return self.floor(self._parse(self.start))
+
+    def text(self, value):
+        if self.has_time:
+            return value.isoformat(' ')
+        return value.date().isoformat()
 
     def __iter__(self):
-        for item in month_chunk_str(self.start, self.end, fmt=self.fmt):
-            suffix = '_' + item[0][:-3]  # don't show day
-            sql_start = "'{0}'".format(item[0])
-            sql_end = "'{0}'".format(item[1])
-            yield Chunk(item[0], item[1], suffix, sql_start, sql_end)
+        # parse once and use date arithmetic rather than a strftime per chunk
+        start = self.first()
+        end = self._parse(self.end)
+        start_text = self.text(start)
+        while start < end:
+            next_start = self.step(start, self.stride)
+            end_text = self.text(next_start)
+            yield Chunk(start_text, end_text, self.suffix(start),
+                        "'{0}'".format(start_text), "'{0}'".format(end_text))
+            start, start_text = next_start, end_text
+
+    def cache_key(self):
+        return (self.start, self.end, self.stride, self.fmt)
+
+    def key(self, value):
+        """
+        Make value comparable with the chunk bounds (ISO date strings)
+        >>> MonthChunker('2012-01', '2012-04').key(dt.date(2012, 2, 3))
+        '2012-02-03'
+        >>> MonthChunker('2012-01', '2012-04').key('2012-02-01T00:00:00')
+        '2012-02-01'
+        >>> HourChunker('2012-01-01', '2012-01-02').key(dt.date(2012, 1, 1))
+        '2012-01-01 00:00:00'
+
+        A UTC offset (ie a timestamptz bound read from the catalog) is
+        dropped, the time is compared as it is written
+        >>> MonthChunker('2012-01', '2012-04').key('2012-02-01 00:00:00+00')
+        '2012-02-01'
+        >>> HourChunker('2012-01-01', '2012-01-02').key('2012-01-01 05:00:00-05:30')
+        '2012-01-01 05:00:00'
+        """
+        if isinstance(value, dt.datetime):
+            value = value.replace(tzinfo=None)
+        elif isinstance(value, dt.date):
+            value = dt.datetime(value.year, value.month, value.day)
+        else:
+            match = TIMESTAMP_RE.match(value.strip())
+            if not match:
+                raise ValueError('Not a date or timestamp: {0!r}'.format(
+                    value))
+            value = dt.datetime(*[int(part) for part in match.groups()[:6]
+                                  if part is not None])
+            if match.group(7):
+                value = value.replace(microsecond=int(
+                    match.group(7)[:6].ljust(6, '0')))
+        if not self.has_time and value.time() == dt.time(0):
+            # midnight is the date itself
+            return value.date().isoformat()
+        return value.isoformat(' ')
+
+
+class HourChunker(TimeChunker):
+    """
+    >>> list(HourChunker('2012-01-01 22:00', '2012-01-02 00:00', 1, '%Y-%m-%d %H:%M'))
+    [Chunk(start='2012-01-01 22:00:00', end='2012-01-01 23:00:00', suffix='_2012-01-01_22', sql_start="'2012-01-01 22:00:00'", sql_end="'2012-01-01 23:00:00'"), Chunk(start='2012-01-01 23:00:00', end='2012-01-02 00:00:00', suffix='_2012-01-01_23', sql_start="'2012-01-01 23:00:00'", sql_end="'2012-01-02 00:00:00'")]
+    """
+    fmt = '%Y-%m-%d %H:%M'
+    has_time = True
+
+    @staticmethod
+    def floor(value):
+        return value.replace(minute=0, second=0, microsecond=0)
+
+    @staticmethod
+    def step(value, n):
+        return value + dt.timedelta(hours=n)
+
+    def suffix(self, value):
+        return '_{0}_{1:02d}'.format(value.date().isoformat(), value.hour)
+
+    def suffix_sql(self, value):
+        """
+        >>> print HourChunker('2012-01-01 00:00', '2012-01-02 00:00', 6).suffix_sql('NEW.ts')
+        '_' || to_char(TIMESTAMP '2012-01-01 00:00:00' + floor(extract(epoch FROM NEW.ts::timestamp - TIMESTAMP '2012-01-01 00:00:00') / 21600)::int * interval '21600 seconds', 'YYYY-MM-DD_HH24')
+        """
+        if self.stride == 1:
+            return "'_' || to_char({0}, 'YYYY-MM-DD_HH24')".format(value)
+        return ("'_' || to_char(TIMESTAMP '{1}' + floor(extract(epoch FROM "
+                "{0}::timestamp - TIMESTAMP '{1}') / {2})::int * interval "
+                "'{2} seconds', 'YYYY-MM-DD_HH24')".format(
+                    value, self.text(self.first()), self.stride * 3600))
+
+    def bounds_sql(self, value):
+        """
+        sql expressions for the start, end and suffix of the chunk that
+        holds value (or would, if it is out of range)
+        """
+        seconds = self.stride * 3600
+        if self.stride == 1:
+            start = "date_trunc('hour', {0}::timestamp)".format(value)
+        else:
+            start = ("(TIMESTAMP '{1}' + floor(extract(epoch FROM "
+                     "{0}::timestamp - TIMESTAMP '{1}') / {2}) * interval "
+                     "'{2} seconds')".format(value, self.text(self.first()),
+                                             seconds))
+        return (start, "({0} + interval '{1} seconds')".format(start, seconds),
+                "'_' || to_char({0}, 'YYYY-MM-DD_HH24')".format(start))
+
+
+class DayChunker(TimeChunker):
+    """
+    >>> [c.suffix for c in DayChunker('2012-02-27', '2012-03-03', 2)]
+    ['_2012-02-27', '_2012-02-29', '_2012-03-02']
+    """
+    days = 1
+
+    @staticmethod
+    def floor(value):
+        return dt.datetime(value.year, value.month, value.day)
+
+    @classmethod
+    def step(cls, value, n):
+        return value + dt.timedelta(days=n * cls.days)
+
+    def suffix(self, value):
+        return '_' + value.date().isoformat()
+
+    def suffix_sql(self, value):
+        """
+        >>> print DayChunker('2012-01-01', '2012-02-01').suffix_sql('NEW.day')
+        '_' || to_char(NEW.day, 'YYYY-MM-DD')
+        >>> print WeekChunker('2012-01-01', '2012-02-01', 2).suffix_sql('NEW.day')
+        '_' || to_char(DATE '2011-12-26' + (NEW.day::date - DATE '2011-12-26') / 14 * 14, 'YYYY-MM-DD')
+        """
+        days = self.stride * self.days
+        if days == 1:
+            return "'_' || to_char({0}, 'YYYY-MM-DD')".format(value)
+        return ("'_' || to_char(DATE '{1}' + ({0}::date - DATE '{1}') / {2} "
+                "* {2}, 'YYYY-MM-DD')".format(
+                    value, self.text(self.first()), days))
+
+    def bounds_sql(self, value):
+        days = self.stride * self.days
+        if days == 1:
+            start = '{0}::date'.format(value)
+        else:
+            start = ("(DATE '{1}' + floor(({0}::date - DATE '{1}')::numeric / "
+                     "{2})::int * {2})".format(value, self.text(self.first()),
+                                               days))
+        return (start, '({0} + {1})'.format(start, days),
+                "'_' || to_char({0}, 'YYYY-MM-DD')".format(start))
+
+
+class WeekChunker(DayChunker):
+    """
+    Weeks start on Monday (like date_trunc('week', ...))
+    >>> [c.suffix for c in WeekChunker('2012-01-04', '2012-01-17')]
+    ['_2012-01-02', '_2012-01-09', '_2012-01-16']
+    """
+    days = 7
+
+    @staticmethod
+    def floor(value):
+        value = DayChunker.floor(value)
+        return value - dt.timedelta(days=value.weekday())
+
+
+class MonthChunker(TimeChunker):
+    """
+    >>> [c.suffix for c in MonthChunker('2012-11', '2013-05', stride=3)]
+    ['_2012-11', '_2013-02']
+    """
+    fmt = '%Y-%m'
+
+    def __init__(self, start, end, fmt='%Y-%m', stride=1):
+        super(MonthChunker, self).__init__(start, end, stride, fmt)
+
+    @staticmethod
+    def floor(value):
+        return dt.datetime(value.year, value.month, 1)
+
+    @staticmethod
+    def step(value, n):
+        date = add_month(value, n)
+        return dt.datetime(date.year, date.month, 1)
+
+    def suffix(self, value):
+        return '_' + value.date().isoformat()[:-3]  # don't show day
+
+    def suffix_sql(self, value):
+        """
+        sql expression for the suffix of the chunk holding value
+        >>> print MonthChunker('2012-01', '2012-04').suffix_sql('NEW.date')
+        '_' || to_char(NEW.date, 'YYYY-MM')
+        >>> print MonthChunker('2012-01', '2012-04', stride=3).suffix_sql('NEW.date')
+        '_' || to_char(DATE '2012-01-01' + (extract(year FROM NEW.date)::int * 12 + extract(month FROM NEW.date)::int - 24145) / 3 * 3 * interval '1 month', 'YYYY-MM')
+        """
+        if self.stride == 1:
+            return "'_' || to_char({0}, 'YYYY-MM')".format(value)
+        first = self.first()
+        return ("'_' || to_char(DATE '{1}' + (extract(year FROM {0})::int * 12"
+                " + extract(month FROM {0})::int - {2}) / {3} * {3} * "
+                "interval '1 month', 'YYYY-MM')".format(
+                    value, self.text(first), first.year * 12 + first.month,
+                    self.stride))
+
+    def bounds_sql(self, value):
+        if self.stride == 1:
+            start = "date_trunc('month', {0})::date".format(value)
+        else:
+            first = self.first()
+            start = ("(DATE '{1}' + floor((extract(year FROM {0})::int * 12 + "
+                     "extract(month FROM {0})::int - {2})::numeric / {3})::int"
+                     " * {3} * interval '1 month')::date".format(
+                         value, self.text(first),
+                         first.year * 12 + first.month, self.stride))
+        return (start, "({0} + interval '{1} month')::date".format(
+                    start, self.stride),
+                "'_' || to_char({0}, 'YYYY-MM')".format(start))
+
+
+class YearChunker(TimeChunker):
+    """
+    >>> [c.suffix for c in YearChunker('2010', '2015', 2)]
+    ['_2010', '_2012', '_2014']
+    """
+    fmt = '%Y'
+
+    @staticmethod
+    def floor(value):
+        return dt.datetime(value.year, 1, 1)
+
+    @staticmethod
+    def step(value, n):
+        return dt.datetime(value.year + n, 1, 1)
+
+    def suffix(self, value):
+        return '_{0}'.format(value.year)
+
+    def suffix_sql(self, value):
+        """
+        >>> print YearChunker('2010', '2015', 2).suffix_sql('NEW.ts')
+        '_' || (2010 + (extract(year FROM NEW.ts)::int - 2010) / 2 * 2)::text
+        """
+        if self.stride == 1:
+            return "'_' || to_char({0}, 'YYYY')".format(value)
+        year = self.first().year
+        return ("'_' || ({1} + (extract(year FROM {0})::int - {1}) / {2} * "
+                "{2})::text".format(value, year, self.stride))
+
+    def bounds_sql(self, value):
+        year = self.first().year
+        start = ("make_date({1} + floor((extract(year FROM {0})::int - {1})"
+                 "::numeric / {2})::int * {2}, 1, 1)".format(value, year,
+                                                             self.stride))
+        return (start, "({0} + interval '{1} year')::date".format(
+                    start, self.stride),
+                "'_' || to_char({0}, 'YYYY')".format(start))
 
 
 class IntChunker(object):
     """ Should have a constant stride """
+    numpy_dtype = 'int64'
+
     def __init__(self, start, end, stride):
         self.start = start
         self.end = end
@@ -231,15 +789,64 @@ class IntChunker(object):
             suffix = '_{0}'.format(prev)
             yield Chunk(prev, num, suffix, prev, num)
 
+    def cache_key(self):
+        return (self.start, self.end, self.stride)
+
+    def key(self, value):
+        return int(value)
+
+    def suffix_sql(self, value):
+        """
+        sql expression for the suffix of the chunk holding value
+        >>> print IntChunker(1, 10, 3).suffix_sql('NEW.key')
+        '_' || (NEW.key - (NEW.key - 1) % 3)::text
+        """
+        return "'_' || ({0} - ({0} - {1}) % {2})::text".format(
+            value, self.start, self.stride)
+
+    def bounds_sql(self, value):
+        """
+        sql expressions for the start, end and suffix of the chunk that
+        holds value (or would, if it is out of range)
+        >>> print IntChunker(1, 10, 3).bounds_sql('NEW.key')[0]
+        (1 + floor((NEW.key - 1)::numeric / 3)::bigint * 3)
+        """
+        start = '({1} + floor(({0} - {1})::numeric / {2})::bigint * {2})'.format(
+            value, self.start, self.stride)
+        return (start, '({0} + {1})'.format(start, self.stride),
+                "'_' || {0}::text".format(start))
+
+
+# versions of chunk lists, so a cache_key is checked in constant time
+_versions = itertools.count()
+
 
 class ArbitraryIntChunker(object):
-    """Takes a list of start nums (end is < next num)
+    """Takes a list of start nums (end is < next num).  Assign a new
+    list to nums to change them (a cached ChunkTable won't see a change
+    made to the list in place).
     >>> list(ArbitraryIntChunker([1,32,60,91]))
     [Chunk(start=1, end=32, suffix='_1', sql_start=1, sql_end=32), Chunk(start=32, end=60, suffix='_32', sql_start=32, sql_end=60), Chunk(start=60, end=91, suffix='_60', sql_start=60, sql_end=91)]
+    >>> c = ArbitraryIntChunker([0, 10])
+    >>> key = c.cache_key()
+    >>> c.nums = [0, 10, 20]
+    >>> c.cache_key() == key
+    False
     """
+    numpy_dtype = 'int64'
+
     def __init__(self, nums):
         self.nums = nums
 
+    @property
+    def nums(self):
+        return self._nums
+
+    @nums.setter
+    def nums(self, nums):
+        self._nums = nums
+        self._version = next(_versions)
+
     def __iter__(self):
         prev = None
         for num in self.nums:
@@ -248,18 +855,752 @@ class ArbitraryIntChunker(object):
                 yield Chunk(prev, num, suffix, prev, num)
             prev = num
 
+    def cache_key(self):
+        return self._version
+
+    def key(self, value):
+        return int(value)
+
+
+class QuantileChunker(ArbitraryIntChunker):
+    """
+    Boundaries chosen from the data so each of n chunks gets roughly
+    the same number of rows (rather than the same width).  Build one
+    with from_sample (any iterable of values, only a fixed size random
+    sample is kept) or from_histogram/from_pg_stats (the statistics
+    ANALYZE keeps).  A value with more than its share of the rows gets
+    a chunk of its own, so the number of chunks can differ from n.
+
+    >>> QuantileChunker.from_sample(xrange(1000), 4).nums
+    [0, 250, 500, 750, 1000]
+    >>> skewed = [1] * 600 + range(2, 402)
+    >>> QuantileChunker.from_sample(skewed, 4).nums
+    [1, 2, 152, 402]
+    >>> QuantileChunker.from_histogram('{0,10,20,30,40,50,60,70,80}', 4).nums
+    [0, 20, 40, 60, 81]
+    >>> QuantileChunker.from_histogram('{10,20,30,40,50}', 4, '{0}', [0.5]).nums
+    [0, 10, 30, 51]
+    >>> QuantileChunker.from_histogram('{10,20,30,40,50}', 2, hi=1000).nums
+    [10, 30, 1001]
+    """
+    @classmethod
+    def from_sample(cls, values, n, sample_size=10000, seed=None):
+        sample = ReservoirSample(sample_size, seed)
+        for value in values:
+            sample.add(value)
+        if not sample.count:
+            raise ValueError('No values to take quantiles of')
+        counts = {}
+        for value in sample.items:
+            counts[value] = counts.get(value, 0) + 1
+        return cls(quantile_bounds(sorted(counts.items()), n, sample.min,
+                                   sample.max + 1))
+
+    @classmethod
+    def from_histogram(cls, histogram_bounds, n, most_common_vals=None,
+                       most_common_freqs=None, lo=None, hi=None):
+        """
+        Arguments are the columns of pg_stats, arrays either as text
+        ('{1,5,9}') or lists.  The most common values aren't in the
+        histogram, pass them (and their frequencies) when there are any.
+        The statistics come from a sample and can miss the smallest and
+        largest values, lo and hi widen the first and last chunks.
+        """
+        bounds = int_array(histogram_bounds)
+        common = int_array(most_common_vals)
+        freqs = most_common_freqs or []
+        if isinstance(freqs, basestring):
+            freqs = [float(f) for f in freqs.strip('{}').split(',')]
+        weights = dict(zip(common, freqs))
+        if len(bounds) > 1:
+            # the rest of the rows are spread evenly over the buckets
+            bucket = (1.0 - sum(freqs)) / (len(bounds) - 1)
+            for value in bounds[:-1]:
+                weights[value] = weights.get(value, 0) + bucket
+        elif not weights:
+            raise ValueError('Need a histogram or most common values')
+        values = bounds + common + [v for v in (lo, hi) if v is not None]
+        return cls(quantile_bounds(sorted(weights.items()), n, min(values),
+                                   max(values) + 1))
+
+    @classmethod
+    def from_pg_stats(cls, conn, table_name, column, n, lo=None, hi=None):
+        """
+        Use the statistics in pg_stats (run ANALYZE on table_name first)
+        """
+        cur = conn.cursor()
+        cur.execute("""SELECT histogram_bounds::text, most_common_vals::text,
+    most_common_freqs
+FROM pg_stats
+WHERE tablename = %s AND attname = %s;""", (table_name, column))
+        row = cur.fetchone()
+        if row is None or (row[0] is None and row[1] is None):
+            raise ValueError('No statistics for {0}.{1} in pg_stats, run '
+                             'ANALYZE {0}'.format(table_name, column))
+        return cls.from_histogram(row[0], n, row[1], row[2], lo, hi)
+
+
+def int_array(value):
+    """
+    >>> int_array('{1,5,9}')
+    [1, 5, 9]
+    >>> int_array(None)
+    []
+    """
+    if not value:
+        return []
+    if isinstance(value, basestring):
+        return [int(item) for item in value.strip('{}').split(',')]
+    return list(value)
+
+
+def quantile_bounds(points, n, start, end):
+    """
+    Boundaries splitting points, sorted (value, weight) pairs, into
+    about n chunks of equal weight.  A value weighing more than a
+    chunk's share ends the chunk it starts.  start and end are the
+    first and last (not included) boundaries.
+    """
+    share = float(sum(weight for value, weight in points)) / n
+    bounds = [min(start, points[0][0])]
+    cum = 0.0
+    target = share
+    for i, (value, weight) in enumerate(points):
+        if i and (cum >= target or weight >= share) and value > bounds[-1]:
+            bounds.append(value)
+            target = (int(cum / share) + 1) * share
+        cum += weight
+        if weight >= share and i + 1 < len(points):
+            bounds.append(points[i + 1][0])
+            target = (int(cum / share) + 1) * share
+    return boundaries(bounds + [max(end, points[-1][0] + 1)])
+
+
+class ReservoirSample(object):
+    """
+    Uniform random sample of at most size items from a stream of any
+    length (plus its exact count, min and max)
+    >>> sample = ReservoirSample(10, seed=1)
+    >>> for i in xrange(1000):
+    ...     sample.add(i)
+    >>> len(sample.items), sample.count, sample.min, sample.max
+    (10, 1000, 0, 999)
+    """
+    def __init__(self, size, seed=None):
+        self.size = size
+        self.items = []
+        self.count = 0
+        self.min = self.max = None
+        self.random = random.Random(seed)
+
+    def add(self, value):
+        self.count += 1
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if len(self.items) < self.size:
+            self.items.append(value)
+        else:
+            i = self.random.randrange(self.count)
+            if i < self.size:
+                self.items[i] = value
+
+
+def boundaries(values):
+    """
+    Sorted values without repeats
+    >>> boundaries([1, 1, 5, 3, 5])
+    [1, 3, 5]
+    """
+    return sorted(set(values))
+
+
+def _rot(x, k):
+    return ((x << k) | (x >> (32 - k))) & 0xffffffff
+
+
+def _mix(a, b, c):
+    m = 0xffffffff
+    a = ((a - c) & m) ^ _rot(c, 4); c = (c + b) & m
+    b = ((b - a) & m) ^ _rot(a, 6); a = (a + c) & m
+    c = ((c - b) & m) ^ _rot(b, 8); b = (b + a) & m
+    a = ((a - c) & m) ^ _rot(c, 16); c = (c + b) & m
+    b = ((b - a) & m) ^ _rot(a, 19); a = (a + c) & m
+    c = ((c - b) & m) ^ _rot(b, 4); b = (b + a) & m
+    return a, b, c
+
+
+def _final(a, b, c):
+    m = 0xffffffff
+    c ^= b; c = (c - _rot(b, 14)) & m
+    a ^= c; a = (a - _rot(c, 11)) & m
+    b ^= a; b = (b - _rot(a, 25)) & m
+    c ^= b; c = (c - _rot(b, 16)) & m
+    a ^= c; a = (a - _rot(c, 4)) & m
+    b ^= a; b = (b - _rot(a, 14)) & m
+    c ^= b; c = (c - _rot(b, 24)) & m
+    return c
+
+
+def hash_text(value):
+    """
+    Postgres' hashtext(value::text) (Bob Jenkins' hash, as computed by a
+    little-endian server) for a string, number or date
+    >>> hash_text('')
+    -1477818771
+    """
+    if isinstance(value, unicode):
+        data = value.encode('utf-8')
+    elif isinstance(value, str):
+        data = value
+    else:
+        data = str(value)
+    length = len(data)
+    a = b = c = (0x9e3779b9 + length + 3923095) & 0xffffffff
+    pos = 0
+    while length - pos >= 12:
+        x, y, z = struct.unpack_from('<3I', data, pos)
+        a, b, c = _mix((a + x) & 0xffffffff, (b + y) & 0xffffffff,
+                       (c + z) & 0xffffffff)
+        pos += 12
+    # the last bytes, the lowest byte of c is left for the length
+    tail = data[pos:] + '\0' * (11 - (length - pos))
+    x, y, z = struct.unpack('<3I', tail[:8] + '\0' + tail[8:])
+    c = _final((a + x) & 0xffffffff, (b + y) & 0xffffffff,
+               (c + z) & 0xffffffff)
+    return c - (1 << 32) if c & 0x80000000 else c
+
+
+class HashChunker(object):
+    """
+    modulus chunks, a value goes in the one numbered
+    hashtext(value::text) % modulus (sign bit masked off)
+    >>> list(HashChunker(2))
+    [Chunk(start=0, end=1, suffix='_0', sql_start=0, sql_end=1), Chunk(start=1, end=2, suffix='_1', sql_start=1, sql_end=2)]
+    >>> [HashChunker(4).key(value) for value in (1, 2, 3)]
+    [1, 2, 0]
+    >>> print HashChunker(4).hash_sql('NEW.id')
+    (hashtext(NEW.id::text) & 2147483647) % 4
+    """
+    def __init__(self, modulus):
+        if modulus < 1:
+            raise ValueError('Need at least one hash partition')
+        self.modulus = modulus
+
+    def __iter__(self):
+        for remainder in xrange(self.modulus):
+            yield Chunk(remainder, remainder + 1, '_{0}'.format(remainder),
+                        remainder, remainder + 1)
+
+    def cache_key(self):
+        return (self.modulus,)
+
+    def key(self, value):
+        return (hash_text(value) & 0x7fffffff) % self.modulus
+
+    def hash_sql(self, value):
+        # masking rather than abs(), which overflows on -2147483648
+        return '(hashtext({0}::text) & 2147483647) % {1}'.format(
+            value, self.modulus)
+
+    def suffix_sql(self, value):
+        return "'_' || ({0})::text".format(self.hash_sql(value))
+
+
+class ChunkList(object):
+    """
+    Chunker over a list of already computed chunks (ie a subset of
+    another chunker's), key and the other optional chunker methods
+    come from chunker
+    >>> chunks = list(IntChunker(0, 30, 10))
+    >>> list(ChunkList(chunks[1:], IntChunker(0, 30, 10)))
+    [Chunk(start=10, end=20, suffix='_10', sql_start=10, sql_end=20), Chunk(start=20, end=30, suffix='_20', sql_start=20, sql_end=30)]
+    """
+    def __init__(self, chunks, chunker):
+        self.chunker = chunker
+        self.chunks = chunks
+
+    @property
+    def chunks(self):
+        return self._chunks
+
+    @chunks.setter
+    def chunks(self, chunks):
+        self._chunks = list(chunks)
+        self._version = next(_versions)
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def __getattr__(self, name):
+        # the subset may not have a constant stride, so no suffix_sql
+        if name in ('suffix_sql', 'chunker') or name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.chunker, name)
+
+    def cache_key(self):
+        return self._version
+
+
+class ChunkTable(object):
+    """
+    The chunks of a chunker computed once and kept in parallel arrays
+    (integer bounds are stored in an array.array)
+
+    >>> table = ChunkTable(IntChunker(0, 30, 10), 'test_part')
+    >>> len(table)
+    3
+    >>> table.starts
+    array('l', [0, 10, 20])
+    >>> table.table_names
+    ['test_part_0', 'test_part_10', 'test_part_20']
+    >>> table[1]
+    Chunk(start=10, end=20, suffix='_10', sql_start=10, sql_end=20)
+    """
+    def __init__(self, chunks, table_name):
+        starts, ends, suffixes, sql_starts, sql_ends = [], [], [], [], []
+        for chunk in chunks:
+            starts.append(chunk.start)
+            ends.append(chunk.end)
+            suffixes.append(chunk.suffix)
+            sql_starts.append(chunk.sql_start)
+            sql_ends.append(chunk.sql_end)
+        self.starts = compact(starts)
+        self.ends = compact(ends)
+        # int chunkers use the same values in the CHECK, don't store twice
+        self.sql_starts = self.starts if sql_starts == starts else sql_starts
+        self.sql_ends = self.ends if sql_ends == ends else sql_ends
+        self.suffixes = suffixes
+        self.table_names = [table_name + suffix for suffix in suffixes]
+
+    def __len__(self):
+        return len(self.suffixes)
+
+    def __getitem__(self, i):
+        return Chunk(self.starts[i], self.ends[i], self.suffixes[i],
+                     self.sql_starts[i], self.sql_ends[i])
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def find(self, key):
+        """
+        Index of the chunk holding key (as returned by the chunker's
+        key method) or -1, a bisect on the chunk starts
+        >>> table = ChunkTable(ArbitraryIntChunker([1, 32, 60]), 't')
+        >>> [table.find(k) for k in (0, 1, 31, 32, 59, 60)]
+        [-1, 0, 0, 1, 1, -1]
+        """
+        i = bisect.bisect_right(self.starts, key) - 1
+        if i >= 0 and key < self.ends[i]:
+            return i
+        return -1
+
+    def numpy_bounds(self, dtype):
+        """
+        (starts, ends) as numpy arrays of dtype (computed once)
+        """
+        if getattr(self, '_numpy_bounds', (None,))[0] != dtype:
+            self._numpy_bounds = (dtype,
+                                  np.asarray(self.starts).astype(dtype),
+                                  np.asarray(self.ends).astype(dtype))
+        return self._numpy_bounds[1:]
+
+
+def compact(values):
+    """
+    Store a list of ints in an array (a list of anything else is
+    returned as is)
+    >>> compact([1, 2])
+    array('l', [1, 2])
+    >>> compact(['a', 'b'])
+    ['a', 'b']
+    """
+    if values and all(isinstance(v, (int, long)) for v in values):
+        try:
+            return array.array('l', values)
+        except OverflowError:
+            pass
+    return values
+
+
+# templates passed to sql() can be anything, so the cache is bounded
+_compiled_templates = {}
+COMPILED_TEMPLATES_MAX = 64
+
+def compile_template(template):
+    """
+    Split a str.format template into (literal, field_name) pairs once,
+    so it can be rendered for many chunks without parsing it again.
+    Returns None if the template uses conversions or format specs.
+    The cache is emptied once it holds COMPILED_TEMPLATES_MAX templates.
+    >>> compile_template('DROP TABLE {table_name};')
+    [('DROP TABLE ', 'table_name'), (';', None)]
+    """
+    try:
+        return _compiled_templates[template]
+    except KeyError:
+        pass
+    parts = []
+    for literal, field, spec, conversion in string.Formatter().parse(template):
+        if spec or conversion:
+            parts = None
+            break
+        parts.append((literal, field))
+    if len(_compiled_templates) >= COMPILED_TEMPLATES_MAX:
+        _compiled_templates.clear()
+    _compiled_templates[template] = parts
+    return parts
+
+
+def render(parts, values):
+    """
+    Fill in a compiled template, values must be strings
+    >>> render(compile_template('DROP TABLE {table_name};'), {'table_name': 't_1'})
+    'DROP TABLE t_1;'
+    """
+    return ''.join([literal if field is None else literal + values[field]
+                    for literal, field in parts])
+
+
+FUNCTION_START = """CREATE OR REPLACE FUNCTION {master_table_name}_insert_function()
+RETURNS TRIGGER AS $$
+BEGIN"""
+
+# how the insert function finds the child table for a row
+ROUTING_MODES = ('linear', 'tree', 'arithmetic')
+
+# what the insert function does with a row no child takes: raise an
+# error, put it in the overflow child or create the child it belongs in
+ON_MISS = ('raise', 'overflow', 'create')
+
+OVERFLOW_SUFFIX = '_overflow'
+
+INDEX_METHODS = ('btree', 'brin', 'hash')
+
+
+class IndexSpec(object):
+    """
+    An index created on every child
+
+    columns - list of columns (or expressions) indexed, or one as a string
+    method - one of INDEX_METHODS (brin is tiny and quick to build on
+      append only, naturally ordered columns like a timestamp)
+    include - non key columns stored in a btree index (Postgres 11+)
+    where - predicate making it a partial index
+    fillfactor - percent of each page filled (btree and hash)
+    pages_per_range - blocks summarized by each brin entry
+    tablespace - where the index is stored
+
+    >>> print IndexSpec('created', 'brin', pages_per_range=64).create_sql(
+    ...     't_0_0_index', 't_0')
+    CREATE INDEX t_0_0_index ON t_0 USING brin (created) WITH (pages_per_range = 64);
+    >>> print IndexSpec(['tenant_id', 'created'], include=['total'],
+    ...     where='NOT deleted', fillfactor=90, tablespace='fast').create_sql(
+    ...     't_0_1_index', 't_0', concurrently=True)
+    CREATE INDEX CONCURRENTLY t_0_1_index ON t_0 (tenant_id,created) INCLUDE (total) WITH (fillfactor = 90) TABLESPACE fast WHERE NOT deleted;
+    >>> IndexSpec('created', 'brin', include='total')
+    Traceback (most recent call last):
+      ...
+    ValueError: Only btree indexes can INCLUDE columns, not brin
+    """
+    def __init__(self, columns, method='btree', include=None, where=None,
+                 fillfactor=None, pages_per_range=None, tablespace=None):
+        if isinstance(columns, basestring):
+            columns = [columns]
+        if isinstance(include, basestring):
+            include = [include]
+        self.columns = list(columns)
+        self.method = method
+        self.include = list(include or [])
+        self.where = where
+        self.fillfactor = fillfactor
+        self.pages_per_range = pages_per_range
+        self.tablespace = tablespace
+        if method not in INDEX_METHODS:
+            raise ValueError('Unknown index method {0!r}, use one of {1}'.format(
+                method, ', '.join(INDEX_METHODS)))
+        if not self.columns:
+            raise ValueError('An index needs at least one column')
+        if method == 'hash' and len(self.columns) > 1:
+            raise ValueError('hash indexes have one column, not {0}'.format(
+                ','.join(self.columns)))
+        if self.include and method != 'btree':
+            raise ValueError('Only btree indexes can INCLUDE columns, '
+                             'not {0}'.format(method))
+        if fillfactor is not None and method == 'brin':
+            raise ValueError('brin indexes have no fillfactor, use '
+                             'pages_per_range')
+        if pages_per_range is not None and method != 'brin':
+            raise ValueError('pages_per_range is only for brin indexes')
+
+    def __repr__(self):
+        return 'IndexSpec({0!r}, {1!r})'.format(self.columns, self.method)
+
+    def columns_sql(self):
+        return ','.join(self.columns)
+
+    def create_sql(self, index_name, table_name, concurrently=False):
+        parts = ['CREATE INDEX']
+        if concurrently:
+            parts.append('CONCURRENTLY')
+        parts.extend([index_name, 'ON', table_name])
+        if self.method != 'btree':
+            parts.append('USING ' + self.method)
+        parts.append('({0})'.format(self.columns_sql()))
+        if self.include:
+            parts.append('INCLUDE ({0})'.format(','.join(self.include)))
+        storage = [(name, value) for name, value in
+                   (('fillfactor', self.fillfactor),
+                    ('pages_per_range', self.pages_per_range))
+                   if value is not None]
+        if storage:
+            parts.append('WITH ({0})'.format(', '.join(
+                '{0} = {1}'.format(name, int(value))
+                for name, value in storage)))
+        if self.tablespace:
+            parts.append('TABLESPACE ' + self.tablespace)
+        if self.where:
+            parts.append('WHERE ' + self.where)
+        return ' '.join(parts) + ';'
+
+
+def index_spec(item):
+    """
+    IndexSpec for an item of index_columns_list: a column, a list of
+    columns, a dict of IndexSpec arguments or an IndexSpec
+    >>> index_spec({'columns': 'created', 'method': 'brin'})
+    IndexSpec(['created'], 'brin')
+    >>> index_spec(['tenant_id', 'created'])
+    IndexSpec(['tenant_id', 'created'], 'btree')
+    """
+    if isinstance(item, IndexSpec):
+        return item
+    if isinstance(item, dict):
+        try:
+            return IndexSpec(**dict((str(key), value)
+                                    for key, value in item.items()))
+        except TypeError, e:
+            raise ValueError('Bad index spec {0!r}: {1}'.format(item, e))
+    return IndexSpec(item)
+
 
 class RangePartitioner(object):
-    def __init__(self, chunker, table_name, column, index_columns_list=None):
+    """
+    strategy - PARTITION BY method of a declaratively partitioned master
+    index_columns_list - the indexes of each child, each a column, a
+      list of columns, a dict of IndexSpec arguments or an IndexSpec
+    declarative - use PARTITION BY RANGE/PARTITION OF (Postgres 10+)
+      rather than INHERITS and an insert trigger.  Indexes are then
+      created on the master table and there is no function or trigger.
+    cache_chunks - compute the chunks once into a ChunkTable shared by
+      all the sql methods (turn off to stream chunks straight from the
+      chunker when generating huge numbers of partitions)
+    on_miss - what the insert function does with a row outside every
+      chunk, one of ON_MISS (see iter_function_code)
+    """
+    strategy = 'RANGE'
+    # the rows of a child, a template like sql() takes
+    chunk_condition = '{column} >= {start} AND {column} < {end}'
+
+    def __init__(self, chunker, table_name, column, index_columns_list=None,
+                 routing='linear', declarative=False, cache_chunks=True,
+                 on_miss='raise'):
         self.chunker = chunker
         self.table_name = table_name
         self.column = column
         self.index_columns_list = index_columns_list
+        self.routing = routing
+        self.declarative = declarative
+        self.cache_chunks = cache_chunks
+        self.on_miss = on_miss
+        self._chunk_table = None
+        self._chunk_table_key = None
+
+    def chunk_table(self):
+        """
+        The ChunkTable for the chunker, only computed again when the
+        chunker (or its range) or the table name changes.  Chunkers
+        without a cache_key() method are never cached.
+        """
+        cache_key = getattr(self.chunker, 'cache_key', None)
+        key = (self.chunker, self.table_name,
+               cache_key() if cache_key else None)
+        if (self._chunk_table is None or cache_key is None or
+            key != self._chunk_table_key):
+            self._chunk_table = ChunkTable(self.chunker, self.table_name)
+            self._chunk_table_key = key
+        return self._chunk_table
+
+    def only(self, table_names):
+        """
+        Copy of the partitioner with just the children in table_names
+        (ie to create only missing partitions)
+        """
+        table_names = set(table_names)
+        table = self.chunk_table()
+        chunks = [table[i] for i, name in enumerate(table.table_names)
+                  if name in table_names]
+        p = copy.copy(self)
+        p.chunker = ChunkList(chunks, self.chunker)
+        p._chunk_table = None
+        return p
+
+    def _iter_chunks(self):
+        """
+        yield (is_last, sql_start, sql_end, table_name) for each chunk
+        from the chunk table (or straight from the chunker if
+        cache_chunks is off, to keep memory constant)
+        """
+        if self.cache_chunks:
+            table = self.chunk_table()
+            last = len(table) - 1
+            for i, table_name in enumerate(table.table_names):
+                yield (i == last, table.sql_starts[i], table.sql_ends[i],
+                       table_name)
+        else:
+            for chunk, is_last in mark_last(self.chunker):
+                yield (is_last, chunk.sql_start, chunk.sql_end,
+                       self.table_name + chunk.suffix)
 
-    def _sql_gen(self, template, start=None, end=None,
-                 first_item=None, middle_items=None, last_item=None,
-                 do_index=False):
+    def check_client_routing(self):
+        """
+        Raise ValueError if the children can't be found client side
+        (partition_for, route_many and the loader)
+        """
+
+    def partition_for(self, value):
+        """
+        Name of the child table value belongs in (None if it is outside
+        every chunk)
+        """
+        self.check_client_routing()
+        table = self.chunk_table()
+        i = table.find(self.chunker.key(value))
+        if i == -1:
+            return None
+        return table.table_names[i]
+
+    def route_many(self, values, group=False):
+        """
+        Chunk index for each of values (-1 if it is outside every chunk),
+        an ndarray when numpy is available (using searchsorted) else a
+        list.  With group=True return a dict mapping child table name
+        (None for the misses) to the positions of its values instead.
+        """
+        self.check_client_routing()
+        table = self.chunk_table()
+        dtype = getattr(self.chunker, 'numpy_dtype', None)
+        if np is not None and dtype is not None:
+            indexes = self._route_numpy(table, values, dtype)
+        else:
+            find = table.find
+            key = self.chunker.key
+            indexes = [find(key(value)) for value in values]
+        if not group:
+            return indexes
+        return self._group(table, indexes)
+
+    def _route_numpy(self, table, values, dtype):
+        starts, ends = table.numpy_bounds(dtype)
+        keys = np.asarray(values)
+        if keys.dtype != dtype:
+            keys = keys.astype(dtype)
+        indexes = np.searchsorted(starts, keys, side='right') - 1
+        found = indexes >= 0
+        found[found] = keys[found] < ends[indexes[found]]
+        indexes[~found] = -1
+        return indexes
+
+    def _group(self, table, indexes):
+        names = table.table_names
+        if np is not None and isinstance(indexes, np.ndarray):
+            order = np.argsort(indexes, kind='mergesort')
+            found, firsts = np.unique(indexes[order], return_index=True)
+            groups = np.split(order, firsts[1:])
+            return dict((names[i] if i != -1 else None, positions)
+                        for i, positions in zip(found, groups))
+        groups = {}
+        for pos, i in enumerate(indexes):
+            groups.setdefault(names[i] if i != -1 else None, []).append(pos)
+        return groups
+
+    def _prune_range(self, lo, hi, inclusive):
+        table = self.chunk_table()
+        key = self.chunker.key
+        first = 0
+        last = len(table)
+        if lo is not None:
+            first = bisect.bisect_right(table.ends, key(lo))
+        if hi is not None:
+            if inclusive:
+                last = bisect.bisect_right(table.starts, key(hi))
+            else:
+                last = bisect.bisect_left(table.starts, key(hi))
+        return table, first, max(first, last)
+
+    def prune(self, lo=None, hi=None, inclusive=False):
         """
+        Names of the child tables that can hold rows with
+        lo <= column < hi (column <= hi if inclusive), either bound can
+        be None for an open range
+        """
+        table, first, last = self._prune_range(lo, hi, inclusive)
+        return table.table_names[first:last]
+
+    def pruned_sql(self, sql, lo=None, hi=None, inclusive=False):
+        """
+        Render sql (a template like sql() takes, ie
+        'SELECT * FROM {table_name} WHERE ...') for only the children
+        prune() returns, joined with UNION ALL.  None if no child
+        overlaps the range.  An aggregate gives a row per child, wrap
+        the result to total them (ie 'SELECT sum(count) FROM (...) t').
+        """
+        table, first, last = self._prune_range(lo, hi, inclusive)
+        if first == last:
+            return None
+        sql = sql.rstrip().rstrip(';')
+        values = dict(column=self.column,
+                      master_table_name=self.table_name)
+        stmts = []
+        for i in xrange(first, last):
+            values['table_name'] = table.table_names[i]
+            values['start'] = table.sql_starts[i]
+            values['end'] = table.sql_ends[i]
+            stmts.append(sql.format(**values))
+        return '\nUNION ALL\n'.join(stmts) + ';'
+
+    def index_specs(self):
+        """
+        An IndexSpec for each index of a child (a btree on the column if
+        there is no index_columns_list)
+        """
+        return [index_spec(item)
+                for item in self.index_columns_list or [self.column]]
+
+    def _index_items(self, table_name, specs=None):
+        """
+        yield (index_name, IndexSpec) for each index on table_name
+        """
+        for j, spec in enumerate(specs or self.index_specs()):
+            yield '{0}_{1}_index'.format(table_name, j), spec
+
+    def _check_inherited(self, what):
+        if self.declarative:
+            raise ValueError('Declarative partitioning routes rows itself, '
+                             'there is no {0}'.format(what))
+
+    def _iter_sql(self, template, start=None, end=None,
+                  first_item=None, middle_items=None, last_item=None,
+                  do_index=False):
+        """
+        Generate sql statements one at a time.  With cache_chunks off
+        the chunks are not materialized either, so memory doesn't
+        depend on the number of partitions (with it on they are kept in
+        the chunk table, once per partitioner).
+
         The template can have the following replacement vars:
 
         master_table_name - name of table
@@ -276,114 +1617,817 @@ class RangePartitioner(object):
         index_cols - columns where index is placed
         """
         if start:
-            stmt = [start.format(master_table_name=self.table_name)]
-        else:
-            stmt = []
-        chunks = list(self.chunker)
+            yield start.format(master_table_name=self.table_name)
         if template:
-            cols = self.index_columns_list or [self.column]
-            for i, chunk in enumerate(chunks):
-                table_name = '{0}{1}'.format(self.table_name, chunk.suffix)
+            parts = compile_template(template)
+            values = dict(column=self.column,
+                          master_table_name=self.table_name)
+            specs = self.index_specs() if do_index else None
+            for i, (is_last, sql_start, sql_end, table_name) in enumerate(
+                    self._iter_chunks()):
                 if i == 0 and first_item:
                     pos_item = first_item
-                elif i == len(chunks)-1 and last_item:
+                elif is_last and last_item:
                     pos_item = last_item
                 else:
                     pos_item = middle_items
+                values['start'] = str(sql_start)
+                values['end'] = str(sql_end)
+                values['table_name'] = table_name
+                values['pos_item'] = str(pos_item)
                 if do_index:
-                    for j, col_list in enumerate(cols):
-                        index_name = '{0}_{1}_index'.format(table_name, j)
-                        col_str = ','.join(cols)
-                        stmt.append(template.format(**dict(
-                            column=self.column,
-                            start=chunk.sql_start,
-                            end=chunk.sql_end,
-                            master_table_name=self.table_name,
-                            table_name=table_name,
-                            pos_item=pos_item,
-                            index_name=index_name,
-                            index_cols=col_str
-                            )))
+                    items = self._index_items(table_name, specs)
                 else:
-                    stmt.append(template.format(**dict(
-                        column=self.column,
-                        start=chunk.sql_start,
-                        end=chunk.sql_end,
-                        master_table_name=self.table_name,
-                        table_name=table_name,
-                        pos_item=pos_item
-                        )))
+                    items = [(None, None)]
+                for index_name, spec in items:
+                    if do_index:
+                        values['index_name'] = index_name
+                        values['index_cols'] = spec.columns_sql()
+                    if parts is None:
+                        yield template.format(**values)
+                    else:
+                        yield render(parts, values)
         if end:
-            stmt.append(end.format(column=self.column,
-                master_table_name=self.table_name))
-        return '\n'.join(stmt)
+            yield end.format(column=self.column,
+                master_table_name=self.table_name)
+
+    def _sql_gen(self, *args, **kw):
+        return '\n'.join(self._iter_sql(*args, **kw))
 
     def create_language(self):
         return """CREATE LANGUAGE plpgsql;"""
 
+    def master_ddl(self, column_defs):
+        """
+        column_defs - sql for the columns of the master table
+        """
+        if self.declarative:
+            temp = """CREATE TABLE {master_table_name} (
+    {column_defs}
+) PARTITION BY {strategy} ({column});"""
+        else:
+            temp = """CREATE TABLE {master_table_name} (
+    {column_defs}
+);"""
+        return temp.format(master_table_name=self.table_name,
+                           column_defs=column_defs, column=self.column,
+                           strategy=self.strategy)
+
+    def iter_create_ddl(self):
+        if self.declarative:
+            temp = """CREATE TABLE {table_name} PARTITION OF {master_table_name}
+    FOR VALUES FROM ({start}) TO ({end});"""
+        else:
+            temp = """CREATE TABLE {table_name} (
+    CHECK ( %s )
+) INHERITS ({master_table_name});""" % self.chunk_condition
+        return self._iter_sql(temp)
+
     def create_ddl(self):
-        temp = """CREATE TABLE {table_name} (
-    CHECK ( {column} >= {start} AND {column} < {end} )
-) INHERITS ({master_table_name});"""
-        return self._sql_gen(temp)
+        return '\n'.join(self.iter_create_ddl())
+
+    def detach_ddl(self, table_name):
+        """
+        Stop table_name being a child of the master (the table is kept)
+        """
+        if self.declarative:
+            return 'ALTER TABLE {0} DETACH PARTITION {1};'.format(
+                self.table_name, table_name)
+        return 'ALTER TABLE {0} NO INHERIT {1};'.format(table_name,
+                                                        self.table_name)
+
+    def iter_drop_ddl(self):
+        return self._iter_sql("""DROP TABLE {table_name};""")
 
     def drop_ddl(self):
-        return self._sql_gen("""DROP TABLE {table_name};""")
+        return '\n'.join(self.iter_drop_ddl())
 
-    def function_code(self):
-        return self._sql_gen("""    {pos_item} ( NEW.{column} >= {start} AND NEW.{column} < {end} ) THEN
+    def iter_function_code(self, routing=None, on_miss=None):
+        """
+        routing - 'linear' tests each chunk in turn with IF/ELSIF,
+          'tree' does a binary search over the chunk boundaries with
+          nested IFs (O(log n) comparisons per row), 'arithmetic'
+          computes the suffix of the child table from the value and
+          inserts with EXECUTE (constant cost per row, only for chunkers
+          with a constant stride).  Defaults to the routing given to the
+          constructor.
+        on_miss - for a row outside every chunk, 'raise' an exception
+          (failing the whole statement), insert it in the 'overflow'
+          child (see overflow_ddl) or 'create' the child it belongs in
+          (only for chunkers with a constant stride, an advisory lock
+          keeps concurrent inserts from creating it twice).  Defaults to
+          the on_miss given to the constructor.
+        """
+        self._check_inherited('insert function')
+        routing = routing or self.routing
+        on_miss = on_miss or self.on_miss
+        if routing == 'tree':
+            return self._iter_tree_function_code(on_miss)
+        elif routing == 'arithmetic':
+            return iter([self._arithmetic_function_code(on_miss)])
+        elif routing != 'linear':
+            raise ValueError('Unknown routing {0!r}, use one of {1}'.format(
+                routing, ', '.join(ROUTING_MODES)))
+        return self._iter_sql("""    {pos_item} ( NEW.{column} >= {start} AND NEW.{column} < {end} ) THEN
         INSERT INTO {table_name} VALUES (NEW.*);""",
-            start="""CREATE OR REPLACE FUNCTION {master_table_name}_insert_function()
-RETURNS TRIGGER AS $$
-BEGIN""",
+            start=FUNCTION_START,
             end="""    ELSE
-        RAISE EXCEPTION '{column} out of range.  Fix the {master_table_name}_insert_function() function!';
+%s
     END IF;
     RETURN NULL;
 END;
 $$
-LANGUAGE plpgsql;""",
+LANGUAGE plpgsql;""" % _escape_braces(self._miss_sql(on_miss, '        ')),
             first_item="IF",
             middle_items="ELSIF")
 
-        return self.create_integer_statements(*args, **kw)[2]
+    def function_code(self, routing=None, on_miss=None):
+        return '\n'.join(self.iter_function_code(routing, on_miss))
+
+    def _iter_tree_function_code(self, on_miss):
+        # the tree needs random access to the chunks
+        chunks = list(self.chunk_table())
+        yield FUNCTION_START.format(master_table_name=self.table_name)
+        if chunks:
+            for line in self._tree_lines(chunks, '    '):
+                yield line
+        yield self._miss_sql(on_miss, '    ')
+        if on_miss != 'raise':
+            yield '    RETURN NULL;'
+        yield """END;
+$$
+LANGUAGE plpgsql;"""
+
+    def _miss_sql(self, on_miss, indent):
+        """
+        plpgsql for a row outside every chunk
+        """
+        if on_miss == 'overflow':
+            return '{0}INSERT INTO {1} VALUES (NEW.*);'.format(
+                indent, self.overflow_table())
+        elif on_miss == 'create':
+            return '\n'.join(self._create_lines(indent))
+        elif on_miss != 'raise':
+            raise ValueError('Unknown on_miss {0!r}, use one of {1}'.format(
+                on_miss, ', '.join(ON_MISS)))
+        return ("{0}RAISE EXCEPTION '{1} out of range.  Fix the "
+                "{2}_insert_function() function!';".format(
+                    indent, self.column, self.table_name))
+
+    def _create_lines(self, indent):
+        bounds_sql = getattr(self.chunker, 'bounds_sql', None)
+        if bounds_sql is None or self.declarative:
+            raise ValueError('creating partitions on a miss needs inheritance '
+                             'and a chunker with a constant stride, not '
+                             '{0}'.format(type(self.chunker).__name__))
+        value = 'NEW.{0}'.format(self.column)
+        start, end, suffix = bounds_sql(value)
+        lines = [
+            '{0}IF {1} IS NULL THEN'.format(indent, value),
+            "{0}    RAISE EXCEPTION '{1} is NULL, no partition to create';".format(
+                indent, self.column),
+            '{0}END IF;'.format(indent),
+            '{0}DECLARE'.format(indent),
+            "{0}    child text := '{1}' || {2};".format(indent, self.table_name,
+                                                    suffix),
+            '{0}    lo text := {1};'.format(indent, start),
+            '{0}    hi text := {1};'.format(indent, end),
+            '{0}BEGIN'.format(indent),
+            '{0}    IF to_regclass(quote_ident(child)) IS NULL THEN'.format(indent),
+            # creating a child locks the master, so one lock per master
+            # (a lock per child could deadlock two inserts creating two
+            # children).  The lock doesn't refresh the catalog, so an
+            # insert that waited finds the child with duplicate_table.
+            "{0}        PERFORM pg_advisory_xact_lock(hashtext('{1}'));".format(
+                indent, self.table_name),
+            '{0}        BEGIN'.format(indent),
+            "{0}            EXECUTE format('CREATE TABLE %I (CHECK ( {1} >= %L "
+            "AND {1} < %L )) INHERITS ({2})', child, lo, hi);".format(
+                indent, self.column, self.table_name)]
+        for index_name, spec in self._index_items(''):
+            # the names go in as %I, the rest is quoted for format()
+            stmt = spec.create_sql('\x00', '\x01').replace(
+                '%', '%%').replace("'", "''").replace(
+                    '\x00', '%I').replace('\x01', '%I')
+            lines.append("{0}            EXECUTE format('{1}', child || '{2}', "
+                         "child);".format(indent, stmt, index_name))
+        lines.extend([
+            '{0}        EXCEPTION WHEN duplicate_table THEN'.format(indent),
+            '{0}            NULL;'.format(indent),
+            '{0}        END;'.format(indent),
+            '{0}    END IF;'.format(indent),
+            "{0}    EXECUTE 'INSERT INTO ' || quote_ident(child) || ' SELECT ($1).*' USING NEW;".format(
+                indent),
+            '{0}END;'.format(indent)])
+        return lines
+
+    def overflow_table(self):
+        return self.table_name + OVERFLOW_SUFFIX
+
+    def overflow_ddl(self):
+        """
+        Child taking the rows outside every chunk (when the function is
+        created with on_miss='overflow').  Its CHECK is that the row is
+        in no chunk, so queries on the chunks skip it.  A declarative
+        master gets a DEFAULT partition.
+        """
+        if self.declarative:
+            return 'CREATE TABLE {0} PARTITION OF {1} DEFAULT;'.format(
+                self.overflow_table(), self.table_name)
+        return """CREATE TABLE {0} (
+    CHECK ( NOT ( {1} ) )
+) INHERITS ({2});""".format(self.overflow_table(),
+                            self._covered_sql(self.column,
+                                              self.chunk_table()),
+                            self.table_name)
+
+    def drop_overflow_ddl(self):
+        return 'DROP TABLE {0};'.format(self.overflow_table())
+
+    def iter_overflow_idx_ddl(self, concurrently=False):
+        """
+        Indexes of the overflow child (a declarative one gets the
+        master's)
+        """
+        if self.declarative:
+            return
+        for table_name, index_name, stmt in self.iter_index_defs(
+                concurrently, [self.overflow_table()]):
+            yield stmt
+
+    def overflow_idx_ddl(self, concurrently=False):
+        return '\n'.join(self.iter_overflow_idx_ddl(concurrently))
+
+    def iter_drop_overflow_idx_ddl(self):
+        if self.declarative:
+            return
+        for table_name, index_name, stmt in self._iter_idx(
+                'DROP INDEX {index_name};', [self.overflow_table()]):
+            yield stmt
+
+    def drop_overflow_idx_ddl(self):
+        return '\n'.join(self.iter_drop_overflow_idx_ddl())
+
+    def _arithmetic_function_code(self, on_miss='raise'):
+        if not hasattr(self.chunker, 'suffix_sql'):
+            raise ValueError('arithmetic routing needs a chunker with a '
+                             'constant stride, not {0}'.format(
+                                 type(self.chunker).__name__))
+        chunks = self.chunk_table()
+        if not chunks:
+            raise ValueError('arithmetic routing needs at least one chunk')
+        value = 'NEW.{0}'.format(self.column)
+        return """{header}
+    IF ( {test} ) THEN
+        EXECUTE 'INSERT INTO {master_table_name}' || {suffix} || ' SELECT ($1).*' USING NEW;
+    ELSE
+{miss}
+    END IF;
+    RETURN NULL;
+END;
+$$
+LANGUAGE plpgsql;""".format(
+            header=FUNCTION_START.format(master_table_name=self.table_name),
+            test=self._covered_sql(value, chunks),
+            suffix=self.chunker.suffix_sql(value),
+            master_table_name=self.table_name,
+            miss=self._miss_sql(on_miss, '        '))
+
+    def _covered_sql(self, value, chunks):
+        """
+        sql test that value is in one of the chunks (which have no gaps)
+        """
+        return '{0} >= {1} AND {0} < {2}'.format(value, chunks[0].sql_start,
+                                                 chunks[-1].sql_end)
+
+    def _tree_lines(self, chunks, indent, leaf_lines=None):
+        """
+        Split the (sorted) chunks in half on the start of the middle
+        chunk until a single chunk is left, which checks both of its
+        bounds so gaps and out of range values fall through to the
+        RAISE at the end of the function.
+        """
+        leaf_lines = leaf_lines or insert_lines
+        if len(chunks) == 1:
+            chunk = chunks[0]
+            table_name = '{0}{1}'.format(self.table_name, chunk.suffix)
+            return (['{0}IF ( NEW.{1} >= {2} AND NEW.{1} < {3} ) THEN'.format(
+                         indent, self.column, chunk.sql_start, chunk.sql_end)] +
+                    leaf_lines(table_name, indent + '    ') +
+                    ['{0}END IF;'.format(indent)])
+        mid = len(chunks) // 2
+        lines = ['{0}IF NEW.{1} < {2} THEN'.format(
+            indent, self.column, chunks[mid].sql_start)]
+        lines.extend(self._tree_lines(chunks[:mid], indent + '    ',
+                                      leaf_lines))
+        lines.append('{0}ELSE'.format(indent))
+        lines.extend(self._tree_lines(chunks[mid:], indent + '    ',
+                                      leaf_lines))
+        lines.append('{0}END IF;'.format(indent))
+        return lines
+
+    def _route_lines(self, indent, leaf_lines):
+        """
+        plpgsql finding the chunk for NEW ('linear' or 'tree' routing),
+        leaf_lines(table_name, indent) are the lines run for it.  Rows in
+        no chunk fall through.
+        """
+        chunks = list(self.chunk_table())
+        if self.routing == 'tree':
+            return self._tree_lines(chunks, indent, leaf_lines) if chunks else []
+        elif self.routing != 'linear':
+            raise ValueError('{0} routing cannot be nested'.format(
+                self.routing))
+        lines = []
+        for i, chunk in enumerate(chunks):
+            lines.append('{0}{1} ( NEW.{2} >= {3} AND NEW.{2} < {4} ) THEN'.format(
+                indent, 'ELSIF' if i else 'IF', self.column, chunk.sql_start,
+                chunk.sql_end))
+            lines.extend(leaf_lines(self.table_name + chunk.suffix,
+                                    indent + '    '))
+        if chunks:
+            lines.append('{0}END IF;'.format(indent))
+        return lines
 
     def trigger_code(self):
+        self._check_inherited('insert trigger')
         return self._sql_gen(None, start="""CREATE TRIGGER insert_{master_table_name}_trigger
     BEFORE INSERT ON {master_table_name}
     FOR EACH ROW EXECUTE PROCEDURE {master_table_name}_insert_function();""")
 
     def drop_trigger_code(self):
+        self._check_inherited('insert trigger')
         return self._sql_gen(None, start="""DROP TRIGGER insert_{master_table_name}_trigger ON {master_table_name};""")
 
-    def create_idx_ddl(self, *args, **kw):
-        return self._sql_gen("""CREATE INDEX {index_name} ON {table_name} ({index_cols});""",
-                             do_index=True)
+    def iter_index_defs(self, concurrently=False, tables=None):
+        """
+        yield (table_name, index_name, create statement) for each index
+        of each child (of the master table if declarative) or of tables
+        """
+        if concurrently and self.declarative:
+            raise ValueError('Postgres cannot create indexes on a '
+                             'partitioned table CONCURRENTLY')
+        for table_name, index_name, spec in self._iter_index_specs(tables):
+            yield table_name, index_name, spec.create_sql(
+                index_name, table_name, concurrently)
+
+    def iter_create_idx_ddl(self, concurrently=False):
+        for table_name, index_name, stmt in self.iter_index_defs(concurrently):
+            yield stmt
+
+    def create_idx_ddl(self, concurrently=False):
+        return '\n'.join(self.iter_create_idx_ddl(concurrently))
+
+    def iter_drop_idx_ddl(self):
+        for table_name, index_name, stmt in self._iter_idx(
+                """DROP INDEX {index_name};"""):
+            yield stmt
 
     def drop_idx_ddl(self, *args, **kw):
-        return self._sql_gen("""DROP INDEX {index_name};""",
-                             do_index=True)
+        return '\n'.join(self.iter_drop_idx_ddl())
+
+    def _iter_index_specs(self, tables=None):
+        """
+        yield (table_name, index_name, IndexSpec) for each index of each
+        child or of tables.  Indexes on a declaratively partitioned
+        master are created on every partition by Postgres.
+        """
+        if tables is None and self.declarative:
+            tables = [self.table_name]
+        elif tables is None:
+            tables = (table_name for is_last, sql_start, sql_end, table_name
+                      in self._iter_chunks())
+        specs = self.index_specs()
+        for table_name in tables:
+            for index_name, spec in self._index_items(table_name, specs):
+                yield table_name, index_name, spec
+
+    def _iter_idx(self, template, tables=None):
+        for table_name, index_name, spec in self._iter_index_specs(tables):
+            yield table_name, index_name, template.format(
+                index_name=index_name, table_name=table_name,
+                index_cols=spec.columns_sql())
+
+    def iter_sql(self, sql, start=None, end=None):
+        return self._iter_sql(sql, start=start, end=end)
 
     def sql(self, sql, start=None, end=None):
-        return self._sql_gen(sql, start=start, end=end)
+        return '\n'.join(self.iter_sql(sql, start=start, end=end))
+
+    def split(self, table_name, at):
+        """
+        Plan splitting the (integer) child table_name at the values in
+        at, see pgpartitionlib.rebalance
+        """
+        import rebalance
+        return rebalance.split(self, table_name, at)
+
+    def merge(self, table_names):
+        """
+        Plan merging neighbouring (integer) children into one, see
+        pgpartitionlib.rebalance
+        """
+        import rebalance
+        return rebalance.merge(self, table_names)
 
 
 class MonthPartitioner(RangePartitioner):
-    def __init__(self, table_name, column, start, end, fmt="%Y-%m"):
-        chunker = MonthChunker(start, end, fmt)
-        super(MonthPartitioner, self).__init__(chunker, table_name, column)
+    def __init__(self, table_name, column, start, end, fmt="%Y-%m",
+                 stride=1, **kw):
+        chunker = MonthChunker(start, end, fmt, stride)
+        super(MonthPartitioner, self).__init__(chunker, table_name, column,
+                                               **kw)
+
+
+class HourPartitioner(RangePartitioner):
+    def __init__(self, table_name, column, start, end, stride=1, fmt=None,
+                 **kw):
+        chunker = HourChunker(start, end, stride, fmt)
+        super(HourPartitioner, self).__init__(chunker, table_name, column,
+                                              **kw)
+
+
+class DayPartitioner(RangePartitioner):
+    def __init__(self, table_name, column, start, end, stride=1, fmt=None,
+                 **kw):
+        chunker = DayChunker(start, end, stride, fmt)
+        super(DayPartitioner, self).__init__(chunker, table_name, column,
+                                             **kw)
+
+
+class WeekPartitioner(RangePartitioner):
+    def __init__(self, table_name, column, start, end, stride=1, fmt=None,
+                 **kw):
+        chunker = WeekChunker(start, end, stride, fmt)
+        super(WeekPartitioner, self).__init__(chunker, table_name, column,
+                                              **kw)
+
+
+class YearPartitioner(RangePartitioner):
+    def __init__(self, table_name, column, start, end, stride=1, fmt=None,
+                 **kw):
+        chunker = YearChunker(start, end, stride, fmt)
+        super(YearPartitioner, self).__init__(chunker, table_name, column,
+                                              **kw)
+
+
+class HashPartitioner(RangePartitioner):
+    """
+    modulus children with rows spread over them by a hash of column, so
+    ever increasing keys don't all go to (and contend on) the newest
+    child and its indexes.
+
+    Inherited children CHECK the hash of the value, declarative ones
+    are FOR VALUES WITH (MODULUS, REMAINDER).  Postgres hashes
+    declarative partitions with its own per type hash functions, so only
+    inherited children can be found client side (partition_for,
+    route_many and the loader).  The insert function computes the hash
+    once, then picks the child with a CASE ('linear' and 'tree' routing)
+    or builds its name ('arithmetic').
+    """
+    strategy = 'HASH'
+
+    def __init__(self, table_name, column, modulus, **kw):
+        chunker = HashChunker(modulus)
+        super(HashPartitioner, self).__init__(chunker, table_name, column,
+                                              **kw)
+        self.chunk_condition = chunker.hash_sql('{column}') + ' = {start}'
+
+    def check_client_routing(self):
+        if self.declarative:
+            raise ValueError('Postgres picks declarative hash partitions with '
+                             'its own hash functions, insert into {0}'.format(
+                                 self.table_name))
+
+    def _prune_range(self, lo, hi, inclusive):
+        raise ValueError('Hash partitions have no ranges to prune, '
+                         'partition_for finds the one holding a value')
+
+    def iter_create_ddl(self):
+        if not self.declarative:
+            return super(HashPartitioner, self).iter_create_ddl()
+        return self._iter_sql("""CREATE TABLE {table_name} PARTITION OF {master_table_name}
+    FOR VALUES WITH (MODULUS %d, REMAINDER {start});""" % self.chunker.modulus)
+
+    def overflow_ddl(self):
+        """
+        Every hash has a child, only NULLs overflow
+        """
+        if self.declarative:
+            raise ValueError('Hash partitioned tables have no default '
+                             'partition, Postgres routes NULLs to remainder 0')
+        return super(HashPartitioner, self).overflow_ddl()
+
+    def iter_function_code(self, routing=None, on_miss=None):
+        self._check_inherited('insert function')
+        routing = routing or self.routing
+        on_miss = on_miss or self.on_miss
+        if routing == 'arithmetic':
+            return iter([self._arithmetic_function_code(on_miss)])
+        elif routing not in ROUTING_MODES:
+            raise ValueError('Unknown routing {0!r}, use one of {1}'.format(
+                routing, ', '.join(ROUTING_MODES)))
+        return self._iter_sql("""    WHEN {start} THEN
+        INSERT INTO {table_name} VALUES (NEW.*);""",
+            start=FUNCTION_START + '\n    CASE ' + self.chunker.hash_sql(
+                'NEW.{0}'.format(self.column)),
+            end="""    ELSE
+%s
+    END CASE;
+    RETURN NULL;
+END;
+$$
+LANGUAGE plpgsql;""" % _escape_braces(self._miss_sql(on_miss, '        ')))
+
+    def _covered_sql(self, value, chunks):
+        return '{0} IS NOT NULL'.format(value)
+
+    def _route_lines(self, indent, leaf_lines):
+        lines = ['{0}CASE {1}'.format(indent, self.chunker.hash_sql(
+            'NEW.{0}'.format(self.column)))]
+        for chunk in self.chunk_table():
+            lines.append('{0}WHEN {1} THEN'.format(indent, chunk.sql_start))
+            lines.extend(leaf_lines(self.table_name + chunk.suffix,
+                                    indent + '    '))
+        lines.extend(['{0}ELSE'.format(indent),
+                      '{0}    NULL;'.format(indent),
+                      '{0}END CASE;'.format(indent)])
+        return lines
+
+
+class SubPartitioner(object):
+    """
+    Partition each child of outer again with inner (ie months, then
+    ranges of tenant ids).  The leaves are named by both suffixes
+    (orders_2024-01 + _0 -> orders_2024-01_0), each level CHECKs (or
+    declares) its own column and the insert function on the master
+    routes on both.  The table names of inner are not used.
+
+    Index, drop and sql() statements are for the leaves (indexes are
+    on the columns of inner, on the master if declarative).  {start},
+    {end} and {master_table_name} in a sql() template are the inner
+    bounds and the leaf's parent.
+    """
+    def __init__(self, outer, inner):
+        self.outer = outer
+        self.inner = inner
+        self.table_name = outer.table_name
+        self.column = outer.column
+        self.declarative = outer.declarative
+
+    def _parents(self):
+        for is_last, sql_start, sql_end, table_name in self.outer._iter_chunks():
+            yield table_name
+
+    def _inner(self, parent):
+        """
+        inner partitioning the outer child parent
+        """
+        p = copy.copy(self.inner)
+        p.table_name = parent
+        p.declarative = self.declarative
+        return p
+
+    def partition_for(self, outer_value, inner_value):
+        parent = self.outer.partition_for(outer_value)
+        leaf = self._inner(self.inner.table_name).partition_for(inner_value)
+        if parent is None or leaf is None:
+            return None
+        return parent + leaf[len(self.inner.table_name):]
+
+    def master_ddl(self, column_defs):
+        return self.outer.master_ddl(column_defs)
+
+    def iter_create_ddl(self):
+        for parent, stmt in zip(self._parents(), self.outer.iter_create_ddl()):
+            if self.declarative:
+                stmt = '{0}\n    PARTITION BY {1} ({2});'.format(
+                    stmt.rstrip(';'), self.inner.strategy, self.inner.column)
+            yield stmt
+            for stmt in self._inner(parent).iter_create_ddl():
+                yield stmt
+
+    def create_ddl(self):
+        return '\n'.join(self.iter_create_ddl())
+
+    def iter_drop_ddl(self):
+        for parent in self._parents():
+            for stmt in self._inner(parent).iter_drop_ddl():
+                yield stmt
+            yield 'DROP TABLE {0};'.format(parent)
+
+    def overflow_table(self):
+        return self.outer.overflow_table()
+
+    def overflow_ddl(self):
+        """
+        A row can miss on either column, so the overflow child has no
+        CHECK
+        """
+        if self.declarative:
+            return self.outer.overflow_ddl()
+        return 'CREATE TABLE {0} () INHERITS ({1});'.format(
+            self.overflow_table(), self.table_name)
+
+    def drop_overflow_ddl(self):
+        return self.outer.drop_overflow_ddl()
+
+    def iter_overflow_idx_ddl(self, concurrently=False):
+        return self._inner(self.table_name).iter_overflow_idx_ddl(concurrently)
+
+    def overflow_idx_ddl(self, concurrently=False):
+        return '\n'.join(self.iter_overflow_idx_ddl(concurrently))
+
+    def iter_drop_overflow_idx_ddl(self):
+        return self._inner(self.table_name).iter_drop_overflow_idx_ddl()
+
+    def drop_overflow_idx_ddl(self):
+        return '\n'.join(self.iter_drop_overflow_idx_ddl())
+
+    def drop_ddl(self):
+        return '\n'.join(self.iter_drop_ddl())
+
+    def iter_function_code(self, routing=None, on_miss=None):
+        """
+        Each level routes with its own routing ('linear' or 'tree'),
+        routing overrides the outer one.  on_miss is 'raise' or
+        'overflow' (into the overflow child of the master).
+        """
+        self.outer._check_inherited('insert function')
+        on_miss = on_miss or self.outer.on_miss
+        if on_miss not in ('raise', 'overflow'):
+            raise ValueError('Sub-partitions can only raise or overflow on a '
+                             'miss')
+        outer = copy.copy(self.outer)
+        outer.routing = routing or outer.routing
+
+        def parent_lines(parent, indent):
+            return self._inner(parent)._route_lines(indent, insert_lines)
+        yield FUNCTION_START.format(master_table_name=self.table_name)
+        for line in outer._route_lines('    ', parent_lines):
+            yield line
+        if on_miss == 'overflow':
+            yield self.outer._miss_sql(on_miss, '    ')
+            yield '    RETURN NULL;'
+        else:
+            yield ("    RAISE EXCEPTION '{0}, {1} out of range.  Fix the "
+                   "{2}_insert_function() function!';".format(
+                       self.outer.column, self.inner.column, self.table_name))
+        yield """END;
+$$
+LANGUAGE plpgsql;"""
+
+    def function_code(self, routing=None, on_miss=None):
+        return '\n'.join(self.iter_function_code(routing, on_miss))
+
+    def trigger_code(self):
+        return self.outer.trigger_code()
+
+    def drop_trigger_code(self):
+        return self.outer.drop_trigger_code()
+
+    def iter_index_defs(self, concurrently=False):
+        if self.declarative:
+            return self._inner(self.table_name).iter_index_defs(concurrently)
+        return (item for parent in self._parents()
+                for item in self._inner(parent).iter_index_defs(concurrently))
+
+    def iter_create_idx_ddl(self, concurrently=False):
+        for table_name, index_name, stmt in self.iter_index_defs(concurrently):
+            yield stmt
+
+    def create_idx_ddl(self, concurrently=False):
+        return '\n'.join(self.iter_create_idx_ddl(concurrently))
+
+    def iter_drop_idx_ddl(self):
+        if self.declarative:
+            return self._inner(self.table_name).iter_drop_idx_ddl()
+        return (stmt for parent in self._parents()
+                for stmt in self._inner(parent).iter_drop_idx_ddl())
+
+    def drop_idx_ddl(self):
+        return '\n'.join(self.iter_drop_idx_ddl())
+
+    def iter_sql(self, sql, start=None, end=None):
+        if start:
+            yield start.format(master_table_name=self.table_name)
+        for parent in self._parents():
+            for stmt in self._inner(parent).iter_sql(sql):
+                yield stmt
+        if end:
+            yield end.format(column=self.column,
+                             master_table_name=self.table_name)
+
+    def sql(self, sql, start=None, end=None):
+        return '\n'.join(self.iter_sql(sql, start=start, end=end))
+
+
+# time unit -> chunker
+TIME_CHUNKERS = {
+    'hour': HourChunker,
+    'day': DayChunker,
+    'week': WeekChunker,
+    'month': MonthChunker,
+    'year': YearChunker,
+    }
 
 
 class IntPartitioner(RangePartitioner):
-    def __init__(self, table_name, column, start, end, stride=1):
+    def __init__(self, table_name, column, start, end, stride=1, **kw):
         chunker = IntChunker(start, end, stride)
-        super(IntPartitioner, self).__init__(chunker, table_name, column)
+        super(IntPartitioner, self).__init__(chunker, table_name, column, **kw)
 
 
 class ArbitraryIntPartitioner(RangePartitioner):
-    def __init__(self, table_name, column, nums):
+    def __init__(self, table_name, column, nums, **kw):
         chunker = ArbitraryIntChunker(nums)
-        super(ArbitraryIntPartitioner, self).__init__(chunker, table_name, column)
+        super(ArbitraryIntPartitioner, self).__init__(chunker, table_name,
+                                                      column, **kw)
+
+
+# partitioner classes by the name used for them on the command line and
+# in manifests
+RANGE_TYPES = {
+    'int': IntPartitioner,
+    'hour': HourPartitioner,
+    'day': DayPartitioner,
+    'week': WeekPartitioner,
+    'month': MonthPartitioner,
+    'year': YearPartitioner,
+    }
+
+PARTITION_TYPES = sorted(RANGE_TYPES) + ['arbitrary', 'hash']
+
+
+def make_partitioner(kind, table_name, column, start=None, end=None,
+                     stride=1, bounds=None, modulus=None, **kw):
+    """
+    Partitioner of type kind (one of PARTITION_TYPES), start/end/stride
+    for the ranges, bounds for 'arbitrary', modulus for 'hash'
+    >>> list(make_partitioner('day', 't', 'ts', '2024-01-30',
+    ...                       '2024-02-01').iter_sql('{table_name}'))
+    ['t_2024-01-30', 't_2024-01-31']
+    >>> list(make_partitioner('arbitrary', 't', 'key',
+    ...                       bounds='0,10,50').iter_sql('{table_name}'))
+    ['t_0', 't_10']
+    """
+    if kind == 'hash':
+        if not modulus:
+            raise ValueError('hash partitions of {0} need a modulus'.format(
+                table_name))
+        return HashPartitioner(table_name, column, int(modulus), **kw)
+    elif kind == 'arbitrary':
+        if not bounds:
+            raise ValueError('arbitrary partitions of {0} need bounds'.format(
+                table_name))
+        if isinstance(bounds, basestring):
+            bounds = bounds.split(',')
+        return ArbitraryIntPartitioner(table_name, column,
+                                       [int(num) for num in bounds], **kw)
+    elif kind not in RANGE_TYPES:
+        raise ValueError('Unknown partition type {0!r}, use one of {1}'.format(
+            kind, ', '.join(PARTITION_TYPES)))
+    if start is None or end is None:
+        raise ValueError('{0} partitions of {1} need a start and end'.format(
+            kind, table_name))
+    if kind == 'int':
+        start, end = int(start), int(end)
+    else:
+        start, end = str(start), str(end)
+    return RANGE_TYPES[kind](table_name, column, start, end,
+                             stride=int(stride), **kw)
+
+
+def _escape_braces(text):
+    # for text put in a template that is formatted again
+    return text.replace('{', '{{').replace('}', '}}')
+
+
+def insert_lines(table_name, indent):
+    """
+    plpgsql inserting NEW into table_name
+    """
+    return ['{0}INSERT INTO {1} VALUES (NEW.*);'.format(indent, table_name),
+            '{0}RETURN NULL;'.format(indent)]
+
+
+def mark_last(items):
+    """
+    yield (item, is_last) pairs without materializing items
+    >>> list(mark_last('abc'))
+    [('a', False), ('b', False), ('c', True)]
+    >>> list(mark_last([]))
+    []
+    """
+    it = iter(items)
+    try:
+        prev = next(it)
+    except StopIteration:
+        return
+    for item in it:
+        yield prev, False
+        prev = item
+    yield prev, True
 
 
 def gen_chunks(start, end, stride):
@@ -402,28 +2446,180 @@ def gen_chunks(start, end, stride):
         yield num, num + stride
 
 
+def write_sql(out, stmts):
+    """
+    Write statements to a file object as they are generated
+    >>> write_sql(sys.stdout, iter(['SELECT 1;', 'SELECT 2;']))
+    SELECT 1;
+    SELECT 2;
+    """
+    for stmt in stmts:
+        out.write(stmt)
+        out.write('\n')
+
+
 def _test():
     import doctest
-    doctest.testmod()
+    import os
+    doctest.testmod(sys.modules[__name__])
+    for filename in sorted(os.listdir(os.path.dirname(__file__))):
+        name, ext = os.path.splitext(filename)
+        if ext == '.py' and name != '__init__':
+            doctest.testmod(__import__('pgpartitionlib.' + name,
+                                       fromlist=['__name__']))
 
 
-def main(prog_args):
-    parser = optparse.OptionParser(version=meta.__version__)
+def add_partitioner_options(parser):
     parser.add_option('-m', '--master-table', help='specify master table [REQ]')
     parser.add_option('-c', '--column', help='specify partitioning column (should be integer type) [REQ]')
     parser.add_option('--start', help='specify value for first partitioning column value [REQ]')
     parser.add_option('--end', help='specify value for final partitioning column value [REQ]')
     parser.add_option('--stride', default='1', help='specify stride (ie start:1, stride:2 1<= column < 3, 3<= col <5, etc) defaults to 1')
+    parser.add_option('--type', default='int', choices=sorted(RANGE_TYPES), help='what --start/--end/--stride count: int, hour, day, week, month or year (ie --type month --start 2024-01 --end 2025-01, --type hour takes YYYY-MM-DD HH:MM or a date), defaults to int')
+    parser.add_option('--bounds', help='partition boundaries (ie 0,100,150,200) instead of --start/--end/--stride')
+    parser.add_option('--hash', type='int', metavar='MODULUS', help='spread rows over MODULUS partitions by a hash of the column (instead of --start/--end)')
+
+
+def partitioner_from_options(opt, **kw):
+    """
+    Partitioner for the options added by add_partitioner_options (None
+    if a required option is missing)
+    """
+    if not opt.master_table or not opt.column:
+        return None
+    if opt.hash:
+        kind = 'hash'
+    elif opt.bounds:
+        kind = 'arbitrary'
+    elif not opt.start or not opt.end:
+        return None
+    else:
+        kind = opt.type
+    return make_partitioner(kind, opt.master_table, opt.column, opt.start,
+                            opt.end, opt.stride, bounds=opt.bounds,
+                            modulus=opt.hash, **kw)
+
+
+# what can be generated for a partitioner, in the order it is output
+ACTIONS = ('master', 'create', 'drop', 'function', 'trigger', 'drop_trigger',
+           'indexes', 'drop_indexes')
+
+# the main() option asking for each action
+ACTION_OPTIONS = {
+    'master': 'create_master_ddl',
+    'create': 'create_ddl',
+    'drop': 'drop_ddl',
+    'function': 'create_function',
+    'trigger': 'create_trigger',
+    'drop_trigger': 'drop_trigger',
+    'indexes': 'create_index_ddl',
+    'drop_indexes': 'drop_index_ddl',
+    }
+
+
+# phases whose items are the pieces of one statement, streamed when
+# written out and joined (by single_statements) when run
+SINGLE_STATEMENT_PHASES = ('function',)
+
+
+def iter_phases(p, actions, master_columns=None, concurrently=False):
+    """
+    yield (phase name, statements) for actions (in the order of ACTIONS
+    whatever their order in actions).  With on_miss='overflow' the
+    overflow child is created, dropped and indexed with the partitions.
+    The function phase streams iter_function_code, see
+    SINGLE_STATEMENT_PHASES.
+    master_columns - column definitions for the 'master' action
+    >>> p = IntPartitioner('test_part', 'key', 0, 2)
+    >>> for name, stmts in iter_phases(p, ['trigger', 'create']):
+    ...     print name, len(list(stmts))
+    partitions 2
+    trigger 1
+    """
+    unknown = set(actions) - set(ACTIONS)
+    if unknown:
+        raise ValueError('Unknown actions {0}, use {1}'.format(
+            ', '.join(sorted(unknown)), ', '.join(ACTIONS)))
+    overflow = getattr(p, 'on_miss', None) == 'overflow'
+    for action in ACTIONS:
+        if action not in actions:
+            continue
+        if action == 'master':
+            if not master_columns:
+                raise ValueError('Creating the master table needs its column '
+                                 'definitions')
+            yield 'master', [p.master_ddl(master_columns)]
+        elif action == 'create':
+            yield 'partitions', p.iter_create_ddl()
+            if overflow:
+                yield 'overflow', [p.overflow_ddl()]
+        elif action == 'drop':
+            if overflow:
+                yield 'drop overflow', [p.drop_overflow_ddl()]
+            yield 'drop partitions', p.iter_drop_ddl()
+        elif action == 'function':
+            yield 'function', p.iter_function_code()
+        elif action == 'trigger':
+            yield 'trigger', [p.trigger_code()]
+        elif action == 'drop_trigger':
+            yield 'drop trigger', [p.drop_trigger_code()]
+        elif action == 'indexes':
+            yield 'indexes', p.iter_create_idx_ddl(concurrently)
+            if overflow:
+                yield 'overflow indexes', p.iter_overflow_idx_ddl(concurrently)
+        elif action == 'drop_indexes':
+            if overflow:
+                yield 'drop overflow indexes', p.iter_drop_overflow_idx_ddl()
+            yield 'drop indexes', p.iter_drop_idx_ddl()
+
+
+# pgpartition SUBCOMMAND ... is handled by SUBCOMMANDS[SUBCOMMAND].main
+SUBCOMMANDS = {
+    'archive': 'pgpartitionlib.archive',
+    'load': 'pgpartitionlib.loader',
+    'maintain': 'pgpartitionlib.maintenance',
+    'manifest': 'pgpartitionlib.manifest',
+    'migrate': 'pgpartitionlib.migrate',
+    'rebalance': 'pgpartitionlib.rebalance',
+    'retain': 'pgpartitionlib.retention',
+    }
+
+
+def main(prog_args):
+    if len(prog_args) > 1 and prog_args[1] in SUBCOMMANDS:
+        module = __import__(SUBCOMMANDS[prog_args[1]], fromlist=['main'])
+        return module.main(prog_args[1:])
+
+    parser = optparse.OptionParser(version=meta.__version__,
+        usage='%prog [options]\n       %prog {0} [options]'.format(
+            '|'.join(sorted(SUBCOMMANDS))))
+    add_partitioner_options(parser)
     parser.add_option('--test', action='store_true', help='run doctest')
+    parser.add_option('--declarative', action='store_true', help='use declarative partitioning (PARTITION BY RANGE/PARTITION OF, Postgres 10+) instead of inheritance and a trigger')
+
+    parser.add_option('--create-master-ddl', metavar='COLUMN_DEFS', help='get ddl for the master table with the given column definitions (ie "key INTEGER NOT NULL")')
 
     parser.add_option('--create-ddl', action='store_true', help='get ddl for partition table creation')
     parser.add_option('--drop-ddl', action='store_true', help='get ddl for partition table dropping')
     parser.add_option('--create-function', action='store_true', help='get ddl for partition table function (trigger calls it, will replace existing funciton)')
+    parser.add_option('--routing', default='linear', choices=ROUTING_MODES, help='how the function finds a partition: linear (IF/ELSIF chain), tree (binary search) or arithmetic (computed from the value), defaults to linear')
+    parser.add_option('--on-miss', default='raise', choices=ON_MISS, help='what the function does with a row no partition takes: raise an error, put it in the MASTER_overflow partition (also created, indexed and dropped with the partitions) or create its partition (constant strides only), defaults to raise')
     parser.add_option('--create-trigger', action='store_true', help='get ddl for partition table trigger creation')
     parser.add_option('--drop-trigger', action='store_true', help='get ddl for dropping partition table trigger')
     parser.add_option('--create-index-ddl', action='store_true', help='get ddl for partition table creating indexes')
     parser.add_option('--drop-index-ddl', action='store_true', help='get ddl for partition table dropping indexes')
+    parser.add_option('--concurrently', action='store_true', help='create indexes with CREATE INDEX CONCURRENTLY')
+    parser.add_option('--build-indexes', metavar='DSN', help='create the partition indexes in the database DSN (ie "dbname=test"), reporting the time for each')
+    parser.add_option('-j', '--jobs', type='int', default=1, help='number of connections building indexes (or running autocommit statements with --apply) at once, defaults to 1')
+    parser.add_option('--maintenance-work-mem', help='maintenance_work_mem for index builds (ie 1GB)')
+    parser.add_option('--retries', type='int', default=2, help='times to retry an index build after a transient error, defaults to 2')
     parser.add_option('--arbitrary-sql', help='specify sql to run against partitions (ie "VACUUM %(table)s;")')
+    parser.add_option('-o', '--output', help='write sql to this file as it is generated (- for stdout, the default)')
+    parser.add_option('--apply', metavar='DSN', help='run the sql in the database DSN instead of writing it, --batch-size statements per transaction and round trip (VACUUM, CONCURRENTLY etc on their own, spread over --jobs connections), reporting the time of each phase')
+    parser.add_option('--batch-size', type='int', default=100, help='statements per transaction with --apply, defaults to 100')
+    parser.add_option('--diff-dsn', metavar='DSN', help='only output ddl for partitions missing from the database DSN (and the function), flagging overlapping or orphaned children')
+    parser.add_option('--diff-state', metavar='FILE', help='like --diff-dsn but read the existing partitions from a state file')
+    parser.add_option('--save-state', metavar='FILE', help='record the partitions in a state file (for --diff-state)')
 
     opt, args = parser.parse_args(prog_args)
 
@@ -431,33 +2627,122 @@ def main(prog_args):
         _test()
         return
 
-    if not opt.master_table or not opt.column or not opt.start or not opt.end:
+    p = partitioner_from_options(opt, routing=opt.routing,
+                                 declarative=opt.declarative,
+                                 on_miss=opt.on_miss,
+                                 # each statement is written once, keep
+                                 # memory flat
+                                 cache_chunks=False)
+    if p is None:
         parser.print_help()
         return
 
-    opt.start = int(opt.start)
-    opt.end = int(opt.end)
-    opt.stride = int(opt.stride)
-
-    p = IntPartitioner(opt.master_table, opt.column, opt.start, opt.end,
-                       opt.stride)
-
-    if opt.create_ddl:
-        print p.create_ddl()
-    if opt.drop_ddl:
-        print p.drop_ddl()
-    if opt.create_function:
-        print p.function_code()
-    if opt.create_trigger:
-        print p.trigger_code()
-    if opt.drop_trigger:
-        print p.drop_trigger_code()
-    if opt.create_index_ddl:
-        print p.create_idx_ddl()
-    if opt.drop_index_ddl:
-        print p.drop_idx_ddl()
+    if opt.diff_dsn or opt.diff_state:
+        return _diff(p, opt)
+    actions = [action for action in ACTIONS
+               if getattr(opt, ACTION_OPTIONS[action])]
+    phases = list(iter_phases(p, actions, opt.create_master_ddl,
+                              opt.concurrently))
     if opt.arbitrary_sql:
-        print p.sql(opt.arbitrary)
+        phases.append(('arbitrary sql', p.iter_sql(opt.arbitrary_sql)))
+    error = _output(phases, opt)
+    if error:
+        return error
+
+    if opt.build_indexes:
+        import indexbuild
+        def report(build):
+            sys.stderr.write(indexbuild.format_build(build) + '\n')
+        started = time.time()
+        builds = indexbuild.build_indexes(
+            p, opt.build_indexes, jobs=opt.jobs, concurrently=opt.concurrently,
+            maintenance_work_mem=opt.maintenance_work_mem,
+            retries=opt.retries, report=report)
+        failed = [build for build in builds if build.error]
+        sys.stderr.write('{0} indexes built, {1} failed in {2:.2f}s\n'.format(
+            len(builds) - len(failed), len(failed), time.time() - started))
+        if failed:
+            return 1
+    if opt.save_state:
+        import diff
+        diff.save_state(opt.save_state, p)
+
+
+def single_statements(phases):
+    """
+    phases with the pieces of each of SINGLE_STATEMENT_PHASES joined into
+    the one statement they make, so it can be executed
+    >>> p = IntPartitioner('test_part', 'key', 0, 2)
+    >>> for name, stmts in single_statements(iter_phases(p, ['function'])):
+    ...     print name, len(stmts)
+    function 1
+    """
+    for name, stmts in phases:
+        if name in SINGLE_STATEMENT_PHASES:
+            stmts = ['\n'.join(stmts)]
+        yield name, stmts
+
+
+def _output(phases, opt):
+    """
+    Write the (name, statements) phases to --output or run them against
+    --apply
+    """
+    if opt.apply:
+        import runner
+        def report(phase):
+            sys.stderr.write(runner.format_phase(phase) + '\n')
+        settings = {}
+        if opt.maintenance_work_mem:
+            settings['maintenance_work_mem'] = opt.maintenance_work_mem
+        started = time.time()
+        try:
+            done = runner.run(opt.apply, single_statements(phases),
+                              jobs=opt.jobs,
+                              batch_size=opt.batch_size, settings=settings,
+                              report=report)
+        except runner.ApplyError, e:
+            sys.stderr.write('FAILED {0}\n'.format(e))
+            return 1
+        sys.stderr.write('{0} statements in {1} round trips, {2:.2f}s\n'.format(
+            sum(phase.statements for phase in done),
+            sum(phase.round_trips for phase in done), time.time() - started))
+        return
+    if opt.output and opt.output != '-':
+        out = open(opt.output, 'w')
+    else:
+        out = sys.stdout
+    try:
+        for name, stmts in phases:
+            write_sql(out, stmts)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+def _diff(p, opt):
+    import diff
+    if opt.diff_dsn:
+        import db
+        conn = db.connect(opt.diff_dsn)
+        try:
+            existing = diff.existing_children(conn, p.table_name)
+        finally:
+            conn.close()
+    else:
+        existing = diff.load_state(opt.diff_state)
+    d = diff.diff(p, existing)
+    sys.stderr.write('{0} partitions to create, {1} existing, {2} '
+                     'overlapping, {3} orphaned\n'.format(
+                         len(d.missing), len(d.present), len(d.overlapping),
+                         len(d.orphaned)))
+    error = _output([('diff', diff.iter_diff_ddl(p, d))], opt)
+    if error:
+        return error
+    if d.overlapping:
+        return 1
+    if opt.save_state:
+        diff.save_state(opt.save_state, p)
 
 if __name__ == '__main__':
     sys.exit(main(sys.argv))
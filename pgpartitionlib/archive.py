@@ -0,0 +1,460 @@
+# Copyright (c) 2010 Matt Harrison
+'''
+Move cold partitions out of the database and back.  Each child wholly
+before a cutoff is streamed out with COPY ... TO STDOUT (FORMAT binary)
+into a gzipped file.  Its rows are counted and its sha256 computed
+from the stream itself.  The file is read back and checked against
+those and against count(*) before the child is detached and dropped,
+all in one transaction holding a lock that blocks writes to the child.
+A manifest in the archive directory records each child's file, rows,
+checksum and the create_ddl/index ddl that restore uses to recreate it
+before copying the rows back.  With inheritance the insert function is
+replaced in the same transaction by one routing around the children
+gone, so an insert in their range takes the on_miss path rather than
+failing on a missing table (the overflow child's CHECK, made for the
+whole range, still refuses it).
+
+>>> p = pgpartitionlib.IntPartitioner('test_part', 'key', 0, 40, 10)
+>>> cold_partitions(p, 25)
+['test_part_0', 'test_part_10']
+>>> function = function_without(p, ['test_part_0'])
+>>> for stmt in iter_archive_sql(p, 'test_part_0', function=function):
+...     print stmt # doctest: +ELLIPSIS
+LOCK TABLE ONLY test_part_0 IN EXCLUSIVE MODE;
+SELECT count(*) FROM ONLY test_part_0;
+COPY test_part_0 TO STDOUT (FORMAT binary)
+CREATE OR REPLACE FUNCTION test_part_insert_function()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF ( NEW.key >= 10 AND NEW.key < 20 ) THEN
+...
+LANGUAGE plpgsql;
+ALTER TABLE test_part_0 NO INHERIT test_part;
+DROP TABLE test_part_0;
+'''
+from collections import namedtuple
+import datetime as dt
+import gzip
+import hashlib
+import optparse
+import os
+import struct
+import sys
+import time
+
+import pgpartitionlib
+import db
+import migrate
+
+SIGNATURE = 'PGCOPY\n\xff\r\n\x00'
+
+MANIFEST = 'manifest.json'
+
+Archived = namedtuple('Archived', ['table_name', 'rows', 'bytes', 'seconds',
+                                   'path'])
+
+
+class CopyCounter(object):
+    """
+    File-like sink for a binary COPY stream, counting its rows and bytes
+    and computing its sha256 as the pieces are written
+
+    >>> c = CopyCounter()
+    >>> stream = (SIGNATURE + struct.pack('!ii', 0, 0) +
+    ...           struct.pack('!hi', 1, 4) + struct.pack('!i', 7) +
+    ...           struct.pack('!hi', 1, -1) + struct.pack('!h', -1))
+    >>> for i in xrange(0, len(stream), 5):
+    ...     c.write(stream[i:i + 5])
+    >>> c.rows, c.done, c.bytes == len(stream)
+    (2, True, True)
+    """
+    def __init__(self):
+        self.sha256 = hashlib.sha256()
+        self.bytes = 0
+        self.rows = 0
+        self.done = False
+        self._buf = ''
+        self._header = False
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.bytes += len(data)
+        buf = self._buf + data
+        pos = 0
+        if not self._header:
+            if len(buf) < 19:
+                self._buf = buf
+                return
+            if buf[:11] != SIGNATURE:
+                raise ValueError('Not a binary COPY stream')
+            pos = 19 + struct.unpack_from('!i', buf, 15)[0]
+            if len(buf) < pos:
+                self._buf = buf
+                return
+            self._header = True
+        while not self.done and len(buf) - pos >= 2:
+            fields = struct.unpack_from('!h', buf, pos)[0]
+            if fields == -1:
+                self.done = True
+                pos += 2
+                break
+            end = pos + 2
+            for i in xrange(fields):
+                if len(buf) - end < 4:
+                    end = None
+                    break
+                end += 4 + max(0, struct.unpack_from('!i', buf, end)[0])
+                if end > len(buf):
+                    end = None
+                    break
+            if end is None:
+                break
+            self.rows += 1
+            pos = end
+        self._buf = buf[pos:]
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+
+class Tee(object):
+    """
+    Write to several files at once
+    """
+    def __init__(self, *outs):
+        self.outs = outs
+
+    def write(self, data):
+        for out in self.outs:
+            out.write(data)
+
+
+def read_archive(path, chunk_size=65536):
+    """
+    CopyCounter of the COPY stream in the gzipped file path
+    """
+    counter = CopyCounter()
+    fin = gzip.open(path, 'rb')
+    try:
+        while True:
+            data = fin.read(chunk_size)
+            if not data:
+                break
+            counter.write(data)
+    finally:
+        fin.close()
+    return counter
+
+
+def cold_partitions(partitioner, cutoff):
+    """
+    Children whose whole range is before cutoff
+    """
+    table = partitioner.chunk_table()
+    cutoff = partitioner.chunker.key(cutoff)
+    return [name for name, end in zip(table.table_names, table.ends)
+            if end <= cutoff]
+
+
+def archive_path(directory, table_name):
+    return os.path.join(directory, table_name + '.copy.gz')
+
+
+def function_without(partitioner, table_names):
+    """
+    Insert function routing to every child but table_names (None with
+    declarative partitioning).  What is left may not start where the
+    chunker does, so arithmetic routing is replaced by a tree.
+    """
+    if partitioner.declarative:
+        return None
+    table_names = set(table_names)
+    p = partitioner.only([name for name in partitioner.chunk_table().table_names
+                          if name not in table_names])
+    routing = p.routing
+    if routing == 'arithmetic' or not len(p.chunk_table()):
+        routing = 'tree'
+    return p.function_code(routing)
+
+
+def iter_archive_sql(partitioner, table_name, detach_only=False,
+                     function=None):
+    """
+    The statements archive_partition runs (the COPY's rows go to the
+    archive file), function replaces the insert function before the
+    child is detached
+    """
+    yield 'LOCK TABLE ONLY {0} IN EXCLUSIVE MODE;'.format(table_name)
+    yield 'SELECT count(*) FROM ONLY {0};'.format(table_name)
+    yield 'COPY {0} TO STDOUT (FORMAT binary)'.format(table_name)
+    if function:
+        yield function
+    yield partitioner.detach_ddl(table_name)
+    if not detach_only:
+        yield 'DROP TABLE {0};'.format(table_name)
+
+
+def load_manifest(directory):
+    """
+    {table_name: entry} of the partitions archived in directory
+    """
+    return migrate.load_checkpoint(os.path.join(directory, MANIFEST))
+
+
+def save_manifest(directory, manifest):
+    # written then renamed, like a migrate checkpoint
+    migrate.save_checkpoint(os.path.join(directory, MANIFEST), manifest)
+
+
+def archive_partition(partitioner, conn, table_name, directory,
+                      detach_only=False, compresslevel=6, function=None):
+    """
+    Archive one child to directory and detach (and drop) it in one
+    transaction, returns (Archived, manifest entry).  Nothing is
+    detached unless the file reads back with the rows and checksum the
+    COPY had and as many rows as the table.  function (see
+    function_without) replaces the insert function in that transaction.
+    """
+    started = time.time()
+    path = archive_path(directory, table_name)
+    tmp = path + '.tmp'
+    only = partitioner.only([table_name])
+    entry = dict(master=partitioner.table_name, column=partitioner.column,
+                 file=os.path.basename(path),
+                 create_ddl=list(only.iter_create_ddl()),
+                 index_ddl=[] if partitioner.declarative else list(
+                     only.iter_create_idx_ddl()))
+    cur = conn.cursor()
+    try:
+        stmts = list(iter_archive_sql(partitioner, table_name, True,
+                                      function))
+        lock, count, copy, detach = stmts[:3] + stmts[-1:]
+        cur.execute(lock)
+        cur.execute(count)
+        rows = cur.fetchone()[0]
+        counter = CopyCounter()
+        fout = gzip.open(tmp, 'wb', compresslevel)
+        try:
+            cur.copy_expert(copy, Tee(fout, counter))
+        finally:
+            fout.close()
+        check = read_archive(tmp)
+        if not (counter.done and check.done and counter.rows == rows and
+                check.rows == rows and
+                check.hexdigest() == counter.hexdigest()):
+            raise ValueError('{0}: archive of {1} rows does not match the '
+                             'table ({2} copied, {3} read back)'.format(
+                                 table_name, rows, counter.rows, check.rows))
+        _fsync(tmp)
+        os.rename(tmp, path)
+        if function:
+            cur.execute(function)
+        cur.execute(detach)
+        if not detach_only:
+            cur.execute('DROP TABLE {0};'.format(table_name))
+        conn.commit()
+    except:
+        conn.rollback()
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    entry.update(rows=rows, bytes=counter.bytes, sha256=counter.hexdigest(),
+                 archived=dt.datetime.now().isoformat(),
+                 dropped=not detach_only)
+    return (Archived(table_name, rows, os.path.getsize(path),
+                     time.time() - started, path), entry)
+
+
+def _fsync(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def archive(partitioner, conn, cutoff, directory, detach_only=False,
+            compresslevel=6, report=None):
+    """
+    Archive every child before cutoff that still exists, recording each
+    in the manifest as it is done, returns a list of Archived.  With
+    inheritance the insert function is replaced as each child goes by
+    one routing around it and the children already gone.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    manifest = load_manifest(directory)
+    done = []
+    gone = []
+    cur = conn.cursor()
+    for table_name in cold_partitions(partitioner, cutoff):
+        cur.execute('SELECT to_regclass(%s);', (table_name,))
+        exists = cur.fetchone()[0] is not None
+        conn.rollback()
+        gone.append(table_name)
+        if not exists:
+            continue
+        archived, entry = archive_partition(
+            partitioner, conn, table_name, directory, detach_only,
+            compresslevel, function_without(partitioner, gone))
+        manifest[table_name] = entry
+        save_manifest(directory, manifest)
+        done.append(archived)
+        if report:
+            report(archived)
+    return done
+
+
+def verify(directory, table_names=None):
+    """
+    yield (table_name, error or None) for each archive in the manifest
+    """
+    manifest = load_manifest(directory)
+    for table_name in table_names or sorted(manifest):
+        entry = manifest.get(table_name)
+        if entry is None:
+            yield table_name, 'not in the manifest'
+            continue
+        path = os.path.join(directory, entry['file'])
+        if not os.path.exists(path):
+            yield table_name, 'missing {0}'.format(path)
+            continue
+        try:
+            check = read_archive(path)
+        except (IOError, ValueError, struct.error), e:
+            yield table_name, str(e)
+            continue
+        if not check.done:
+            yield table_name, 'truncated'
+        elif check.rows != entry['rows']:
+            yield table_name, '{0} rows, the manifest has {1}'.format(
+                check.rows, entry['rows'])
+        elif check.hexdigest() != entry['sha256']:
+            yield table_name, 'checksum does not match'
+        else:
+            yield table_name, None
+
+
+def restore_partition(conn, directory, table_name, manifest):
+    """
+    Recreate table_name with the ddl recorded when it was archived and
+    COPY its rows back, in one transaction.  With inheritance the insert
+    function still routes around it until it is created again (ie with
+    pgpartition --create-function).
+    """
+    entry = manifest[table_name]
+    for name, error in verify(directory, [table_name]):
+        if error:
+            raise ValueError('{0}: {1}'.format(name, error))
+    started = time.time()
+    path = os.path.join(directory, entry['file'])
+    cur = conn.cursor()
+    try:
+        for stmt in entry['create_ddl']:
+            cur.execute(stmt)
+        fin = gzip.open(path, 'rb')
+        try:
+            cur.copy_expert('COPY {0} FROM STDIN (FORMAT binary)'.format(
+                table_name), fin)
+        finally:
+            fin.close()
+        cur.execute('SELECT count(*) FROM ONLY {0};'.format(table_name))
+        rows = cur.fetchone()[0]
+        if rows != entry['rows']:
+            raise ValueError('{0}: restored {1} rows, archived {2}'.format(
+                table_name, rows, entry['rows']))
+        for stmt in entry['index_ddl']:
+            cur.execute(stmt)
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    return Archived(table_name, rows, os.path.getsize(path),
+                    time.time() - started, path)
+
+
+def restore(conn, directory, table_names=None, report=None):
+    """
+    Restore table_names (every archive in the manifest by default),
+    marking them restored in the manifest, returns a list of Archived
+    """
+    manifest = load_manifest(directory)
+    done = []
+    for table_name in table_names or sorted(manifest):
+        if table_name not in manifest:
+            raise ValueError('{0} is not in {1}'.format(
+                table_name, os.path.join(directory, MANIFEST)))
+        restored = restore_partition(conn, directory, table_name, manifest)
+        manifest[table_name]['restored'] = dt.datetime.now().isoformat()
+        save_manifest(directory, manifest)
+        done.append(restored)
+        if report:
+            report(restored)
+    return done
+
+
+def format_archived(archived):
+    """
+    >>> print format_archived(Archived('t_0', 1000, 2048, 0.5, 'cold/t_0.copy.gz'))
+    t_0: 1000 rows, 2048 bytes, 0.50s -> cold/t_0.copy.gz
+    """
+    return '{0}: {1} rows, {2} bytes, {3:.2f}s -> {4}'.format(*archived)
+
+
+def main(prog_args):
+    parser = optparse.OptionParser(
+        usage='%prog archive [options]',
+        description='Archive the partitions before a cutoff to compressed '
+                    'files and drop them, or restore them')
+    pgpartitionlib.add_partitioner_options(parser)
+    parser.add_option('--declarative', action='store_true', help='the master table uses declarative partitioning')
+    parser.add_option('--before', metavar='CUTOFF', help='archive the partitions wholly before this value')
+    parser.add_option('--dir', help='archive directory (holding the manifest) [REQ]')
+    parser.add_option('--dsn', help='database to archive from or restore to')
+    parser.add_option('--detach-only', action='store_true', help="detach archived partitions but don't drop them")
+    parser.add_option('--compress-level', type='int', default=6, help='gzip level, defaults to 6')
+    parser.add_option('--dry-run', action='store_true', help='only list the partitions that would be archived')
+    parser.add_option('--verify', action='store_true', help='check the archive files against the manifest')
+    parser.add_option('--restore', action='store_true', help='recreate archived partitions and copy their rows back')
+    parser.add_option('--table', action='append', help='with --verify/--restore, only this partition (can be repeated)')
+
+    opt, args = parser.parse_args(prog_args)
+    if not opt.dir:
+        parser.print_help()
+        return 1
+
+    def report(archived):
+        sys.stderr.write(format_archived(archived) + '\n')
+    if opt.verify:
+        failed = 0
+        for table_name, error in verify(opt.dir, opt.table):
+            sys.stderr.write('{0}: {1}\n'.format(table_name, error or 'ok'))
+            failed += bool(error)
+        return 1 if failed else None
+    if opt.restore:
+        if not opt.dsn:
+            parser.print_help()
+            return 1
+        conn = db.connect(opt.dsn)
+        try:
+            restore(conn, opt.dir, opt.table, report)
+        finally:
+            conn.close()
+        return
+    p = pgpartitionlib.partitioner_from_options(opt,
+                                                declarative=opt.declarative)
+    if p is None or not opt.before or not (opt.dsn or opt.dry_run):
+        parser.print_help()
+        return 1
+    if opt.dry_run:
+        for table_name in cold_partitions(p, opt.before):
+            print table_name
+        return
+    conn = db.connect(opt.dsn)
+    try:
+        done = archive(p, conn, opt.before, opt.dir, opt.detach_only,
+                       opt.compress_level, report)
+    finally:
+        conn.close()
+    sys.stderr.write('{0} partitions, {1} rows archived to {2}\n'.format(
+        len(done), sum(archived.rows for archived in done), opt.dir))
@@ -0,0 +1,43 @@
+# Copyright (c) 2010 Matt Harrison
+'''
+Helpers for running the generated sql against a database.  These need
+psycopg2, which is only imported when a connection is made.
+'''
+
+# SQLSTATEs worth retrying: serialization failure, deadlock detected,
+# lock not available, too many connections, admin/crash shutdown and
+# cannot connect now
+TRANSIENT_CODES = frozenset(['40001', '40P01', '55P03', '53300',
+                             '57P01', '57P02', '57P03'])
+
+
+def connect(dsn, autocommit=False, settings=None):
+    """
+    settings - dict of run time settings (ie maintenance_work_mem) to
+      set for the session
+    """
+    import psycopg2
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = autocommit
+    if settings:
+        cur = conn.cursor()
+        for name, value in sorted(settings.items()):
+            cur.execute('SELECT set_config(%s, %s, false);',
+                        (name, str(value)))
+        if not autocommit:
+            conn.commit()
+    return conn
+
+
+def is_transient(error):
+    """
+    Is error one that could go away if the statement is retried (a
+    dropped connection, deadlock, lock timeout, etc)
+    """
+    import psycopg2
+    if not isinstance(error, psycopg2.Error):
+        return False
+    if error.pgcode is None:
+        # no SQLSTATE means the server never answered
+        return isinstance(error, psycopg2.OperationalError)
+    return error.pgcode in TRANSIENT_CODES
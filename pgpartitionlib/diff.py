@@ -0,0 +1,205 @@
+# Copyright (c) 2010 Matt Harrison
+'''
+Compare the children a master table already has (read from
+pg_inherits/pg_class or a state file) with the chunks of a partitioner,
+so only the DDL for missing partitions is generated.  Existing children
+whose range overlaps a chunk they aren't, or that match no chunk at
+all, are flagged.
+
+>>> p = pgpartitionlib.IntPartitioner('test_part', 'key', 0, 50, 10)
+>>> existing = [Child('test_part_0', 0, 10), Child('test_part_10', 10, 20),
+...             Child('test_part_old', 15, 25), Child('test_part_x', 90, 100)]
+>>> d = diff(p, existing)
+>>> d.missing
+['test_part_30', 'test_part_40']
+>>> d.overlapping
+[(Child(table_name='test_part_old', start=15, end=25), ['test_part_10', 'test_part_20'])]
+>>> d.orphaned
+[Child(table_name='test_part_x', start=90, end=100)]
+>>> for stmt in iter_diff_ddl(p, d):
+...     print stmt
+-- test_part_old overlaps test_part_10, test_part_20
+-- test_part_x matches no partition
+CREATE TABLE test_part_30 (
+    CHECK ( key >= 30 AND key < 40 )
+) INHERITS (test_part);
+CREATE TABLE test_part_40 (
+    CHECK ( key >= 40 AND key < 50 )
+) INHERITS (test_part);
+CREATE INDEX test_part_30_0_index ON test_part_30 (key);
+CREATE INDEX test_part_40_0_index ON test_part_40 (key);
+-- not replacing test_part_insert_function(), resolve the overlaps first
+
+Bounds of a timestamptz column are read back with the session's UTC
+offset, which is dropped to compare them
+
+>>> m = pgpartitionlib.MonthPartitioner('ev', 'ts', '2012-01', '2012-03')
+>>> check = ("CHECK (((ts >= '{0} 00:00:00+00'::timestamp with time zone) "
+...          "AND (ts < '{1} 00:00:00+00'::timestamp with time zone)))")
+>>> bounds = parse_bounds(check.format('2012-01-01', '2012-02-01'))
+>>> bounds
+('2012-01-01 00:00:00+00', '2012-02-01 00:00:00+00')
+>>> d = diff(m, [Child('ev_2012-01', *bounds)])
+>>> d.present, d.missing, d.overlapping, d.orphaned
+(['ev_2012-01'], ['ev_2012-02'], [], [])
+'''
+import bisect
+from collections import namedtuple
+import json
+import re
+
+import pgpartitionlib
+
+# start/end are None if the range of the child couldn't be read
+Child = namedtuple('Child', ['table_name', 'start', 'end'])
+
+Diff = namedtuple('Diff', ['missing', 'present', 'overlapping', 'orphaned'])
+
+CHILDREN_SQL = """SELECT c.relname, pg_get_expr(c.relpartbound, c.oid),
+    (SELECT string_agg(pg_get_constraintdef(con.oid), ' AND ')
+     FROM pg_constraint con
+     WHERE con.conrelid = c.oid AND con.contype = 'c')
+FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+WHERE i.inhparent = %s::regclass
+ORDER BY c.relname;"""
+
+_check_re = re.compile(r'>=\s*(.+?)\)\s+AND\s+\(.+?<\s*(.+?)\)')
+_bound_re = re.compile(r'FROM \((.+?)\) TO \((.+?)\)')
+
+
+def parse_bounds(expr):
+    """
+    (start, end) from a CHECK constraint or partition bound as Postgres
+    prints it, (None, None) if it isn't a simple range
+    >>> parse_bounds('CHECK (((key >= 0) AND (key < 10)))')
+    (0, 10)
+    >>> parse_bounds("CHECK (((d >= '2012-01-01'::date) AND (d < '2012-02-01'::date)))")
+    ('2012-01-01', '2012-02-01')
+    >>> parse_bounds("FOR VALUES FROM ('2012-01-01') TO ('2012-02-01')")
+    ('2012-01-01', '2012-02-01')
+    >>> parse_bounds('CHECK ((key > 0))')
+    (None, None)
+    """
+    match = _bound_re.search(expr or '') or _check_re.search(expr or '')
+    if not match:
+        return None, None
+    return parse_value(match.group(1)), parse_value(match.group(2))
+
+
+def parse_value(text):
+    text = text.split('::')[0].strip()
+    if text.startswith("'"):
+        return text.strip("'")
+    try:
+        return int(text)
+    except ValueError:
+        return text
+
+
+def existing_children(conn, master_table):
+    """
+    Child for each table inheriting from (or a partition of) master_table
+    """
+    cur = conn.cursor()
+    cur.execute(CHILDREN_SQL, (master_table,))
+    children = []
+    for name, bound, check in cur.fetchall():
+        start, end = parse_bounds(bound or check)
+        children.append(Child(name, start, end))
+    return children
+
+
+def load_state(path):
+    """
+    Children recorded in a state file written by save_state
+    """
+    fin = open(path)
+    try:
+        return [Child(item['table_name'], item['start'], item['end'])
+                for item in json.load(fin)]
+    finally:
+        fin.close()
+
+
+def save_state(path, partitioner):
+    """
+    Record the children of partitioner in a state file (a JSON list)
+    """
+    table = partitioner.chunk_table()
+    state = [dict(table_name=table.table_names[i], start=table.starts[i],
+                  end=table.ends[i]) for i in xrange(len(table))]
+    fout = open(path, 'w')
+    try:
+        json.dump(state, fout, indent=1)
+    finally:
+        fout.close()
+
+
+def diff(partitioner, existing):
+    """
+    Compare the chunks of partitioner with the existing children
+    """
+    table = partitioner.chunk_table()
+    key = partitioner.chunker.key
+    names = dict((name, i) for i, name in enumerate(table.table_names))
+    present = set()
+    blocked = set()
+    overlapping = []
+    orphaned = []
+    for child in existing:
+        if child.table_name == partitioner.overflow_table():
+            continue
+        i = names.get(child.table_name)
+        try:
+            start, end = key(child.start), key(child.end)
+        except (TypeError, ValueError):
+            # not a range the chunker can read
+            start = None
+        if start is None:
+            if i is None:
+                orphaned.append(child)
+            else:
+                present.add(i)
+            continue
+        if i is not None and (start, end) == (table.starts[i], table.ends[i]):
+            present.add(i)
+            continue
+        first = bisect.bisect_right(table.ends, start)
+        last = bisect.bisect_left(table.starts, end)
+        if first < last:
+            overlapping.append((child, list(table.table_names[first:last])))
+            blocked.update(xrange(first, last))
+        else:
+            orphaned.append(child)
+    missing = [name for i, name in enumerate(table.table_names)
+               if i not in present and i not in blocked]
+    return Diff(missing, [table.table_names[i] for i in sorted(present)],
+                overlapping, orphaned)
+
+
+def iter_diff_ddl(partitioner, d):
+    """
+    Flag overlapping/orphaned children (as sql comments), then yield
+    the create and index DDL of the missing partitions and the insert
+    function (once, for the whole partitioner)
+    """
+    for child, table_names in d.overlapping:
+        yield '-- {0} overlaps {1}'.format(child.table_name,
+                                           ', '.join(table_names))
+    for child in d.orphaned:
+        yield '-- {0} matches no partition'.format(child.table_name)
+    if d.missing:
+        missing = partitioner.only(d.missing)
+        for stmt in missing.iter_create_ddl():
+            yield stmt
+        if not partitioner.declarative:
+            for stmt in missing.iter_create_idx_ddl():
+                yield stmt
+    if partitioner.declarative:
+        return
+    if d.overlapping:
+        yield ('-- not replacing {0}_insert_function(), resolve the '
+               'overlaps first'.format(partitioner.table_name))
+    elif d.missing:
+        # one statement, so it can be executed
+        yield partitioner.function_code()
@@ -0,0 +1,114 @@
+# Copyright (c) 2010 Matt Harrison
+'''
+Build the indexes of every partition in parallel over a bounded number
+of connections, rather than running create_idx_ddl() one statement at a
+time.  Each connection sets maintenance_work_mem for its session,
+transient failures are retried and the build time of each index is
+reported.
+'''
+from collections import namedtuple
+import Queue
+import threading
+import time
+
+import db
+
+IndexBuild = namedtuple('IndexBuild', ['table_name', 'index_name', 'seconds',
+                                       'attempts', 'error'])
+
+
+def build_indexes(partitioner, dsn, jobs=1, concurrently=False,
+                  maintenance_work_mem=None, retries=2, retry_wait=5,
+                  report=None):
+    """
+    Run the CREATE INDEX statements of partitioner over up to jobs
+    connections, returns an IndexBuild for each index in the order they
+    finished.
+
+    concurrently - use CREATE INDEX CONCURRENTLY (doesn't block writes)
+    maintenance_work_mem - ie '1GB', set on each connection
+    retries - how many times to retry an index after a transient error
+    report - function called with each IndexBuild as it finishes
+    """
+    settings = {}
+    if maintenance_work_mem:
+        settings['maintenance_work_mem'] = maintenance_work_mem
+    todo = Queue.Queue()
+    for item in partitioner.iter_index_defs(concurrently):
+        todo.put(item)
+    results = []
+    lock = threading.Lock()
+
+    def worker():
+        conn = None
+        try:
+            while True:
+                try:
+                    table_name, index_name, stmt = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                result, conn = build_index(conn, dsn, settings, table_name,
+                                           index_name, stmt, concurrently,
+                                           retries, retry_wait)
+                with lock:
+                    results.append(result)
+                    if report:
+                        report(result)
+        finally:
+            if conn is not None:
+                conn.close()
+
+    threads = [threading.Thread(target=worker)
+               for i in xrange(max(1, min(jobs, todo.qsize())))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def build_index(conn, dsn, settings, table_name, index_name, stmt,
+                concurrently=False, retries=2, retry_wait=5):
+    """
+    Run one CREATE INDEX, connecting (again) if conn is None or was
+    lost.  Returns (IndexBuild, conn).
+    """
+    import psycopg2
+    started = time.time()
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            if conn is None:
+                conn = db.connect(dsn, autocommit=True, settings=settings)
+            cur = conn.cursor()
+            if concurrently and attempt > 1:
+                # a failed concurrent build leaves an INVALID index behind
+                cur.execute('DROP INDEX CONCURRENTLY IF EXISTS {0};'.format(
+                    index_name))
+            cur.execute(stmt)
+            return IndexBuild(table_name, index_name, time.time() - started,
+                              attempt, None), conn
+        except psycopg2.Error, e:
+            if conn is not None and conn.closed:
+                conn = None
+            if attempt > retries or not db.is_transient(e):
+                return IndexBuild(table_name, index_name,
+                                  time.time() - started, attempt,
+                                  str(e).strip()), conn
+            time.sleep(retry_wait)
+
+
+def format_build(build):
+    """
+    >>> print format_build(IndexBuild('t_0', 't_0_0_index', 1.5, 1, None))
+    t_0_0_index ON t_0: 1.50s
+    >>> print format_build(IndexBuild('t_0', 't_0_0_index', 1.5, 3, 'boom'))
+    t_0_0_index ON t_0: FAILED after 3 attempts (1.50s): boom
+    """
+    if build.error:
+        return '{0} ON {1}: FAILED after {2} attempts ({3:.2f}s): {4}'.format(
+            build.index_name, build.table_name, build.attempts, build.seconds,
+            build.error)
+    return '{0} ON {1}: {2:.2f}s'.format(build.index_name, build.table_name,
+                                         build.seconds)
@@ -0,0 +1,369 @@
+# Copyright (c) 2010 Matt Harrison
+'''
+Bulk load CSV/TSV data straight into the partitions.  Each record is
+routed client side (a bisect over the chunk boundaries) and buffered
+per partition, then one COPY block is written per partition, so the
+insert trigger on the master table never fires.  Records are passed
+through exactly as read: CSV in COPY's csv format and TSV in its text
+format (tab separated, \\N for NULL, backslash escapes), so NULLs,
+empty strings and escapes load as they would with COPY itself.  Rows
+that don't fall in any chunk go to a reject file rather than aborting
+the load.
+
+>>> import StringIO
+>>> p = pgpartitionlib.IntPartitioner('test_part', 'key', 0, 20, 10)
+>>> loader = PartitionLoader(p, column_index=0)
+>>> loader.load(StringIO.StringIO("""1,a
+... 15,"b,c"
+... 42,d
+... 3,""
+... 4,
+... "7,7",x
+... ,y
+... """))
+>>> loader.write_copy(sys.stdout)
+COPY test_part_0 FROM STDIN WITH CSV;
+1,a
+3,""
+4,
+\\.
+COPY test_part_10 FROM STDIN WITH CSV;
+15,"b,c"
+\\.
+>>> sorted(loader.counts.items())
+[('test_part_0', 3), ('test_part_10', 1)]
+>>> loader.rejected
+3
+
+TSV is COPY's text format, a NULL key is rejected and escapes are
+undone to route on the key
+
+>>> loader = PartitionLoader(p, column_index=1, fmt='text')
+>>> loader.load(StringIO.StringIO('a\\t1\\t\\\\N\\n\\t1\\tx\\\\\\\\y\\n'
+...                               'b\\\\tc\\t12\\t\\n\\\\N\\t\\\\N\\ty\\n'))
+>>> out = StringIO.StringIO()
+>>> loader.write_copy(out)
+>>> for line in out.getvalue().splitlines():
+...     print repr(line)
+'COPY test_part_0 FROM STDIN;'
+'a\\t1\\t\\\\N'
+'\\t1\\tx\\\\\\\\y'
+'\\\\.'
+'COPY test_part_10 FROM STDIN;'
+'b\\\\tc\\t12\\t'
+'\\\\.'
+>>> loader.rejected
+1
+'''
+import csv
+import optparse
+import os
+import re
+import sys
+import tempfile
+
+import pgpartitionlib
+
+FORMATS = ('csv', 'text')
+
+# COPY text format escapes
+ESCAPES = {'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t',
+           'v': '\v'}
+
+ESCAPE_RE = re.compile(r'\\(x[0-9a-fA-F]{1,2}|[0-7]{1,3}|.)')
+
+
+def unescape_text(field):
+    """
+    Value of a field in COPY text format (None for NULL)
+    >>> unescape_text('\\\\N') is None
+    True
+    >>> unescape_text('a\\\\tb\\\\\\\\c\\\\101')
+    'a\\tb\\\\cA'
+    """
+    if field == '\\N':
+        return None
+
+    def sub(match):
+        esc = match.group(1)
+        if esc[0] == 'x' and len(esc) > 1:
+            return chr(int(esc[1:], 16))
+        elif esc[0].isdigit():
+            return chr(int(esc, 8) & 0xff)
+        return ESCAPES.get(esc, esc)
+    return ESCAPE_RE.sub(sub, field)
+
+
+def iter_text_records(lines, column_index):
+    """
+    yield (record, key value) for each line of COPY text format
+    """
+    for line in lines:
+        if not line.endswith('\n'):
+            line += '\n'
+        fields = line.rstrip('\r\n').split('\t')
+        try:
+            value = unescape_text(fields[column_index])
+        except IndexError:
+            value = None
+        yield line, value
+
+
+class _Recorder(object):
+    # the lines csv.reader takes for each record, so the record can be
+    # passed on unchanged
+    def __init__(self, lines):
+        self.lines = iter(lines)
+        self.taken = []
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = next(self.lines)
+        self.taken.append(line)
+        return line
+
+
+def iter_csv_records(lines, column_index, delimiter=','):
+    """
+    yield (record, key value) for each (possibly multi-line) CSV record,
+    an empty unquoted key is NULL as in COPY
+    """
+    recorder = _Recorder(lines)
+    for row in csv.reader(recorder, delimiter=delimiter):
+        record = ''.join(recorder.taken)
+        recorder.taken = []
+        if not record.endswith('\n'):
+            record += '\n'
+        try:
+            value = row[column_index]
+        except IndexError:
+            value = None
+        # csv gives '' for both an empty field (NULL to COPY) and ""
+        if value == '' and raw_field(record, column_index,
+                                     delimiter).strip() != '""':
+            value = None
+        yield record, value
+
+
+def raw_field(record, index, delimiter=','):
+    """
+    The text of field index in a CSV record, quotes and all
+    >>> raw_field('"a,b",""\\n', 1)
+    '""'
+    """
+    chars = []
+    field = 0
+    quoted = False
+    for char in record.rstrip('\r\n'):
+        if char == '"':
+            quoted = not quoted
+        elif char == delimiter and not quoted:
+            field += 1
+            if field > index:
+                break
+            continue
+        if field == index:
+            chars.append(char)
+    return ''.join(chars)
+
+
+class PartitionLoader(object):
+    """
+    column_index - position of the partitioning column in each row
+    fmt - 'csv' or 'text' (TSV), the input is written out in the same
+      COPY format
+    reject - file object for rows that don't match a chunk (they are
+      counted and dropped if not given)
+    buffer_size - bytes buffered in memory over all the partitions.
+      Past it the partition with the most is appended to one shared
+      temporary file, so memory and open files don't grow with the
+      number of partitions.
+    """
+    def __init__(self, partitioner, column_index, fmt='csv', reject=None,
+                 buffer_size=64*1024*1024):
+        if fmt not in FORMATS:
+            raise ValueError('Unknown format {0!r}, use one of {1}'.format(
+                fmt, ', '.join(FORMATS)))
+        self.partitioner = partitioner
+        self.column_index = column_index
+        self.fmt = fmt
+        self.buffer_size = buffer_size
+        self.reject = reject
+        self.counts = {}
+        self.rejected = 0
+        self._buffers = {}  # chunk index -> records in memory
+        self._sizes = {}  # chunk index -> bytes in memory
+        self._buffered = 0
+        self._segments = {}  # chunk index -> [(offset, length)] spilled
+        self._spill = None
+
+    def iter_records(self, lines):
+        if self.fmt == 'text':
+            return iter_text_records(lines, self.column_index)
+        return iter_csv_records(lines, self.column_index)
+
+    def load(self, lines):
+        """
+        Route the records in lines (a file or iterable of lines)
+
+        >>> h = pgpartitionlib.HashPartitioner('test_hash', 'id', 3,
+        ...                                    declarative=True)
+        >>> PartitionLoader(h, column_index=0).load(['1,a\\n'])
+        Traceback (most recent call last):
+          ...
+        ValueError: Postgres picks declarative hash partitions with its own hash functions, insert into test_hash
+        """
+        self.partitioner.check_client_routing()
+        table = self.partitioner.chunk_table()
+        key = self.partitioner.chunker.key
+        buffers = self._buffers
+        sizes = self._sizes
+        for record, value in self.iter_records(lines):
+            i = -1
+            if value is not None:
+                try:
+                    i = table.find(key(value))
+                except ValueError:
+                    pass
+            if i == -1:
+                self.rejected += 1
+                if self.reject:
+                    self.reject.write(record)
+                continue
+            if i in buffers:
+                buffers[i].append(record)
+                sizes[i] += len(record)
+            else:
+                buffers[i] = [record]
+                sizes[i] = len(record)
+            self._buffered += len(record)
+            name = table.table_names[i]
+            self.counts[name] = self.counts.get(name, 0) + 1
+            if self._buffered > self.buffer_size:
+                self._spill_largest()
+
+    def _spill_largest(self):
+        i = max(self._sizes, key=self._sizes.get)
+        data = ''.join(self._buffers.pop(i))
+        self._buffered -= self._sizes.pop(i)
+        if self._spill is None:
+            self._spill = tempfile.TemporaryFile()
+        self._spill.seek(0, os.SEEK_END)
+        self._segments.setdefault(i, []).append((self._spill.tell(),
+                                                 len(data)))
+        self._spill.write(data)
+
+    def _iter_data(self, i, chunk_size=64*1024):
+        for offset, length in self._segments.get(i, []):
+            self._spill.seek(offset)
+            while length > 0:
+                buf = self._spill.read(min(chunk_size, length))
+                length -= len(buf)
+                yield buf
+        for record in self._buffers.get(i, []):
+            yield record
+
+    def iter_copy(self):
+        """
+        yield (table_name, data) for each partition with rows, in chunk
+        order, data is an iterator of strings
+        """
+        table = self.partitioner.chunk_table()
+        for i in sorted(set(self._buffers) | set(self._segments)):
+            yield table.table_names[i], self._iter_data(i)
+
+    def write_copy(self, out):
+        for table_name, data in self.iter_copy():
+            write_copy_block(out, table_name, data, self.fmt)
+
+    def write_files(self, directory):
+        """
+        Write a <table_name>.sql file with the COPY block for each
+        partition, returns the paths
+        """
+        paths = []
+        for table_name, data in self.iter_copy():
+            path = os.path.join(directory, table_name + '.sql')
+            out = open(path, 'w')
+            try:
+                write_copy_block(out, table_name, data, self.fmt)
+            finally:
+                out.close()
+            paths.append(path)
+        return paths
+
+    def close(self):
+        if self._spill is not None:
+            self._spill.close()
+        self._spill = None
+        self._buffers = {}
+        self._sizes = {}
+        self._segments = {}
+        self._buffered = 0
+
+
+def write_copy_block(out, table_name, data, fmt='csv'):
+    if fmt == 'csv':
+        out.write('COPY {0} FROM STDIN WITH CSV;\n'.format(table_name))
+    else:
+        out.write('COPY {0} FROM STDIN;\n'.format(table_name))
+    for buf in data:
+        out.write(buf)
+    out.write('\\.\n')
+
+
+def main(prog_args):
+    parser = optparse.OptionParser(
+        usage='%prog load [options] [FILE]',
+        description='Route CSV/TSV rows (from FILE or stdin) to partitions '
+        'and write a COPY block per partition')
+    pgpartitionlib.add_partitioner_options(parser)
+    parser.add_option('--tsv', action='store_true', help="input is tab separated in COPY's text format (\\N for NULL, backslash escapes), default is CSV")
+    parser.add_option('--header', action='store_true', help='first row is a header (the partitioning column is found by name)')
+    parser.add_option('--column-index', type='int', help='position of the partitioning column in a row (from 0), required without --header')
+    parser.add_option('--reject', help='write rows that match no partition to this file')
+    parser.add_option('-o', '--output', help='write the COPY blocks to this file (default stdout)')
+    parser.add_option('--output-dir', help='write a <partition>.sql file per partition into this directory')
+    parser.add_option('--buffer-size', type='int', default=64*1024*1024, help='bytes kept in memory over all the partitions before spilling to disk, defaults to 64MB')
+
+    opt, args = parser.parse_args(prog_args)
+    p = pgpartitionlib.partitioner_from_options(opt)
+    if p is None or (opt.column_index is None and not opt.header):
+        parser.print_help()
+        return 1
+
+    fmt = 'text' if opt.tsv else 'csv'
+    fin = open(args[1]) if len(args) > 1 else sys.stdin
+    reject = open(opt.reject, 'w') if opt.reject else None
+    try:
+        column_index = opt.column_index
+        if opt.header:
+            if fmt == 'text':
+                header = [unescape_text(field) for field in
+                          next(fin).rstrip('\r\n').split('\t')]
+            else:
+                header = next(csv.reader(fin))
+            if column_index is None:
+                column_index = header.index(p.column)
+        loader = PartitionLoader(p, column_index, fmt, reject=reject,
+                                 buffer_size=opt.buffer_size)
+        loader.load(fin)
+        if opt.output_dir:
+            loader.write_files(opt.output_dir)
+        else:
+            out = open(opt.output, 'w') if opt.output else sys.stdout
+            try:
+                loader.write_copy(out)
+            finally:
+                if out is not sys.stdout:
+                    out.close()
+        loader.close()
+    finally:
+        if fin is not sys.stdin:
+            fin.close()
+        if reject:
+            reject.close()
+    sys.stderr.write('{0} rows loaded into {1} partitions, {2} rejected\n'.format(
+        sum(loader.counts.values()), len(loader.counts), loader.rejected))
@@ -0,0 +1,217 @@
+# Copyright (c) 2010 Matt Harrison
+'''
+VACUUM and ANALYZE only the partitions that need it.  The statistics
+Postgres keeps for each child (pg_stat_user_tables) give its dead rows
+and the rows changed since it was last analyzed.  Children over the
+policy's thresholds are maintained, the furthest over first, and cold
+partitions that haven't changed are skipped.
+
+>>> import datetime as dt
+>>> analyzed = dt.datetime(2013, 1, 1)
+>>> stats = [TableStats('t_0', 100000, 50, 0, analyzed),
+...          TableStats('t_1', 100000, 30000, 40000, None),
+...          TableStats('t_2', 1000, 5000, 10, analyzed),
+...          TableStats('t_3', 50000, 0, 9000, analyzed)]
+>>> tasks = plan(stats, MaintenancePolicy())
+>>> for task in tasks:
+...     print task_sql(task), round(task.priority, 2)
+VACUUM t_2; 20.0
+VACUUM ANALYZE t_1; 3.98
+ANALYZE t_3; 1.78
+'''
+from collections import namedtuple
+import optparse
+import sys
+import time
+
+import pgpartitionlib
+
+# last_analyze is the latest of the manual and auto runs
+TableStats = namedtuple('TableStats', ['table_name', 'live', 'dead',
+                                       'modified', 'last_analyze'])
+
+Task = namedtuple('Task', ['table_name', 'vacuum', 'analyze', 'priority',
+                           'stats'])
+
+Done = namedtuple('Done', ['task', 'seconds', 'error'])
+
+# the names are looked up like the ddl created them (on the search_path)
+# so a table of the same name in another schema isn't picked up
+STATS_SQL = """SELECT t.name, s.n_live_tup, s.n_dead_tup, s.n_mod_since_analyze,
+    greatest(s.last_analyze, s.last_autoanalyze)
+FROM unnest(%s::text[]) AS t(name)
+JOIN pg_stat_user_tables s ON s.relid = to_regclass(t.name);"""
+
+
+class MaintenancePolicy(object):
+    """
+    Like autovacuum, a child is vacuumed when its dead rows exceed
+    dead_min + dead_fraction * live rows and analyzed when the rows
+    modified since the last analyze exceed analyze_min +
+    analyze_fraction * live rows (or it has never been analyzed).  The
+    defaults are autovacuum's.
+    """
+    def __init__(self, dead_min=50, dead_fraction=0.2, analyze_min=50,
+                 analyze_fraction=0.1):
+        self.dead_min = dead_min
+        self.dead_fraction = dead_fraction
+        self.analyze_min = analyze_min
+        self.analyze_fraction = analyze_fraction
+
+    def task(self, stats):
+        """
+        Task for a child (None if it doesn't need anything), the
+        priority is how many times over its threshold it is
+        """
+        vacuum = float(stats.dead) / (self.dead_min +
+                                      self.dead_fraction * stats.live)
+        analyze = float(stats.modified) / (self.analyze_min +
+                                           self.analyze_fraction * stats.live)
+        if stats.last_analyze is None and stats.live:
+            analyze = max(analyze, 1.0)
+        if vacuum <= 1 and analyze <= 1:
+            return None
+        return Task(stats.table_name, vacuum > 1, analyze > 1,
+                    max(vacuum, analyze), stats)
+
+
+def partition_stats(conn, partitioner):
+    """
+    TableStats for the children of partitioner (the leaves of a
+    SubPartitioner) that exist
+    """
+    table_names = list(partitioner.iter_sql('{table_name}'))
+    cur = conn.cursor()
+    cur.execute(STATS_SQL, (table_names,))
+    return [TableStats(*row) for row in cur.fetchall()]
+
+
+def plan(stats, policy):
+    """
+    Tasks for the children that need them, most urgent first
+    """
+    tasks = [task for task in (policy.task(s) for s in stats) if task]
+    tasks.sort(key=lambda task: (-task.priority, task.table_name))
+    return tasks
+
+
+def action(task):
+    """
+    >>> action(Task('t_0', True, True, 2.0, None))
+    'VACUUM ANALYZE'
+    """
+    words = []
+    if task.vacuum:
+        words.append('VACUUM')
+    if task.analyze:
+        words.append('ANALYZE')
+    return ' '.join(words)
+
+
+def task_sql(task):
+    """
+    >>> print task_sql(Task('t_0', True, False, 2.0, None))
+    VACUUM t_0;
+    """
+    return '{0} {1};'.format(action(task), task.table_name)
+
+
+def run(tasks, conn, budget=None, report=None):
+    """
+    Run tasks in order on conn (which must be in autocommit mode, VACUUM
+    can't run in a transaction), returns a Done for each task run.  No
+    task is started once budget seconds have passed (a running one
+    isn't interrupted).  A failing task is recorded and the rest still
+    run.
+
+    report - function called with each Done as it finishes
+    """
+    import psycopg2
+    started = time.time()
+    cur = conn.cursor()
+    done = []
+    for task in tasks:
+        if budget is not None and time.time() - started >= budget:
+            break
+        task_started = time.time()
+        error = None
+        try:
+            cur.execute(task_sql(task))
+        except psycopg2.Error, e:
+            if conn.closed:
+                raise
+            error = str(e).strip()
+        result = Done(task, time.time() - task_started, error)
+        done.append(result)
+        if report:
+            report(result)
+    return done
+
+
+def format_task(task):
+    """
+    >>> print format_task(Task('t_1', True, True, 3.98, TableStats('t_1', 100000, 30000, 40000, None)))
+    t_1: VACUUM ANALYZE, 30000 dead, 40000 modified of 100000 rows (3.98x threshold)
+    """
+    return ('{0}: {1}, {2} dead, {3} modified of {4} rows '
+            '({5:.2f}x threshold)'.format(task.table_name, action(task),
+                                          task.stats.dead, task.stats.modified,
+                                          task.stats.live, task.priority))
+
+
+def format_done(done):
+    """
+    >>> print format_done(Done(Task('t_0', True, False, 2.0, None), 1.5, None))
+    VACUUM t_0; 1.50s
+    """
+    if done.error:
+        return '{0} FAILED ({1:.2f}s): {2}'.format(task_sql(done.task),
+                                                  done.seconds, done.error)
+    return '{0} {1:.2f}s'.format(task_sql(done.task), done.seconds)
+
+
+def main(prog_args):
+    parser = optparse.OptionParser(
+        usage='%prog maintain [options]',
+        description='VACUUM/ANALYZE the partitions over the thresholds, '
+                    'most urgent first')
+    pgpartitionlib.add_partitioner_options(parser)
+    parser.add_option('--dsn', help='database to read the statistics from [REQ]')
+    parser.add_option('--dead-min', type='int', default=50, help='dead rows a partition can have before it is vacuumed, plus --dead-fraction of its rows, defaults to 50')
+    parser.add_option('--dead-fraction', type='float', default=0.2, help='defaults to 0.2')
+    parser.add_option('--analyze-min', type='int', default=50, help='rows modified before a partition is analyzed, plus --analyze-fraction of its rows, defaults to 50')
+    parser.add_option('--analyze-fraction', type='float', default=0.1, help='defaults to 0.1')
+    parser.add_option('--budget', type='float', metavar='SECONDS', help="with --apply, don't start any more maintenance after this many seconds")
+    parser.add_option('--apply', action='store_true', help='run the maintenance against --dsn rather than printing it')
+
+    opt, args = parser.parse_args(prog_args)
+    p = pgpartitionlib.partitioner_from_options(opt, cache_chunks=False)
+    if p is None or not opt.dsn:
+        parser.print_help()
+        return 1
+
+    import db
+    policy = MaintenancePolicy(opt.dead_min, opt.dead_fraction,
+                               opt.analyze_min, opt.analyze_fraction)
+    conn = db.connect(opt.dsn, autocommit=True)
+    try:
+        tasks = plan(partition_stats(conn, p), policy)
+        for task in tasks:
+            sys.stderr.write(format_task(task) + '\n')
+        if not opt.apply:
+            pgpartitionlib.write_sql(sys.stdout,
+                                     (task_sql(task) for task in tasks))
+            return
+
+        def report(done):
+            sys.stderr.write(format_done(done) + '\n')
+        done = run(tasks, conn, opt.budget, report)
+    finally:
+        conn.close()
+    failed = [d for d in done if d.error]
+    sys.stderr.write('{0} partitions maintained, {1} failed, {2} left for '
+                     'the next run\n'.format(len(done) - len(failed),
+                                             len(failed),
+                                             len(tasks) - len(done)))
+    if failed:
+        return 1
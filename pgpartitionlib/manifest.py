@@ -0,0 +1,299 @@
+# Copyright (c) 2010 Matt Harrison
+'''
+Generate the sql for many master tables in one run from a manifest of
+table specs, spread over a pool of processes.  A manifest is JSON or
+YAML (a list of specs, or {"defaults": {...}, "tables": [...]}) or INI
+(a section per table, [DEFAULT] for the defaults).  A spec has:
+
+  table - the master table (the section name in INI)
+  type - one of pgpartitionlib.PARTITION_TYPES, defaults to int
+  column, start, end, stride, bounds (arbitrary), modulus (hash)
+  index_columns - a list of indexes, each a list of columns (in INI
+    "key; key,junk") or, in JSON/YAML, an object of IndexSpec arguments
+    (ie {"columns": ["created"], "method": "brin"})
+  routing, declarative, on_miss - as for the partitioner
+  master_columns - column definitions for the master action
+  concurrently - create the indexes concurrently
+  actions - what to generate, any of pgpartitionlib.ACTIONS (output in
+    that order), defaults to create, function, trigger and indexes
+
+>>> specs = parse_manifest("""
+... [DEFAULT]
+... column = key
+... actions = create, trigger
+...
+... [orders]
+... start = 0
+... end = 2
+...
+... [events]
+... type = month
+... column = created
+... start = 2024-01
+... end = 2024-02
+... index_columns = created; tenant_id,created
+... """, 'ini')
+>>> [(spec['table'], spec['type']) for spec in specs]
+[('orders', 'int'), ('events', 'month')]
+>>> specs[1]['index_columns']
+[['created'], ['tenant_id', 'created']]
+>>> print render(specs[0]).text
+CREATE TABLE orders_0 (
+    CHECK ( key >= 0 AND key < 1 )
+) INHERITS (orders);
+CREATE TABLE orders_1 (
+    CHECK ( key >= 1 AND key < 2 )
+) INHERITS (orders);
+CREATE TRIGGER insert_orders_trigger
+    BEFORE INSERT ON orders
+    FOR EACH ROW EXECUTE PROCEDURE orders_insert_function();
+<BLANKLINE>
+'''
+from collections import namedtuple
+import ConfigParser
+import json
+import multiprocessing
+import optparse
+import os
+import StringIO
+import sys
+import time
+
+import pgpartitionlib
+
+DEFAULT_ACTIONS = ['create', 'function', 'trigger', 'indexes']
+
+BOOLEANS = {'1': True, 'yes': True, 'true': True, 'on': True,
+            '0': False, 'no': False, 'false': False, 'off': False}
+
+# text - the script (None if it was written to path), error - why the
+#   table failed
+Script = namedtuple('Script', ['table', 'text', 'path', 'statements',
+                               'seconds', 'error'])
+
+
+def parse_manifest(text, fmt):
+    """
+    The table specs (normalized dicts, in table order) of a manifest in
+    fmt ('json', 'yaml' or 'ini')
+    """
+    if fmt == 'ini':
+        parser = ConfigParser.RawConfigParser()
+        parser.readfp(StringIO.StringIO(text))
+        defaults = {}
+        tables = [dict(parser.items(section), table=section)
+                  for section in parser.sections()]
+    else:
+        if fmt == 'json':
+            data = json.loads(text)
+        elif fmt == 'yaml':
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError('YAML manifests need PyYAML')
+            data = yaml.safe_load(text)
+        else:
+            raise ValueError('Unknown manifest format {0!r}'.format(fmt))
+        if isinstance(data, list):
+            data = {'tables': data}
+        defaults = data.get('defaults') or {}
+        tables = data.get('tables') or []
+    specs = [normalize(dict(defaults, **table)) for table in tables]
+    names = [spec['table'] for spec in specs]
+    duplicates = sorted(set(name for name in names if names.count(name) > 1))
+    if duplicates:
+        raise ValueError('Tables in the manifest more than once: {0}'.format(
+            ', '.join(duplicates)))
+    return specs
+
+
+def load_manifest(path):
+    """
+    The table specs in the manifest file path (the format is from the
+    extension: .json, .yaml/.yml or .ini/.cfg)
+    """
+    ext = os.path.splitext(path)[1].lower()
+    fmt = {'.json': 'json', '.yaml': 'yaml', '.yml': 'yaml', '.ini': 'ini',
+           '.cfg': 'ini'}.get(ext)
+    if fmt is None:
+        raise ValueError('Unknown manifest format {0}'.format(path))
+    fin = open(path)
+    try:
+        return parse_manifest(fin.read(), fmt)
+    finally:
+        fin.close()
+
+
+def _split(value, sep=','):
+    if isinstance(value, basestring):
+        return [item.strip() for item in value.split(sep) if item.strip()]
+    return list(value)
+
+
+def _boolean(value):
+    if isinstance(value, basestring):
+        try:
+            return BOOLEANS[value.strip().lower()]
+        except KeyError:
+            raise ValueError('Not a boolean: {0!r}'.format(value))
+    return bool(value)
+
+
+def normalize(spec):
+    """
+    spec with the INI strings turned into lists and booleans and the
+    defaults filled in
+    >>> spec = normalize({'table': 't', 'column': 'key', 'bounds': '0, 10'})
+    >>> spec['bounds'], spec['actions'], spec['declarative']
+    (['0', '10'], ['create', 'function', 'trigger', 'indexes'], False)
+    """
+    spec = dict(spec)
+    if not spec.get('table') or not spec.get('column'):
+        raise ValueError('Every table needs a table and column: {0!r}'.format(
+            spec))
+    spec.setdefault('type', 'int')
+    spec['actions'] = _split(spec.get('actions') or DEFAULT_ACTIONS)
+    if spec.get('bounds'):
+        spec['bounds'] = _split(spec['bounds'])
+    if spec.get('index_columns'):
+        spec['index_columns'] = [
+            index if isinstance(index, dict) else _split(index)
+            for index in _split(spec['index_columns'], ';')]
+    for name in ('declarative', 'concurrently'):
+        spec[name] = _boolean(spec.get(name, False))
+    return spec
+
+
+def partitioner(spec):
+    kw = dict(declarative=spec['declarative'],
+              index_columns_list=spec.get('index_columns') or None,
+              # each statement is written once
+              cache_chunks=False)
+    for name in ('routing', 'on_miss'):
+        if spec.get(name):
+            kw[name] = spec[name]
+    return pgpartitionlib.make_partitioner(
+        spec['type'], spec['table'], spec['column'], spec.get('start'),
+        spec.get('end'), spec.get('stride', 1), bounds=spec.get('bounds'),
+        modulus=spec.get('modulus'), **kw)
+
+
+def render(spec, out_dir=None):
+    """
+    Generate the script of one table, written to out_dir/TABLE.sql if
+    out_dir is given.  Returns a Script, errors are recorded in it rather
+    than raised (so one bad table doesn't stop the rest).
+    """
+    started = time.time()
+    path = None
+    statements = 0
+    try:
+        p = partitioner(spec)
+        if out_dir:
+            path = os.path.join(out_dir, spec['table'] + '.sql')
+            out = open(path, 'w')
+        else:
+            out = StringIO.StringIO()
+        try:
+            for name, stmts in pgpartitionlib.iter_phases(
+                    p, spec['actions'], spec.get('master_columns'),
+                    spec['concurrently']):
+                pieces = 0
+                for stmt in stmts:
+                    out.write(stmt)
+                    out.write('\n')
+                    pieces += 1
+                if name in pgpartitionlib.SINGLE_STATEMENT_PHASES:
+                    pieces = min(pieces, 1)
+                statements += pieces
+            text = None if out_dir else out.getvalue()
+        finally:
+            out.close()
+    except (ValueError, TypeError, EnvironmentError), e:
+        return Script(spec['table'], None, path, statements,
+                      time.time() - started, str(e))
+    return Script(spec['table'], text, path, statements,
+                  time.time() - started, None)
+
+
+def _render(args):
+    # Pool.imap passes one argument
+    return render(*args)
+
+
+def iter_scripts(specs, jobs=None, out_dir=None):
+    """
+    yield a Script for each spec, in order, rendering up to jobs (the
+    number of cpus by default) at once in separate processes
+    """
+    args = [(spec, out_dir) for spec in specs]
+    if jobs == 1 or len(specs) < 2:
+        for script in map(_render, args):
+            yield script
+        return
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for script in pool.imap(_render, args):
+            yield script
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def format_script(script):
+    """
+    >>> print format_script(Script('orders', None, 'out/orders.sql', 40, 0.5, None))
+    orders: 40 statements, 0.50s -> out/orders.sql
+    """
+    if script.error:
+        return '{0}: FAILED {1}'.format(script.table, script.error)
+    return '{0}: {1} statements, {2:.2f}s{3}'.format(
+        script.table, script.statements, script.seconds,
+        ' -> ' + script.path if script.path else '')
+
+
+def main(prog_args):
+    parser = optparse.OptionParser(
+        usage='%prog manifest [options] MANIFEST',
+        description='Generate the sql for every table in a manifest '
+                    '(.json, .yaml or .ini)')
+    parser.add_option('-o', '--output', help='write one combined script here (- for stdout, the default)')
+    parser.add_option('-d', '--output-dir', help='write a script per table (DIR/TABLE.sql) instead')
+    parser.add_option('-j', '--jobs', type='int', help='processes generating at once, defaults to the number of cpus')
+    parser.add_option('--table', action='append', help='only this table (can be repeated)')
+
+    opt, args = parser.parse_args(prog_args[1:])
+    if len(args) != 1:
+        parser.print_help()
+        return 1
+    specs = load_manifest(args[0])
+    if opt.table:
+        missing = set(opt.table) - set(spec['table'] for spec in specs)
+        if missing:
+            sys.stderr.write('Not in the manifest: {0}\n'.format(
+                ', '.join(sorted(missing))))
+            return 1
+        specs = [spec for spec in specs if spec['table'] in opt.table]
+    if opt.output_dir and not os.path.isdir(opt.output_dir):
+        os.makedirs(opt.output_dir)
+    if opt.output and opt.output != '-' and not opt.output_dir:
+        out = open(opt.output, 'w')
+    else:
+        out = sys.stdout
+    started = time.time()
+    failed = 0
+    try:
+        for script in iter_scripts(specs, opt.jobs, opt.output_dir):
+            sys.stderr.write(format_script(script) + '\n')
+            if script.error:
+                failed += 1
+            elif script.text is not None:
+                out.write(script.text)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    sys.stderr.write('{0} tables, {1} failed in {2:.2f}s\n'.format(
+        len(specs), failed, time.time() - started))
+    if failed:
+        return 1
@@ -0,0 +1,226 @@
+# Copyright (c) 2010 Matt Harrison
+'''
+Move the rows already in a master table into its new children, a
+batch at a time.  Each batch is one short transaction that deletes up
+to batch_size rows of a chunk from ONLY the master and inserts them in
+the child, so no lock is held for long and the table stays online.
+Batches walk the chunk in order of a key column (the partitioning
+column by default), starting each one where the last ended rather than
+scanning the rows already moved again.  A checkpoint file records the
+progress after every batch so an interrupted run picks up where it
+stopped.
+
+>>> p = pgpartitionlib.IntPartitioner('test_part', 'key', 0, 20, 10)
+>>> for table_name, condition in iter_chunks(p):
+...     print table_name, condition
+test_part_0 key >= 0 AND key < 10
+test_part_10 key >= 10 AND key < 20
+>>> print move_sql('test_part', 'test_part_10', 'key >= 10 AND key < 20',
+...                'key', 1000, keyset=True)
+WITH moved AS (
+    DELETE FROM ONLY test_part WHERE ctid = ANY(ARRAY(
+        SELECT ctid FROM ONLY test_part
+        WHERE key >= 10 AND key < 20 AND key >= %s
+        ORDER BY key
+        LIMIT 1000))
+    RETURNING *
+), inserted AS (
+    INSERT INTO test_part_10 SELECT * FROM moved
+)
+SELECT count(*), max(key) FROM moved;
+'''
+from collections import namedtuple
+import itertools
+import json
+import optparse
+import os
+import sys
+import time
+
+import pgpartitionlib
+import db
+
+Batch = namedtuple('Batch', ['table_name', 'rows', 'last_key', 'seconds'])
+
+
+def iter_chunks(partitioner):
+    """
+    yield (table_name, sql condition for its rows) for each child
+    """
+    return itertools.izip(
+        partitioner.iter_sql('{table_name}'),
+        partitioner.iter_sql(partitioner.chunk_condition))
+
+
+def move_sql(source, table_name, condition, key, batch_size, keyset=False):
+    """
+    Statement moving a batch, with keyset it takes the key to start at
+    (the rows before it have already been moved) as a parameter, so any
+    % in the condition is doubled for psycopg2.  Selecting the rows by
+    ctid keeps the DELETE to a TID scan of the batch.
+    >>> p = pgpartitionlib.HashPartitioner('test_hash', 'id', 3)
+    >>> table_name, condition = next(iter_chunks(p))
+    >>> stmt = move_sql('test_hash', table_name, condition, 'id', 1000,
+    ...                 keyset=True)
+    >>> print (stmt % (42,)).splitlines()[3].strip()
+    WHERE (hashtext(id::text) & 2147483647) % 3 = 0 AND id >= 42
+    """
+    if keyset:
+        condition = '{0} AND {1} >= %s'.format(condition.replace('%', '%%'),
+                                               key)
+    return """WITH moved AS (
+    DELETE FROM ONLY {source} WHERE ctid = ANY(ARRAY(
+        SELECT ctid FROM ONLY {source}
+        WHERE {condition}
+        ORDER BY {key}
+        LIMIT {batch_size}))
+    RETURNING *
+), inserted AS (
+    INSERT INTO {table_name} SELECT * FROM moved
+)
+SELECT count(*), max({key}) FROM moved;""".format(
+        source=source, table_name=table_name, condition=condition, key=key,
+        batch_size=batch_size)
+
+
+def move_all_sql(source, table_name, condition):
+    """
+    Statement moving every row at once (for a script)
+    """
+    return """WITH moved AS (
+    DELETE FROM ONLY {0} WHERE {1}
+    RETURNING *
+)
+INSERT INTO {2} SELECT * FROM moved;""".format(source, condition, table_name)
+
+
+def load_checkpoint(path):
+    """
+    The progress recorded in path ({} if it doesn't exist yet)
+    """
+    if not path or not os.path.exists(path):
+        return {}
+    fin = open(path)
+    try:
+        return json.load(fin)
+    finally:
+        fin.close()
+
+
+def save_checkpoint(path, checkpoint):
+    # write then rename, so a crash never leaves half a file
+    tmp = path + '.tmp'
+    fout = open(tmp, 'w')
+    try:
+        json.dump(checkpoint, fout, indent=1, sort_keys=True, default=str)
+    finally:
+        fout.close()
+    os.rename(tmp, path)
+
+
+def migrate(partitioner, conn, key=None, source=None, batch_size=10000,
+            sleep=0, checkpoint=None, retries=2, retry_wait=5, report=None):
+    """
+    Move the rows of each chunk from source (the master by default) to
+    its child, returns {table_name: rows moved} for this run.
+
+    key - column the batches are ordered by (an indexed one, defaults to
+      the partitioning column)
+    sleep - seconds to wait between batches
+    checkpoint - path of the checkpoint file
+    retries - times to retry a batch after a transient error (ie a
+      lock_timeout)
+    report - function called with a Batch after each batch
+    """
+    import psycopg2
+    key = key or partitioner.column
+    source = source or partitioner.table_name
+    state = load_checkpoint(checkpoint)
+    if state and state.get('source') != source:
+        raise ValueError('Checkpoint {0} is for {1}, not {2}'.format(
+            checkpoint, state.get('source'), source))
+    state.setdefault('source', source)
+    state.setdefault('done', {})
+    moved = {}
+    cur = conn.cursor()
+    for table_name, condition in iter_chunks(partitioner):
+        if table_name in state['done']:
+            continue
+        last = None
+        if state.get('table_name') == table_name:
+            last = state.get('last_key')
+        total = 0
+        while True:
+            started = time.time()
+            stmt = move_sql(source, table_name, condition, key, batch_size,
+                            keyset=last is not None)
+            attempt = 0
+            while True:
+                attempt += 1
+                try:
+                    cur.execute(stmt, (last,) if last is not None else None)
+                    rows, batch_last = cur.fetchone()
+                    conn.commit()
+                    break
+                except psycopg2.Error, e:
+                    conn.rollback()
+                    if attempt > retries or not db.is_transient(e):
+                        raise
+                    time.sleep(retry_wait)
+            total += rows
+            if batch_last is not None:
+                last = batch_last
+            if checkpoint:
+                state.update(table_name=table_name, last_key=last)
+                if rows < batch_size:
+                    state['done'][table_name] = total
+                save_checkpoint(checkpoint, state)
+            if report:
+                report(Batch(table_name, rows, last, time.time() - started))
+            if rows < batch_size:
+                break
+            if sleep:
+                time.sleep(sleep)
+        moved[table_name] = total
+    return moved
+
+
+def main(prog_args):
+    parser = optparse.OptionParser(
+        usage='%prog migrate [options]',
+        description='Move the rows in the master table into its partitions '
+                    'in small batches')
+    pgpartitionlib.add_partitioner_options(parser)
+    parser.add_option('--dsn', help='database to migrate [REQ]')
+    parser.add_option('--key', help='indexed column to walk each partition in order of, defaults to --column')
+    parser.add_option('--source', help='table to move the rows from, defaults to --master-table')
+    parser.add_option('--batch-size', type='int', default=10000, help='rows moved per transaction, defaults to 10000')
+    parser.add_option('--sleep', type='float', default=0, help='seconds to wait between batches, defaults to 0')
+    parser.add_option('--checkpoint', metavar='FILE', help='record progress here and resume from it')
+    parser.add_option('--lock-timeout', help='give up (and retry) a batch waiting longer than this for a lock (ie 2s)')
+    parser.add_option('-q', '--quiet', action='store_true', help="don't report each batch")
+
+    opt, args = parser.parse_args(prog_args)
+    p = pgpartitionlib.partitioner_from_options(opt, cache_chunks=False)
+    if p is None or not opt.dsn:
+        parser.print_help()
+        return 1
+
+    def report(batch):
+        if not opt.quiet:
+            sys.stderr.write('{0}: {1} rows up to {2} ({3:.2f}s)\n'.format(
+                batch.table_name, batch.rows, batch.last_key, batch.seconds))
+    settings = {}
+    if opt.lock_timeout:
+        settings['lock_timeout'] = opt.lock_timeout
+    conn = db.connect(opt.dsn, settings=settings)
+    try:
+        started = time.time()
+        moved = migrate(p, conn, opt.key, opt.source, opt.batch_size,
+                        opt.sleep, opt.checkpoint, report=report)
+    finally:
+        conn.close()
+    sys.stderr.write('{0} rows moved to {1} partitions in {2:.2f}s, VACUUM '
+                     '{3} to reclaim the space\n'.format(
+                         sum(moved.values()), len(moved),
+                         time.time() - started, opt.source or p.table_name))
@@ -0,0 +1,247 @@
+# Copyright (c) 2010 Matt Harrison
+'''
+Split a busy integer partition into several, or merge small neighbours
+into one, without repartitioning the whole table.  The old tables are
+renamed out of the way, the new children (with their CHECKs and
+indexes) and the insert function are created in one transaction, then
+the rows are moved over in batches and the old tables dropped.
+
+With inheritance the old tables stay children of the master while their
+rows move, so queries see every row throughout.  Declarative partitions
+can't overlap, so the old ones are detached first and their rows are
+only visible again once moved.
+
+>>> p = pgpartitionlib.IntPartitioner('test_part', 'key', 0, 30, 10)
+>>> r = split(p, 'test_part_10', [15])
+>>> r.partitioner.chunker.nums
+[0, 10, 15, 20, 30]
+>>> for stmt in iter_sql(r):
+...     print stmt # doctest: +ELLIPSIS
+ALTER TABLE test_part_10 RENAME TO test_part_10_split;
+ALTER INDEX IF EXISTS test_part_10_0_index RENAME TO test_part_10_split_0_index;
+CREATE TABLE test_part_10 (
+    CHECK ( key >= 10 AND key < 15 )
+) INHERITS (test_part);
+CREATE TABLE test_part_15 (
+    CHECK ( key >= 15 AND key < 20 )
+) INHERITS (test_part);
+CREATE INDEX test_part_10_0_index ON test_part_10 (key);
+CREATE INDEX test_part_15_0_index ON test_part_15 (key);
+CREATE OR REPLACE FUNCTION test_part_insert_function()
+...
+LANGUAGE plpgsql;
+WITH moved AS (
+    DELETE FROM ONLY test_part_10_split WHERE key >= 10 AND key < 15
+    RETURNING *
+)
+INSERT INTO test_part_10 SELECT * FROM moved;
+WITH moved AS (
+    DELETE FROM ONLY test_part_10_split WHERE key >= 15 AND key < 20
+    RETURNING *
+)
+INSERT INTO test_part_15 SELECT * FROM moved;
+DROP TABLE test_part_10_split;
+>>> merge(p, ['test_part_10', 'test_part_20']).moves
+[('test_part_10_merge', 'test_part_10'), ('test_part_20', 'test_part_10')]
+'''
+from collections import namedtuple
+import copy
+import optparse
+import sys
+
+import pgpartitionlib
+import db
+import migrate
+
+# detached - children of the old layout to take out of a declarative
+#   master, renames - (table, its new name) pairs, moves - (source,
+#   target) pairs, dropped - tables dropped once empty
+Rebalance = namedtuple('Rebalance', ['partitioner', 'detached', 'renames',
+                                     'created', 'moves', 'dropped'])
+
+
+def _bounds(partitioner):
+    table = partitioner.chunk_table()
+    nums = list(table.starts) + list(table.ends[-1:])
+    if (partitioner.strategy != 'RANGE' or
+        not all(isinstance(num, (int, long)) for num in nums)):
+        raise ValueError('Only integer range partitions can be split or '
+                         'merged')
+    if list(table.ends[:-1]) != list(table.starts[1:]):
+        raise ValueError('Partitions of {0} have gaps'.format(
+            partitioner.table_name))
+    return table, nums
+
+
+def _position(table, table_name):
+    try:
+        return table.table_names.index(table_name)
+    except ValueError:
+        raise ValueError('No partition {0}'.format(table_name))
+
+
+def _with_bounds(partitioner, nums):
+    p = copy.copy(partitioner)
+    p.chunker = pgpartitionlib.ArbitraryIntChunker(nums)
+    p._chunk_table = None
+    if p.routing == 'arithmetic':
+        # the stride isn't constant any more
+        p.routing = 'tree'
+    return p
+
+
+def split(partitioner, table_name, at):
+    """
+    Split the child table_name at each of the values in at
+    """
+    table, nums = _bounds(partitioner)
+    i = _position(table, table_name)
+    at = pgpartitionlib.boundaries(at)
+    if not at or at[0] <= table.starts[i] or at[-1] >= table.ends[i]:
+        raise ValueError('Split points must be inside {0} ({1} to {2})'.format(
+            table_name, table.starts[i], table.ends[i]))
+    p = _with_bounds(partitioner, pgpartitionlib.boundaries(nums + at))
+    old = table_name + '_split'
+    created = [partitioner.table_name + '_{0}'.format(num)
+               for num in [table.starts[i]] + at]
+    return Rebalance(p, [table_name], [(table_name, old)], created,
+                     [(old, name) for name in created], [old])
+
+
+def merge(partitioner, table_names):
+    """
+    Merge the neighbouring children table_names into one
+    """
+    table, nums = _bounds(partitioner)
+    positions = sorted(_position(table, name) for name in table_names)
+    if (len(positions) < 2 or
+        positions != range(positions[0], positions[-1] + 1)):
+        raise ValueError('Can only merge two or more neighbouring partitions')
+    merged = set(table.starts[i] for i in positions[1:])
+    p = _with_bounds(partitioner, [num for num in nums if num not in merged])
+    target = table.table_names[positions[0]]
+    old = target + '_merge'
+    sources = [old] + [table.table_names[i] for i in positions[1:]]
+    return Rebalance(p, [table.table_names[i] for i in positions],
+                     [(target, old)], [target],
+                     [(source, target) for source in sources], sources)
+
+
+def iter_prepare_ddl(r):
+    """
+    Rename the old tables, create the new children, their indexes and
+    the insert function (run in one transaction)
+    """
+    p = r.partitioner
+    if p.declarative:
+        for table_name in r.detached:
+            yield p.detach_ddl(table_name)
+    for table_name, new_name in r.renames:
+        yield 'ALTER TABLE {0} RENAME TO {1};'.format(table_name, new_name)
+        if not p.declarative:
+            for (index_name, _), (new_index_name, _) in zip(
+                    p._index_items(table_name), p._index_items(new_name)):
+                yield 'ALTER INDEX IF EXISTS {0} RENAME TO {1};'.format(
+                    index_name, new_index_name)
+    created = p.only(r.created)
+    for stmt in created.iter_create_ddl():
+        yield stmt
+    if not p.declarative:
+        for stmt in created.iter_create_idx_ddl():
+            yield stmt
+        yield p.function_code()
+
+
+def iter_move_sql(r):
+    """
+    Move all the rows at once (apply moves them in batches)
+    """
+    for source, target in r.moves:
+        for table_name, condition in migrate.iter_chunks(
+                r.partitioner.only([target])):
+            yield migrate.move_all_sql(source, table_name, condition)
+
+
+def iter_finish_ddl(r):
+    for table_name in r.dropped:
+        yield 'DROP TABLE {0};'.format(table_name)
+
+
+def iter_sql(r):
+    for stmts in (iter_prepare_ddl(r), iter_move_sql(r), iter_finish_ddl(r)):
+        for stmt in stmts:
+            yield stmt
+
+
+def apply(r, conn, batch_size=10000, sleep=0, report=None):
+    """
+    Run the rebalance on conn, moving the rows in batches (see
+    migrate.migrate).  Running it again after an interruption skips the
+    steps already done.  Returns {table_name: rows moved}.
+    """
+    cur = conn.cursor()
+    cur.execute('SELECT to_regclass(%s);', (r.renames[0][1],))
+    if cur.fetchone()[0] is None:
+        try:
+            for stmt in iter_prepare_ddl(r):
+                cur.execute(stmt)
+        except:
+            conn.rollback()
+            raise
+        conn.commit()
+    moved = {}
+    for source, target in r.moves:
+        cur.execute('SELECT to_regclass(%s);', (source,))
+        if cur.fetchone()[0] is None:
+            continue
+        for table_name, rows in migrate.migrate(
+                r.partitioner.only([target]), conn, source=source,
+                batch_size=batch_size, sleep=sleep, report=report).items():
+            moved[table_name] = moved.get(table_name, 0) + rows
+    try:
+        for table_name in r.dropped:
+            cur.execute('DROP TABLE IF EXISTS {0};'.format(table_name))
+    except:
+        conn.rollback()
+        raise
+    conn.commit()
+    return moved
+
+
+def main(prog_args):
+    parser = optparse.OptionParser(
+        usage='%prog rebalance [options]',
+        description='Split an integer partition or merge neighbouring ones')
+    pgpartitionlib.add_partitioner_options(parser)
+    parser.add_option('--declarative', action='store_true', help='the master table uses declarative partitioning')
+    parser.add_option('--split', metavar='TABLE', help='partition to split')
+    parser.add_option('--at', help='values to split at (ie 150,175)')
+    parser.add_option('--merge', metavar='TABLES', help='neighbouring partitions to merge (ie t_0,t_10)')
+    parser.add_option('--dsn', help='run the rebalance in this database rather than printing the sql')
+    parser.add_option('--batch-size', type='int', default=10000, help='rows moved per transaction with --dsn, defaults to 10000')
+    parser.add_option('--sleep', type='float', default=0, help='seconds to wait between batches, defaults to 0')
+
+    opt, args = parser.parse_args(prog_args)
+    p = pgpartitionlib.partitioner_from_options(opt,
+                                                declarative=opt.declarative)
+    if p is None or bool(opt.split) == bool(opt.merge) or (
+            opt.split and not opt.at):
+        parser.print_help()
+        return 1
+    if opt.split:
+        r = split(p, opt.split, [int(num) for num in opt.at.split(',')])
+    else:
+        r = merge(p, opt.merge.split(','))
+    if opt.dsn:
+        def report(batch):
+            sys.stderr.write('{0}: {1} rows moved\n'.format(batch.table_name,
+                                                            batch.rows))
+        conn = db.connect(opt.dsn)
+        try:
+            apply(r, conn, opt.batch_size, opt.sleep, report)
+        finally:
+            conn.close()
+    else:
+        pgpartitionlib.write_sql(sys.stdout, iter_sql(r))
+    sys.stderr.write('partitions are now --bounds {0}\n'.format(
+        ','.join(str(num) for num in r.partitioner.chunker.nums)))
@@ -0,0 +1,244 @@
+# Copyright (c) 2010 Matt Harrison
+'''
+Rolling window maintenance for time partitioned tables.  Given a
+policy (ie keep 24 months, create 3 months ahead, or 90 days and 7
+ahead) and the children that exist, one run creates the partitions
+coming up, replaces the insert function for the new window and
+detaches/drops the partitions that have aged out.  Running it again
+for the same month does nothing, so it can run from cron.
+
+>>> policy = RetentionPolicy(keep=3, ahead=1)
+>>> existing = [diff.Child('test_month_2012-09', '2012-09-01', '2012-10-01'),
+...             diff.Child('test_month_2012-10', '2012-10-01', '2012-11-01'),
+...             diff.Child('test_month_2012-11', '2012-11-01', '2012-12-01'),
+...             diff.Child('test_month_2012-12', '2012-12-01', '2013-01-01')]
+>>> pl = plan('test_month', 'date', policy, existing, today=dt.date(2013, 1, 9))
+>>> print report(pl)
+window: 2012-11 to 2013-03
+create: test_month_2013-01, test_month_2013-02
+keep: test_month_2012-11, test_month_2012-12
+drop: test_month_2012-09, test_month_2012-10
+>>> for stmt in iter_plan_ddl(pl):
+...     print stmt # doctest: +ELLIPSIS
+CREATE TABLE test_month_2013-01 (
+    CHECK ( date >= '2013-01-01' AND date < '2013-02-01' )
+) INHERITS (test_month);
+CREATE TABLE test_month_2013-02 (
+    CHECK ( date >= '2013-02-01' AND date < '2013-03-01' )
+) INHERITS (test_month);
+CREATE INDEX test_month_2013-01_0_index ON test_month_2013-01 (date);
+CREATE INDEX test_month_2013-02_0_index ON test_month_2013-02 (date);
+CREATE OR REPLACE FUNCTION test_month_insert_function()
+...
+LANGUAGE plpgsql;
+ALTER TABLE test_month_2012-09 NO INHERIT test_month;
+DROP TABLE test_month_2012-09;
+ALTER TABLE test_month_2012-10 NO INHERIT test_month;
+DROP TABLE test_month_2012-10;
+'''
+from collections import namedtuple
+import datetime as dt
+import optparse
+import sys
+
+import pgpartitionlib
+import diff
+
+Plan = namedtuple('Plan', ['partitioner', 'diff', 'expired', 'policy'])
+
+
+class RetentionPolicy(object):
+    """
+    keep - partitions to keep, including the current one
+    ahead - partitions to create after the current one
+    unit - size of a partition, a key of pgpartitionlib.TIME_CHUNKERS
+    detach_only - detach aged out partitions from the master but don't
+      drop them
+    """
+    def __init__(self, keep, ahead=1, detach_only=False, unit='month'):
+        if keep < 1 or ahead < 0:
+            raise ValueError('Need to keep at least 1 partition and create '
+                             '0 or more ahead')
+        self.keep = keep
+        self.ahead = ahead
+        self.detach_only = detach_only
+        self.chunker_class = pgpartitionlib.TIME_CHUNKERS[unit]
+
+    def window(self, today):
+        """
+        (start, end) of the partitions that should exist (end isn't
+        included, like the chunkers).  today is a date or, for units
+        smaller than a day, a datetime.
+        >>> RetentionPolicy(keep=24, ahead=3).window(dt.date(2013, 1, 15))
+        ('2011-02', '2013-05')
+        >>> RetentionPolicy(keep=7, ahead=2, unit='day').window(dt.date(2013, 1, 2))
+        ('2012-12-27', '2013-01-05')
+        >>> RetentionPolicy(keep=24, ahead=3, unit='hour').window(
+        ...     dt.datetime(2013, 1, 2, 15, 30))
+        ('2013-01-01 16:00', '2013-01-02 19:00')
+        """
+        cls = self.chunker_class
+        if not isinstance(today, dt.datetime):
+            today = dt.datetime(today.year, today.month, today.day)
+        now = cls.floor(today)
+        start = cls.step(now, 1 - self.keep)
+        end = cls.step(now, self.ahead + 1)
+        return start.strftime(cls.fmt), end.strftime(cls.fmt)
+
+
+def plan(table_name, column, policy, existing, today=None, **kw):
+    """
+    Work out what to create and drop for the window policy gives on
+    today (a date or datetime, now by default), existing is a list of
+    diff.Child.  Extra keyword arguments go to the RangePartitioner.
+    >>> hours = [diff.Child('t_2013-01-02_{0:02d}'.format(h),
+    ...                     '2013-01-02 {0:02d}:00:00'.format(h),
+    ...                     '2013-01-02 {0:02d}:00:00'.format(h + 1))
+    ...          for h in (13, 14, 15)]
+    >>> pl = plan('t', 'ts', RetentionPolicy(keep=2, ahead=1, unit='hour'),
+    ...           hours, today=dt.datetime(2013, 1, 2, 15, 30))
+    >>> print report(pl)
+    window: 2013-01-02 14:00 to 2013-01-02 17:00
+    create: t_2013-01-02_16
+    keep: t_2013-01-02_14, t_2013-01-02_15
+    drop: t_2013-01-02_13
+    """
+    start, end = policy.window(today or dt.datetime.now())
+    p = pgpartitionlib.RangePartitioner(policy.chunker_class(start, end),
+                                        table_name, column, **kw)
+    d = diff.diff(p, existing)
+    window_start = p.chunk_table().starts[0]
+    expired = [child for child in d.orphaned
+               if _ends_before(p.chunker, child, window_start)]
+    orphaned = [child for child in d.orphaned if child not in expired]
+    return Plan(p, d._replace(orphaned=orphaned), expired, policy)
+
+
+def _ends_before(chunker, child, value):
+    try:
+        return child.end is not None and chunker.key(child.end) <= value
+    except ValueError:
+        # a bound the chunker can't read, left for someone to look at
+        return False
+
+
+def parse_today(text):
+    """
+    >>> parse_today('2013-01-02')
+    datetime.datetime(2013, 1, 2, 0, 0)
+    >>> parse_today('2013-01-02T15:30')
+    datetime.datetime(2013, 1, 2, 15, 30)
+    """
+    text = text.strip().replace('T', ' ')
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d %H',
+                '%Y-%m-%d'):
+        try:
+            return dt.datetime.strptime(text, fmt)
+        except ValueError:
+            pass
+    raise ValueError('--today should be YYYY-MM-DD or YYYY-MM-DD HH:MM, '
+                     'not {0!r}'.format(text))
+
+
+def iter_plan_ddl(pl):
+    """
+    Create the new partitions, replace the function, then detach (and
+    drop) the expired ones.  Nothing if the window hasn't moved.
+    """
+    p = pl.partitioner
+    for stmt in diff.iter_diff_ddl(p, pl.diff):
+        yield stmt
+    if pl.expired and not pl.diff.missing and not p.declarative:
+        # the function still routes to the expired partitions
+        yield p.function_code()
+    for child in pl.expired:
+        yield p.detach_ddl(child.table_name)
+        if not pl.policy.detach_only:
+            yield 'DROP TABLE {0};'.format(child.table_name)
+
+
+def report(pl):
+    p = pl.partitioner
+    lines = ['window: {0} to {1}'.format(p.chunker.start, p.chunker.end)]
+    for label, names in [
+        ('create', pl.diff.missing),
+        ('keep', pl.diff.present),
+        ('detach' if pl.policy.detach_only else 'drop',
+         [child.table_name for child in pl.expired]),
+        ('overlapping', [child.table_name
+                         for child, table_names in pl.diff.overlapping]),
+        ('unknown', [child.table_name for child in pl.diff.orphaned])]:
+        if names:
+            lines.append('{0}: {1}'.format(label, ', '.join(names)))
+    return '\n'.join(lines)
+
+
+def apply_plan(pl, conn):
+    """
+    Run the plan in one transaction on conn
+    """
+    cur = conn.cursor()
+    try:
+        for stmt in iter_plan_ddl(pl):
+            if not stmt.startswith('--'):
+                cur.execute(stmt)
+    except:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
+def main(prog_args):
+    parser = optparse.OptionParser(
+        usage='%prog retain [options]',
+        description='Create upcoming time partitions and drop expired ones')
+    parser.add_option('-m', '--master-table', help='specify master table [REQ]')
+    parser.add_option('-c', '--column', help='specify partitioning (date/timestamp) column [REQ]')
+    parser.add_option('--unit', default='month', choices=sorted(pgpartitionlib.TIME_CHUNKERS), help='size of each partition: {0}, defaults to month'.format(', '.join(sorted(pgpartitionlib.TIME_CHUNKERS))))
+    parser.add_option('--keep', type='int', help='partitions to keep, including the current one [REQ]')
+    parser.add_option('--ahead', type='int', default=1, help='partitions to create after the current one, defaults to 1')
+    parser.add_option('--today', help='run as if it were this date or time (YYYY-MM-DD or YYYY-MM-DD HH:MM)')
+    parser.add_option('--dsn', help='read the existing partitions from this database')
+    parser.add_option('--state', help='read the existing partitions from (and record the new ones in) this state file')
+    parser.add_option('--declarative', action='store_true', help='the master table uses declarative partitioning')
+    parser.add_option('--detach-only', action='store_true', help="detach expired partitions but don't drop them")
+    parser.add_option('--dry-run', action='store_true', help='only report what would be done')
+    parser.add_option('--apply', action='store_true', help='run the sql against --dsn (in one transaction) rather than printing it')
+
+    opt, args = parser.parse_args(prog_args)
+    if (not opt.master_table or not opt.column or not opt.keep or
+        bool(opt.dsn) == bool(opt.state) or (opt.apply and not opt.dsn)):
+        parser.print_help()
+        return 1
+
+    today = None
+    if opt.today:
+        try:
+            today = parse_today(opt.today)
+        except ValueError, e:
+            parser.error(str(e))
+    policy = RetentionPolicy(opt.keep, opt.ahead, opt.detach_only, opt.unit)
+    conn = None
+    if opt.dsn:
+        import db
+        conn = db.connect(opt.dsn)
+        existing = diff.existing_children(conn, opt.master_table)
+    else:
+        existing = diff.load_state(opt.state)
+    try:
+        pl = plan(opt.master_table, opt.column, policy, existing, today,
+                  declarative=opt.declarative)
+        sys.stderr.write(report(pl) + '\n')
+        if opt.dry_run:
+            return
+        if opt.apply:
+            apply_plan(pl, conn)
+        else:
+            pgpartitionlib.write_sql(sys.stdout, iter_plan_ddl(pl))
+        if opt.state and not pl.diff.overlapping:
+            diff.save_state(opt.state, pl.partitioner)
+    finally:
+        if conn is not None:
+            conn.close()
+    if pl.diff.overlapping:
+        return 1
@@ -0,0 +1,242 @@
+# Copyright (c) 2010 Matt Harrison
+'''
+Run generated sql against a database rather than printing it.  The
+statements of a phase (ie the partitions, then the indexes) are sent
+batch_size at a time as one multi-statement query, which Postgres runs
+as one transaction, so a few thousand CREATE TABLEs cost a few dozen
+round trips instead of one each.  Statements that can't run in a
+transaction block (VACUUM, CREATE INDEX CONCURRENTLY, ...) are sent on
+their own in autocommit, a run of them spread over the connections of
+the pool.
+
+>>> for autocommit, stmts in iter_batches(['CREATE TABLE t_0 ();',
+...         'CREATE TABLE t_1 ();', 'CREATE TABLE t_2 ();',
+...         'CREATE INDEX CONCURRENTLY t_0_0_index ON t_0 (key);',
+...         '-- t_x matches no partition', 'VACUUM t_1;'], 2):
+...     print autocommit, stmts
+False ['CREATE TABLE t_0 ();', 'CREATE TABLE t_1 ();']
+False ['CREATE TABLE t_2 ();']
+True ['CREATE INDEX CONCURRENTLY t_0_0_index ON t_0 (key);']
+True ['VACUUM t_1;']
+'''
+from collections import namedtuple
+import Queue
+import re
+import threading
+import time
+
+import db
+
+# round_trips - queries sent (a batch, or one autocommit statement)
+Phase = namedtuple('Phase', ['name', 'statements', 'round_trips', 'seconds'])
+
+COMMENT_RE = re.compile(r'\s*--[^\n]*(\n|$)')
+
+NO_TRANSACTION_RE = re.compile(
+    r'(VACUUM|CREATE\s+DATABASE|DROP\s+DATABASE|ALTER\s+SYSTEM|'
+    r'(CREATE|DROP)\s+TABLESPACE|'
+    r'((CREATE(\s+UNIQUE)?|DROP)\s+INDEX|REINDEX)\s[^;]*\bCONCURRENTLY|'
+    r'ALTER\s+TABLE\s[^;]*\bDETACH\s+PARTITION\s[^;]*\bCONCURRENTLY)\b',
+    re.I)
+
+
+class ApplyError(Exception):
+    """
+    A statement failed, the batch it was in was rolled back (earlier
+    batches are committed)
+    """
+    def __init__(self, phase, stmts, error):
+        Exception.__init__(self, '{0}: {1}'.format(phase, str(error).strip()))
+        self.phase = phase
+        self.stmts = stmts
+        self.error = error
+
+
+def strip_comments(stmt):
+    """
+    >>> strip_comments('-- note\\nDROP TABLE t_0;')
+    'DROP TABLE t_0;'
+    """
+    while True:
+        match = COMMENT_RE.match(stmt)
+        if not match:
+            return stmt.strip()
+        stmt = stmt[match.end():]
+
+
+def needs_autocommit(stmt):
+    """
+    Can stmt not run inside a transaction block
+    >>> needs_autocommit('VACUUM ANALYZE t_0;')
+    True
+    >>> needs_autocommit('CREATE INDEX t_0_0_index ON t_0 (key);')
+    False
+    >>> needs_autocommit('DROP INDEX CONCURRENTLY t_0_0_index;')
+    True
+    """
+    return bool(NO_TRANSACTION_RE.match(strip_comments(stmt)))
+
+
+def iter_batches(stmts, batch_size=100):
+    """
+    yield (autocommit, statements) batches in order, comments are
+    dropped
+    """
+    batch = []
+    for stmt in stmts:
+        stmt = strip_comments(stmt)
+        if not stmt:
+            continue
+        if needs_autocommit(stmt):
+            if batch:
+                yield False, batch
+                batch = []
+            yield True, [stmt]
+            continue
+        batch.append(stmt)
+        if len(batch) >= batch_size:
+            yield False, batch
+            batch = []
+    if batch:
+        yield False, batch
+
+
+class ConnectionPool(object):
+    """
+    Up to size autocommit connections to dsn, made as they are needed
+    """
+    def __init__(self, dsn, size=2, settings=None):
+        self.dsn = dsn
+        self.size = max(1, size)
+        self.settings = settings
+        self._idle = Queue.Queue()
+        self._made = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            make = self._idle.empty() and self._made < self.size
+            if make:
+                self._made += 1
+        if not make:
+            return self._idle.get()
+        try:
+            return db.connect(self.dsn, autocommit=True,
+                             settings=self.settings)
+        except:
+            with self._lock:
+                self._made -= 1
+            raise
+
+    def put(self, conn):
+        if conn.closed:
+            with self._lock:
+                self._made -= 1
+        else:
+            self._idle.put(conn)
+
+    def close(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except Queue.Empty:
+                return
+            conn.close()
+            with self._lock:
+                self._made -= 1
+
+
+def run_phase(pool, name, stmts, batch_size=100):
+    """
+    Run stmts in order, returns a Phase.  Raises an ApplyError for the
+    first failing batch.
+    """
+    started = time.time()
+    statements = round_trips = 0
+    pending = []
+    for autocommit, batch in iter_batches(stmts, batch_size):
+        statements += len(batch)
+        round_trips += 1
+        if autocommit:
+            pending.append(batch[0])
+            continue
+        _run_autocommit(pool, name, pending)
+        pending = []
+        _run_batch(pool, name, batch)
+    _run_autocommit(pool, name, pending)
+    return Phase(name, statements, round_trips, time.time() - started)
+
+
+def _run_batch(pool, name, stmts):
+    import psycopg2
+    conn = pool.get()
+    try:
+        # a multi-statement query is one implicit transaction
+        conn.cursor().execute('\n'.join(stmts))
+    except psycopg2.Error, e:
+        raise ApplyError(name, stmts, e)
+    finally:
+        pool.put(conn)
+
+
+def _run_autocommit(pool, name, stmts):
+    """
+    Run independent autocommit statements over the pool's connections
+    """
+    if len(stmts) <= 1 or pool.size == 1:
+        for stmt in stmts:
+            _run_batch(pool, name, [stmt])
+        return
+    todo = Queue.Queue()
+    for stmt in stmts:
+        todo.put(stmt)
+    errors = []
+
+    def worker():
+        while not errors:
+            try:
+                stmt = todo.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                _run_batch(pool, name, [stmt])
+            except Exception, e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=worker)
+               for i in xrange(min(pool.size, len(stmts)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def run(dsn, phases, jobs=2, batch_size=100, settings=None, report=None):
+    """
+    Run the (name, statements) phases in order over a pool of up to
+    jobs connections, returns a Phase for each.
+
+    settings - dict of run time settings for each connection
+    report - function called with each Phase as it finishes
+    """
+    pool = ConnectionPool(dsn, jobs, settings)
+    done = []
+    try:
+        for name, stmts in phases:
+            phase = run_phase(pool, name, stmts, batch_size)
+            done.append(phase)
+            if report:
+                report(phase)
+    finally:
+        pool.close()
+    return done
+
+
+def format_phase(phase):
+    """
+    >>> print format_phase(Phase('partitions', 3000, 30, 1.5))
+    partitions: 3000 statements in 30 round trips, 1.50s
+    """
+    return '{0}: {1} statements in {2} round trips, {3:.2f}s'.format(*phase)
@@ -1,5 +1,6 @@
 # Copyright (c) 2010 Matt Harrison
 
+import re
 import unittest
 
 import sqlalchemy as sa
@@ -94,6 +95,94 @@ class TestPgpartitionlib(unittest.TestCase):
         drop_master = """DROP table test_part;"""
         run_sql(dburl, drop_master, autocommit=False)
         
+class TestRouting(unittest.TestCase):
+    partitioners = [
+        pgpartitionlib.MonthPartitioner('test_month', 'date', '2011-11', '2013-02'),
+        pgpartitionlib.IntPartitioner('test_part', 'key', 1, 40, 3),
+        pgpartitionlib.ArbitraryIntPartitioner('test_arb', 'key',
+                                               [1, 32, 60, 91, 200, 201]),
+        ]
+
+    def test_tree_matches_linear(self):
+        for p in self.partitioners:
+            linear = p.function_code(routing='linear')
+            tree = p.function_code(routing='tree')
+            for chunk in p.chunker:
+                for value in boundary_values(chunk):
+                    self.assertEqual(route(linear, value),
+                                     route(tree, value))
+                    self.assertEqual(route(tree, chunk.start),
+                                     p.table_name + chunk.suffix)
+
+    def test_out_of_range(self):
+        p = pgpartitionlib.IntPartitioner('test_part', 'key', 1, 10)
+        for routing in pgpartitionlib.ROUTING_MODES:
+            code = p.function_code(routing=routing)
+            self.assertEqual(route(code, 0), None)
+            self.assertEqual(route(code, 10), None)
+
+    def test_arithmetic(self):
+        p = pgpartitionlib.IntPartitioner('test_part', 'key', 1, 10, 3)
+        suffix = p.chunker.suffix_sql('NEW.key')
+        self.assertEqual(suffix, "'_' || (NEW.key - (NEW.key - 1) % 3)::text")
+        linear = p.function_code(routing='linear')
+        code = p.function_code(routing='arithmetic')
+        self.assertTrue(suffix in code)
+        for chunk in p.chunker:
+            for value in range(chunk.start, chunk.end):
+                self.assertEqual(route(code, value),
+                                 p.table_name + chunk.suffix)
+                self.assertEqual(route(code, value), route(linear, value))
+        overflow = p.function_code(routing='arithmetic', on_miss='overflow')
+        for value in (0, 1, 9, 10):
+            expected = route(code, value) or p.overflow_table()
+            self.assertEqual(route(overflow, value), expected)
+        self.assertEqual(route(code, 0), None)
+        self.assertEqual(route(code, 10), None)
+
+
+def boundary_values(chunk):
+    if isinstance(chunk.start, int):
+        return [chunk.start - 1, chunk.start, chunk.end - 1, chunk.end]
+    return [chunk.start, chunk.end]
+
+
+def route(function_code, value):
+    """
+    Run the IF/ELSIF routing of a generated insert function in python,
+    returning the table a row with the partitioning column set to value
+    is inserted into (None if the function would RAISE)
+    """
+    lines = function_code.split('\n')
+    body = []
+    for line in lines[lines.index('BEGIN')+1:lines.index('END;')]:
+        indent = line[:len(line) - len(line.lstrip())]
+        stmt = line.strip()
+        if stmt.startswith('IF ') or stmt.startswith('ELSIF '):
+            keyword, cond = stmt[:-len(' THEN')].split(' ', 1)
+            cond = re.sub(r'NEW\.\w+', 'value', cond).replace('AND', 'and')
+            keyword = 'if' if keyword == 'IF' else 'elif'
+            body.append('{0}{1} {2}:'.format(indent, keyword, cond))
+        elif stmt == 'ELSE':
+            body.append(indent + 'else:')
+        elif stmt.startswith('INSERT INTO'):
+            body.append('{0}return {1!r}'.format(indent, stmt.split()[2]))
+        elif stmt.startswith("EXECUTE 'INSERT INTO "):
+            # arithmetic routing: the master's name || suffix expression
+            table, suffix = re.match(
+                r"EXECUTE 'INSERT INTO (\w+)' \|\| (.*) \|\| ' SELECT",
+                stmt).groups()
+            suffix = re.sub(r'\((.*)\)::text', r'str(\1)', suffix)
+            suffix = re.sub(r'NEW\.\w+', 'value', suffix).replace('||', '+')
+            body.append('{0}return {1!r} + {2}'.format(indent, table, suffix))
+        elif stmt.startswith('RAISE') or stmt == 'RETURN NULL;':
+            body.append(indent + 'return None')
+        # END IF; only closes a block, indentation takes care of that
+    namespace = {}
+    exec 'def _route(value):\n' + '\n'.join(body) in namespace
+    return namespace['_route'](value)
+
+
 def run_sql(dburl, sql, autocommit=True, **kw):
     """
     Allow up to 2 gigs mem usage.
@@ -103,7 +192,6 @@ def run_sql(dburl, sql, autocommit=True, **kw):
     connection = engine.connect()
     if not autocommit:
         import psycopg2.extensions
-        raw = engine.raw_connection()
         connection.connection.connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
 
     for key in kw: